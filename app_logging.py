@@ -0,0 +1,104 @@
+"""
+Logging de la aplicación.
+
+Todos los módulos usan loggers hijos de 'tindo' (tindo.db, tindo.correo, tindo.ordenes, ...).
+Los registros se encolan con un QueueHandler y un QueueListener en un hilo aparte los escribe
+en stderr, así una petición nunca espera a que la terminal o el colector de logs consuman la salida.
+
+Variables de entorno:
+  LOG_LEVEL   DEBUG | INFO (por defecto) | WARNING | ERROR
+  LOG_FORMAT  text (por defecto) | json  (una línea JSON por registro, para agregadores)
+"""
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+import threading
+
+ROOT_LOGGER = 'tindo'
+LOG_FORMATS = ('text', 'json')
+TEXT_FORMAT = '%(asctime)s %(levelname)s [%(name)s] %(message)s'
+
+_listener = None
+_lock = threading.Lock()
+
+
+def get_logger(nombre):
+    """Logger del módulo: get_logger('db') -> 'tindo.db'"""
+    return logging.getLogger(f'{ROOT_LOGGER}.{nombre}')
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro"""
+
+    def format(self, record):
+        data = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+def _log_level():
+    nivel = os.environ.get('LOG_LEVEL', 'INFO').strip().upper()
+    return logging.getLevelNamesMapping().get(nivel, logging.INFO)
+
+
+def _formatter():
+    formato = os.environ.get('LOG_FORMAT', 'text').strip().lower()
+    if formato == 'json':
+        return JsonFormatter()
+    return logging.Formatter(TEXT_FORMAT)
+
+
+def _start_listener():
+    global _listener
+    salida = logging.StreamHandler(sys.stderr)
+    salida.setFormatter(_formatter())
+    cola = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(cola, salida, respect_handler_level=False)
+    _listener.start()
+
+    logger = logging.getLogger(ROOT_LOGGER)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(cola))
+
+
+def _restart_after_fork():
+    # El hilo del listener no sobrevive a fork (gunicorn --preload): cada worker arranca el suyo
+    if _listener is not None:
+        _start_listener()
+
+
+def configure_logging():
+    """Configura el logger 'tindo' una sola vez por proceso. Idempotente."""
+    with _lock:
+        if _listener is not None:
+            return logging.getLogger(ROOT_LOGGER)
+        logger = logging.getLogger(ROOT_LOGGER)
+        logger.setLevel(_log_level())
+        # No duplicar en el root logger (gunicorn/werkzeug configuran el suyo)
+        logger.propagate = False
+        _start_listener()
+        atexit.register(shutdown_logging)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=_restart_after_fork)
+        return logger
+
+
+def shutdown_logging():
+    """Vacía la cola pendiente antes de salir del proceso"""
+    if _listener is not None:
+        try:
+            _listener.stop()
+        except Exception:
+            pass
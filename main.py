@@ -1,43 +1,79 @@
 from flask import Flask, request, jsonify, render_template, session, redirect, url_for
 import os
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
-from sqlalchemy import create_engine, text
-from sqlalchemy.pool import StaticPool
+from sqlalchemy import create_engine, text, event
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import StaticPool, QueuePool, SingletonThreadPool
 import secrets
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import uuid
 import sqlite3
 from pathlib import Path
 import time
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from email.message import EmailMessage
 import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
-import json
+# Antes de importar los módulos propios: varios leen su configuración del entorno al importarse
 load_dotenv()
+import json
+import gzip
+import base64
+import binascii
+import logging
+import hashlib
+import migrations
+import app_logging
+import metrics
+import query_profiler
+import outbox
+import smtp_pool
+import notificaciones
+import retencion
+import password_pool
+import sesiones
+try:
+    import brotli  # Opcional: si está instalado se sirven también variantes br
+except ImportError:
+    brotli = None
+
+app_logging.configure_logging()
+log = app_logging.get_logger('app')
+log_db = app_logging.get_logger('db')
+log_correo = app_logging.get_logger('correo')
+log_ordenes = app_logging.get_logger('ordenes')
+log_catalogo = app_logging.get_logger('catalogo')
 
 app = Flask(__name__)
+# Detrás de un proxy (Render): cuántos saltos de X-Forwarded-For/-Proto confiar para request.remote_addr
+_proxy_hops = int(os.environ.get('PROXY_FIX_HOPS', '0'))
+if _proxy_hops > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=_proxy_hops, x_proto=_proxy_hops)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'tu_clave_secreta_aqui')
 app.config['UPLOAD_FOLDER'] = 'static/images'
 # Versión de assets para cache busting (se puede sobreescribir con env var)
 app.config['ASSET_VERSION'] = os.environ.get('ASSET_VERSION', str(int(time.time())))
 
+# Sentencias SQL por petición, log de consultas lentas y detector de N+1
+query_profiler.init_app(app)
+# Latencia por endpoint, tiempo en DB y peticiones en curso, expuestos en /metrics
+metrics.init_app(app)
+
 # Forzar charset UTF-8 en respuestas de texto para evitar problemas de codificación en el navegador
+TEXT_MIMES = frozenset({
+    'text/html',
+    'text/css',
+    'application/javascript',
+    'text/javascript',
+    'application/json',
+})
+
 @app.after_request
 def add_utf8_charset(response):
     try:
         # Asegurar charset solo en tipos de texto comunes
-        text_mimes = {
-            'text/html',
-            'text/css',
-            'application/javascript',
-            'text/javascript',
-            'application/json',
-        }
-        if getattr(response, 'mimetype', None) in text_mimes:
+        if response.mimetype in TEXT_MIMES and not response.mimetype_params.get('charset'):
             # Si ya tiene Content-Type, reemplazar/ajustar con charset=utf-8
             response.headers['Content-Type'] = f"{response.mimetype}; charset=utf-8"
     except Exception:
@@ -71,80 +107,222 @@ def ensure_storage_paths():
                 if os.path.exists(seed_path):
                     import shutil
                     shutil.copyfile(seed_path, db_path)
-                    print(f"ðŸŒ± Base de datos sembrada desde {seed_path} -> {db_path}")
+                    log.info("Base de datos sembrada desde %s -> %s", seed_path, db_path)
                 else:
-                    print(f"â„¹ï¸ No se encontrÃ³ seed DB en {seed_path}. Se crearÃ¡ una DB nueva en el primer init_db().")
+                    log.info("No se encontró seed DB en %s. Se creará una DB nueva al aplicar las migraciones.", seed_path)
             except Exception as e:
-                print(f"âš ï¸ Error copiando seed DB desde {seed_path} a {db_path}: {e}")
-        print(f"ðŸ—‚ï¸ Rutas de almacenamiento listas. DB dir: {db_dir or os.getcwd()} | DB file: {db_path}")
+                log.warning("Error copiando seed DB desde %s a %s: %s", seed_path, db_path, e)
+        log.info("Rutas de almacenamiento listas. DB dir: %s | DB file: %s", db_dir or os.getcwd(), db_path)
     except Exception as e:
-        print(f"âš ï¸ No se pudieron crear rutas de almacenamiento: {e}")
+        log.warning("No se pudieron crear rutas de almacenamiento: %s", e)
 
 # Ejecutar inmediatamente para entornos como Gunicorn en Render
 ensure_storage_paths()
 
-# Nota: init_db() se invocarÃ¡ mÃ¡s abajo con un guard para evitar NameError y correrlo solo una vez
+# Verificar el esquema al arrancar cada worker. Si PRAGMA user_version ya está al día es una
+# sola lectura; las migraciones pendientes se aplican una vez bajo lock (ver migrations.py).
+# En el deploy se ejecutan antes con `python migrations.py`.
+try:
+    migrations.ensure_schema(os.environ.get('DATABASE_PATH', 'inefablestore.db'))
+except Exception as e:
+    log.exception("Error aplicando migraciones al arrancar: %s", e)
 
 # ConfiguraciÃ³n de SQLAlchemy con SQLite
+# Modo del pool de conexiones (variable DB_POOL_MODE):
+# - 'queue'  (por defecto): QueuePool acotado, DB_POOL_SIZE conexiones + DB_POOL_MAX_OVERFLOW extra
+# - 'thread': una conexión por hilo (SingletonThreadPool, hasta DB_POOL_SIZE hilos)
+# - 'static': una única conexión compartida por todos los hilos (comportamiento anterior)
+DB_POOL_MODES = ('queue', 'thread', 'static')
+
+def _db_pool_settings():
+    mode = (os.environ.get('DB_POOL_MODE') or 'queue').strip().lower()
+    if mode not in DB_POOL_MODES:
+        log_db.warning("DB_POOL_MODE inválido %r, usando 'queue'", mode)
+        mode = 'queue'
+    return {
+        'mode': mode,
+        'size': max(1, int(os.environ.get('DB_POOL_SIZE', '5'))),
+        'max_overflow': max(0, int(os.environ.get('DB_POOL_MAX_OVERFLOW', '5'))),
+        'timeout': float(os.environ.get('DB_POOL_TIMEOUT', '30')),
+    }
+
+# Perfiles de PRAGMA aplicados a cada conexión SQLite nueva (variable SQLITE_PRAGMA_PROFILE).
+# El orden importa: busy_timeout va primero para que el cambio a WAL espere si hay bloqueos.
+SQLITE_PRAGMA_PROFILES = {
+    # Lectores concurrentes con un único escritor (recomendado en producción)
+    'wal': [
+        ('busy_timeout', '5000'),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', '-16000'),      # ~16 MB por conexión
+        ('mmap_size', '134217728'),    # 128 MB
+        ('temp_store', 'MEMORY'),
+        ('foreign_keys', 'ON'),
+    ],
+    # Igual que 'wal' pero con fsync en cada commit
+    'wal-durable': [
+        ('busy_timeout', '5000'),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'FULL'),
+        ('cache_size', '-16000'),
+        ('mmap_size', '134217728'),
+        ('temp_store', 'MEMORY'),
+        ('foreign_keys', 'ON'),
+    ],
+    # Journal clásico (rollback); útil si el disco no soporta memoria compartida para WAL
+    'legacy': [
+        ('busy_timeout', '5000'),
+        ('journal_mode', 'DELETE'),
+    ],
+}
+DEFAULT_SQLITE_PRAGMA_PROFILE = 'wal'
+
+def _sqlite_pragma_profile_name():
+    name = (os.environ.get('SQLITE_PRAGMA_PROFILE') or DEFAULT_SQLITE_PRAGMA_PROFILE).strip().lower()
+    if name not in SQLITE_PRAGMA_PROFILES:
+        log_db.warning("SQLITE_PRAGMA_PROFILE inválido %r, usando %r", name, DEFAULT_SQLITE_PRAGMA_PROFILE)
+        name = DEFAULT_SQLITE_PRAGMA_PROFILE
+    return name
+
+def _apply_sqlite_pragmas(dbapi_conn):
+    """Aplica el perfil de PRAGMA configurado a una conexión sqlite3 recién abierta."""
+    cursor = dbapi_conn.cursor()
+    try:
+        for pragma, valor in SQLITE_PRAGMA_PROFILES[_sqlite_pragma_profile_name()]:
+            try:
+                cursor.execute(f"PRAGMA {pragma}={valor}")
+            except sqlite3.Error as e:
+                log_db.warning("No se pudo aplicar PRAGMA %s=%s: %s", pragma, valor, e)
+    finally:
+        cursor.close()
+
+def get_sqlite_pragma_report(conn):
+    """Valores efectivos de los PRAGMA del perfil activo, leídos desde una conexión SQLAlchemy."""
+    profile = _sqlite_pragma_profile_name()
+    report = {'profile': profile}
+    for pragma, _ in SQLITE_PRAGMA_PROFILES[profile]:
+        try:
+            report[pragma] = conn.execute(text(f"PRAGMA {pragma}")).scalar()
+        except Exception as e:
+            report[pragma] = f'error: {e}'
+    return report
+
+# Métricas del pool (por proceso), expuestas en /health/db
+_pool_stats_lock = threading.Lock()
+_pool_stats = {
+    'connects': 0,
+    'checkouts': 0,
+    'checkins': 0,
+    'in_use': 0,
+    'max_in_use': 0,
+    'timeouts': 0,
+    'wait_total_ms': 0.0,
+    'wait_max_ms': 0.0,
+}
+
+def _register_pool_metrics(engine):
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_conn, conn_record):
+        with _pool_stats_lock:
+            _pool_stats['connects'] += 1
+
+    @event.listens_for(engine, 'checkout')
+    def _on_checkout(dbapi_conn, conn_record, conn_proxy):
+        with _pool_stats_lock:
+            _pool_stats['checkouts'] += 1
+            _pool_stats['in_use'] += 1
+            if _pool_stats['in_use'] > _pool_stats['max_in_use']:
+                _pool_stats['max_in_use'] = _pool_stats['in_use']
+
+    @event.listens_for(engine, 'checkin')
+    def _on_checkin(dbapi_conn, conn_record):
+        with _pool_stats_lock:
+            _pool_stats['checkins'] += 1
+            _pool_stats['in_use'] = max(0, _pool_stats['in_use'] - 1)
+
+def get_pool_stats():
+    """Copia de las métricas del pool de este proceso, con el estado actual del pool."""
+    with _pool_stats_lock:
+        stats = dict(_pool_stats)
+    checkouts = stats['checkouts'] or 1
+    stats['wait_avg_ms'] = round(stats['wait_total_ms'] / checkouts, 3)
+    stats['wait_total_ms'] = round(stats['wait_total_ms'], 3)
+    stats['wait_max_ms'] = round(stats['wait_max_ms'], 3)
+    stats.update(_db_pool_settings())
+    if db_engine is not None:
+        stats['pool_status'] = db_engine.pool.status()
+    return stats
+
 def create_db_engine():
     # Usar SQLite como base de datos por defecto
     db_path = os.environ.get('DATABASE_PATH', 'inefablestore.db')
     database_url = f"sqlite:///{db_path}"
-    
-    print(f"ðŸ”— Conectando con SQLite: {db_path}")
+    settings = _db_pool_settings()
+
+    log_db.info("Conectando con SQLite: %s (pool=%s, size=%s)", db_path, settings['mode'], settings['size'])
+
+    if settings['mode'] == 'static':
+        pool_args = {'poolclass': StaticPool}
+    elif settings['mode'] == 'thread':
+        pool_args = {'poolclass': SingletonThreadPool, 'pool_size': settings['size']}
+    else:
+        pool_args = {
+            'poolclass': QueuePool,
+            'pool_size': settings['size'],
+            'max_overflow': settings['max_overflow'],
+            'pool_timeout': settings['timeout'],
+        }
 
     try:
         # ConfiguraciÃ³n especÃ­fica para SQLite
         engine = create_engine(
             database_url,
-            poolclass=StaticPool,  # Para SQLite
             pool_pre_ping=True,  # Para verificar conexiones antes de usarlas
             connect_args={
-                "check_same_thread": False,  # Permitir acceso desde mÃºltiples threads
+                "check_same_thread": False,  # Las conexiones del pool pasan de un hilo a otro
                 "timeout": 30  # Timeout de conexiÃ³n
             },
-            echo=False  # Cambiar a True para debug SQL
+            echo=False,  # Cambiar a True para debug SQL
+            **pool_args
         )
+        event.listen(engine, 'connect', lambda dbapi_conn, conn_record: _apply_sqlite_pragmas(dbapi_conn))
+        _register_pool_metrics(engine)
+        query_profiler.instrument_engine(engine)
 
         # Probar la conexiÃ³n
         with engine.connect() as conn:
             conn.execute(text('SELECT 1'))
 
-        print("âœ… ConexiÃ³n a SQLite exitosa")
+        log_db.info("Conexión a SQLite exitosa")
         return engine
     except Exception as e:
-        print(f"âŒ Error conectando a SQLite: {e}")
-        print("ðŸ’¡ Verifica que:")
-        print("   - El directorio tenga permisos de escritura")
-        print("   - No haya problemas de espacio en disco")
+        log_db.error("Error conectando a SQLite: %s. Verifica que el directorio tenga permisos de escritura y haya espacio en disco", e)
         raise e
 
 # Engine global
 db_engine = None
+_db_engine_lock = threading.Lock()
 
 def get_db_connection():
     """Obtener conexiÃ³n a la base de datos usando SQLAlchemy"""
     global db_engine
     if db_engine is None:
-        db_engine = create_db_engine()
-    return db_engine.connect()
-
-def _sqlite_column_exists(conn, table: str, column: str) -> bool:
+        with _db_engine_lock:
+            if db_engine is None:
+                db_engine = create_db_engine()
+    inicio = time.perf_counter()
     try:
-        result = conn.execute(text(f"PRAGMA table_info({table})"))
-        cols = [row[1] for row in result.fetchall()]
-        return column in cols
-    except Exception:
-        return False
-
-def _ensure_sqlite_column(conn, table: str, column: str, ddl: str):
-    """Ensure a column exists in a SQLite table. ddl must be 'column_name TYPE [DEFAULT ...]'."""
-    if not _sqlite_column_exists(conn, table, column):
-        try:
-            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {ddl}"))
-            print(f"ðŸ§© MigraciÃ³n SQLite: aÃ±adida columna {table}.{column}")
-        except Exception as e:
-            print(f"âš ï¸ No se pudo aÃ±adir columna {table}.{column}: {e}")
+        conn = db_engine.connect()
+    except PoolTimeoutError:
+        with _pool_stats_lock:
+            _pool_stats['timeouts'] += 1
+        raise
+    espera_ms = (time.perf_counter() - inicio) * 1000
+    with _pool_stats_lock:
+        _pool_stats['wait_total_ms'] += espera_ms
+        if espera_ms > _pool_stats['wait_max_ms']:
+            _pool_stats['wait_max_ms'] = espera_ms
+    return conn
 
 def get_sqlite_connection():
     """Obtener conexiÃ³n directa con sqlite3 para funciones que lo requieren"""
@@ -156,288 +334,182 @@ def get_sqlite_connection():
             timeout=30,
             check_same_thread=False
         )
+        _apply_sqlite_pragmas(conn)
         # Configurar SQLite para que devuelva filas como diccionarios
         conn.row_factory = sqlite3.Row
         return conn
     except Exception as e:
-        print(f"âŒ Error en conexiÃ³n SQLite: {e}")
-        print(f"ðŸ”— Ruta utilizada: {db_path}")
+        log_db.error("Error en conexión SQLite (%s): %s", db_path, e)
         raise e
 
-def enviar_correo_gift_card_completada(orden_info):
-    """EnvÃ­a correo al usuario con el cÃ³digo de la Gift Card"""
-    try:
-        # ConfiguraciÃ³n del correo
-        smtp_server = "smtp.gmail.com"
-        smtp_port = 587
-        email_usuario = "1yorbi1@gmail.com"
-        email_password = os.environ.get('GMAIL_APP_PASSWORD')
-
-        print(f"ðŸŽ Enviando Gift Card completada para orden #{orden_info['id']}")
-        print(f"ðŸ“§ Destinatario: {orden_info['usuario_email']}")
-
-        if not email_password:
-            print("âŒ ERROR: No se encontrÃ³ la contraseÃ±a de Gmail")
-            return False
-
-        # Crear mensaje
-        mensaje = MIMEMultipart()
-        mensaje['From'] = email_usuario
-        mensaje['To'] = orden_info['usuario_email']
-        mensaje['Subject'] = f"ðŸŽ Â¡Tu Gift Card estÃ¡ lista! - Orden #{orden_info['id']} - tindostore"
-
-        # Cuerpo del mensaje especÃ­fico para Gift Cards
-        cuerpo = f"""
-        Â¡Hola! ðŸŽ
-
-        Â¡Excelentes noticias! Tu Gift Card ha sido procesada exitosamente.
-
-        ðŸ“‹ Detalles de tu orden:
-        â€¢ Orden #: {orden_info['id']}
-        â€¢ Producto: {orden_info.get('juego_nombre', 'Gift Card')}
-        â€¢ Paquete: {orden_info['paquete']}
-        â€¢ Monto: ${orden_info['monto']}
-        â€¢ Estado: âœ… COMPLETADA
-        â€¢ Fecha de procesamiento: {datetime.now().strftime('%d/%m/%Y a las %H:%M')}
-
-        ðŸŽ¯ CÃ“DIGO DE TU GIFT CARD:
-        â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•
-        ðŸ”‘ {orden_info.get('codigo_producto', 'CÃ“DIGO NO DISPONIBLE')}
-        â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•â•
-
-        ðŸ“ Instrucciones de uso:
-        â€¢ Guarda este cÃ³digo en un lugar seguro
-        â€¢ Utiliza este cÃ³digo en la plataforma correspondiente
-        â€¢ El cÃ³digo es de un solo uso
-        â€¢ Si tienes problemas para canjearlo, contÃ¡ctanos
-
-        âš ï¸ IMPORTANTE: Este cÃ³digo es personal e intransferible.
-        No lo compartas con nadie para evitar fraudes.
-
-        Â¡Gracias por confiar en tindostore! ðŸš€
-
-        ---
-        Equipo de tindostore
-        """
-
-        mensaje.attach(MIMEText(cuerpo, 'plain'))
-
-        print("ðŸ“¤ Enviando Gift Card con cÃ³digo al usuario...")
-        # Enviar correo
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(email_usuario, email_password)
-        texto = mensaje.as_string()
-        server.sendmail(email_usuario, orden_info['usuario_email'], texto)
-        server.quit()
-
-        print(f"âœ… Gift Card enviada exitosamente a: {orden_info['usuario_email']}")
-        return True
-
-    except Exception as e:
-        print(f"âŒ Error al enviar Gift Card: {str(e)}")
-        return False
-
-def enviar_correo_recarga_completada(orden_info):
-    """EnvÃ­a correo al usuario confirmando que su recarga ha sido completada"""
-    try:
-        # ConfiguraciÃ³n del correo
-        smtp_server = "smtp.gmail.com"
-        smtp_port = 587
-        email_usuario = "1yorbi1@gmail.com"
-        email_password = os.environ.get('GMAIL_APP_PASSWORD')
-
-        print(f"ðŸ“¨ Enviando confirmaciÃ³n de recarga completada para orden #{orden_info['id']}")
-        print(f"ðŸ“§ Destinatario: {orden_info['usuario_email']}")
-
-        if not email_password:
-            print("âŒ ERROR: No se encontrÃ³ la contraseÃ±a de Gmail")
-            return False
-
-        # Crear mensaje
-        mensaje = MIMEMultipart()
-        mensaje['From'] = email_usuario
-        mensaje['To'] = orden_info['usuario_email']
-        # Asunto con marca Tindo Store
-        mensaje['Subject'] = f"Tu recarga estÃ¡ lista - Orden #{orden_info['id']} - Tindo Store"
-
-        # FunciÃ³n local para formatear la fecha en espaÃ±ol (evita depender del locale del sistema)
-        meses_es = [
-            "enero", "febrero", "marzo", "abril", "mayo", "junio",
-            "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre"
-        ]
-        ahora = datetime.now()
-        fecha_es = f"{ahora.day} de {meses_es[ahora.month - 1]} de {ahora.year}"
-
-        # Cuerpo del mensaje con el template solicitado
-        cuerpo = f"""
-Hola,
-
-Gracias por tu compra. Nos complace informarte que tu pedido ha sido procesado con Ã©xito.
-
-Detalles de la orden:  
-ðŸ“… Fecha: {fecha_es}  
-ðŸŽ® Producto: {orden_info.get('juego_nombre', 'N/A')}  
-ðŸ†” ID de jugador: {orden_info.get('usuario_id', 'No especificado')}  
-ðŸ’Ž Paquete adquirido: {orden_info.get('paquete', 'N/A')}  
-ðŸ’° Costo: ${orden_info.get('monto', '0.00')} USD
-
-Si necesitas asistencia o tienes alguna consulta, estamos aquÃ­ para ayudarte.
-
-Atentamente,  
-Equipo de Tindo Store
-"""
-
-        mensaje.attach(MIMEText(cuerpo, 'plain'))
-
-        print("ðŸ“¤ Enviando correo de confirmaciÃ³n al usuario...")
-        # Enviar correo
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(email_usuario, email_password)
-        texto = mensaje.as_string()
-        server.sendmail(email_usuario, orden_info['usuario_email'], texto)
-        server.quit()
-
-        print(f"âœ… Correo de confirmaciÃ³n enviado exitosamente a: {orden_info['usuario_email']}")
-        return True
-
-    except Exception as e:
-        print(f"âŒ Error al enviar correo de confirmaciÃ³n: {str(e)}")
-        return False
-
-def enviar_correo_orden_rechazada(orden_info):
-    """EnvÃ­a correo al usuario notificando que su orden ha sido rechazada por datos incorrectos"""
-    try:
-        # ConfiguraciÃ³n del correo
-        smtp_server = "smtp.gmail.com"
-        smtp_port = 587
-        email_usuario = "1yorbi1@gmail.com"
-        email_password = os.environ.get('GMAIL_APP_PASSWORD')
-
-        print(f"ðŸ“§ Enviando notificaciÃ³n de orden rechazada para orden #{orden_info['id']}")
-        print(f"ðŸ“§ Destinatario: {orden_info['usuario_email']}")
-
-        if not email_password:
-            print("âŒ ERROR: No se encontrÃ³ la contraseÃ±a de Gmail")
-            return False
-
-        # Crear mensaje
-        mensaje = MIMEMultipart()
-        mensaje['From'] = email_usuario
-        mensaje['To'] = orden_info['usuario_email']
-        mensaje['Subject'] = f"âš ï¸ Orden Rechazada - Datos Incorrectos - Orden #{orden_info['id']} - tindostore"
-
-        # Cuerpo del mensaje para orden rechazada
-        cuerpo = f"""
-        Hola,
-
-        Lamentamos informarte que tu orden ha sido rechazada debido a datos incorrectos.
-
-        ðŸ“‹ Detalles de la orden rechazada:
-        â€¢ Orden #: {orden_info['id']}
-        â€¢ Juego: {orden_info.get('juego_nombre', 'N/A')}
-        â€¢ Paquete: {orden_info['paquete']}
-        â€¢ Monto: ${orden_info['monto']}
-        â€¢ MÃ©todo de pago: {orden_info['metodo_pago']}
-        â€¢ Referencia proporcionada: {orden_info['referencia_pago']}
-        â€¢ Estado: âŒ RECHAZADA
-        â€¢ Fecha de rechazo: {datetime.now().strftime('%d/%m/%Y a las %H:%M')}
-
-        âš ï¸ Motivo del rechazo:
-        No pudimos encontrar la referencia de pago proporcionada en nuestro sistema. 
-        Esto puede deberse a:
-        
-        â€¢ Referencia de pago incorrecta o incompleta
-        â€¢ El pago aÃºn no se ha procesado
-        â€¢ Error al escribir la referencia
-
-        ðŸ”„ Â¿QuÃ© puedes hacer?
-        1. Verifica que la referencia de pago sea correcta
-        2. AsegÃºrate de que el pago se haya completado exitosamente
-        3. Contacta con nosotros si estÃ¡s seguro de que los datos son correctos
-        4. Realiza una nueva orden con la informaciÃ³n correcta
-
-        ðŸ“ž Contacto:
-        Si tienes alguna duda o necesitas ayuda, no dudes en contactarnos a travÃ©s de nuestros canales de atenciÃ³n.
-
-        Gracias por tu comprensiÃ³n.
-
-        ---
-        Equipo de tindostore
-        """
-
-        mensaje.attach(MIMEText(cuerpo, 'plain'))
-
-        print("ðŸ“¤ Enviando correo de orden rechazada al usuario...")
-        # Enviar correo
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(email_usuario, email_password)
-        texto = mensaje.as_string()
-        server.sendmail(email_usuario, orden_info['usuario_email'], texto)
-        server.quit()
-
-        print(f"âœ… Correo de orden rechazada enviado exitosamente a: {orden_info['usuario_email']}")
-        return True
-
-    except Exception as e:
-        print(f"âŒ Error al enviar correo de orden rechazada: {str(e)}")
-        return False
+# Sesiones en la tabla sesiones (la cookie solo lleva el id), con el perfil del usuario
+# cacheado por worker: /usuario y POST /orden no consultan usuarios
+app.session_interface = sesiones.SQLiteSessionInterface(get_db_connection)
 
-def limpiar_ordenes_antiguas(usuario_email):
-    """Mantiene solo las Ãºltimas 40 Ã³rdenes por usuario, eliminando las mÃ¡s antiguas"""
-    conn = get_db_connection()
+# =====================
+# Caches en memoria (por worker) con versión compartida
+# =====================
+# Cada cache tiene una fila en cache_versiones. Los endpoints que modifican los datos
+# incrementan la versión dentro de su transacción; cada worker compara su snapshot con
+# esa versión como mucho cada CACHE_VERSION_CHECK_SECONDS (0 = en cada petición).
+CACHE_VERSION_CHECK_SECONDS = float(os.environ.get('CACHE_VERSION_CHECK_SECONDS', '1'))
+
+def bump_cache_version(conn, clave):
+    """Incrementa la versión compartida de una cache. Llamar antes del commit del cambio."""
+    conn.execute(text('''
+        INSERT INTO cache_versiones (clave, version, actualizado) VALUES (:clave, 1, CURRENT_TIMESTAMP)
+        ON CONFLICT (clave) DO UPDATE SET version = version + 1, actualizado = CURRENT_TIMESTAMP
+    '''), {'clave': clave})
+
+# Cache-Control de las respuestas públicas cacheables, configurable por endpoint
+PUBLIC_CACHE_CONTROL = {
+    'productos': os.environ.get('CACHE_CONTROL_PRODUCTOS', 'public, max-age=30, stale-while-revalidate=120'),
+    'config': os.environ.get('CACHE_CONTROL_CONFIG', 'public, max-age=60, stale-while-revalidate=300'),
+    'valoraciones': os.environ.get('CACHE_CONTROL_VALORACIONES', 'no-cache'),
+}
+
+def _parse_fecha_utc(valor):
+    """CURRENT_TIMESTAMP de SQLite ('YYYY-MM-DD HH:MM:SS', UTC) -> datetime con zona"""
+    if not valor:
+        return None
+    if isinstance(valor, datetime):
+        return valor.replace(tzinfo=timezone.utc)
     try:
-        # Contar Ã³rdenes del usuario
-        result = conn.execute(text('''
-            SELECT COUNT(*) FROM ordenes WHERE usuario_email = :email
-        '''), {'email': usuario_email})
-
-        total_ordenes = result.fetchone()[0]
-
-        # Si tiene mÃ¡s de 40 Ã³rdenes, eliminar las mÃ¡s antiguas
-        if total_ordenes > 40:
-            ordenes_a_eliminar = total_ordenes - 40
-
-            # Obtener IDs de las Ã³rdenes mÃ¡s antiguas
-            result = conn.execute(text('''
-                SELECT id FROM ordenes 
-                WHERE usuario_email = :email 
-                ORDER BY fecha ASC 
-                LIMIT :limit
-            '''), {'email': usuario_email, 'limit': ordenes_a_eliminar})
-
-            ids_a_eliminar = [row[0] for row in result.fetchall()]
-
-            if ids_a_eliminar:
-                # Eliminar las Ã³rdenes mÃ¡s antiguas
-                for orden_id in ids_a_eliminar:
-                    conn.execute(text('DELETE FROM ordenes WHERE id = :id'), {'id': orden_id})
-
-                conn.commit()
-                print(f"ðŸ§¹ Limpieza automÃ¡tica: Eliminadas {len(ids_a_eliminar)} Ã³rdenes antiguas del usuario {usuario_email}")
-
-    except Exception as e:
-        print(f"âŒ Error al limpiar Ã³rdenes antiguas: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+        return datetime.strptime(str(valor)[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+# Cuerpos más chicos que esto no se comprimen (el overhead de gzip no compensa)
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '512'))
+JSON_CONTENT_TYPE = 'application/json; charset=utf-8'
+
+def _codificar_variantes(body):
+    """Codificaciones precalculadas de un cuerpo, en orden de preferencia: {'br'?, 'gzip'?, 'identity'}"""
+    variantes = {}
+    if len(body) >= COMPRESS_MIN_BYTES:
+        # Se comprime una vez por versión, así que conviene el nivel máximo
+        if brotli is not None:
+            variantes['br'] = brotli.compress(body, quality=11)
+        variantes['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+    variantes['identity'] = body
+    return variantes
+
+class Snapshot:
+    """Datos cacheados de una versión, su cuerpo JSON ya serializado y sus variantes comprimidas."""
+    __slots__ = ('version', 'data', 'body', 'etag', 'last_modified', 'variantes', '_por_id')
+
+    def __init__(self, version, data, body, last_modified=None):
+        self.version = version
+        self.data = data
+        self.body = body
+        # Derivado del contenido: igual en todos los workers para la misma versión
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.last_modified = last_modified
+        self.variantes = _codificar_variantes(body)
+        self._por_id = None
+
+    def variante(self, accept_encodings):
+        """(codificación, bytes) aceptada por el cliente; identity si no acepta ninguna comprimida"""
+        for codificacion, contenido in self.variantes.items():
+            if codificacion == 'identity' or accept_encodings.quality(codificacion) > 0:
+                return codificacion, contenido
+        return 'identity', self.body
+
+    def por_id(self):
+        """{id: elemento} cuando data es una lista de dicts con 'id' (se arma una vez por versión)"""
+        if self._por_id is None:
+            self._por_id = {item['id']: item for item in self.data}
+        return self._por_id
+
+class CacheSnapshot:
+    """Snapshot versionado en memoria de una respuesta pública de solo lectura.
+
+    loader(conn) devuelve los datos; se reconstruye solo cuando cambia la versión compartida.
+    """
 
-# Ejecutar init_db() una sola vez por proceso cuando lleguen las primeras solicitudes
-_DB_INIT_DONE = False
+    def __init__(self, clave, loader):
+        self.clave = clave
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._verificado_en = 0.0
+
+    def invalidate(self):
+        """Fuerza a releer la versión compartida en la próxima petición (tras un cambio local)."""
+        self._verificado_en = 0.0
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._verificado_en < CACHE_VERSION_CHECK_SECONDS:
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and time.monotonic() - self._verificado_en < CACHE_VERSION_CHECK_SECONDS:
+                return snapshot
+            conn = get_db_connection()
+            try:
+                # Leer la versión antes que los datos: si hay una escritura entre ambas lecturas
+                # el snapshot queda con la versión vieja y se reconstruye en la siguiente verificación
+                row = conn.execute(text('SELECT version, actualizado FROM cache_versiones WHERE clave = :clave'),
+                                   {'clave': self.clave}).fetchone()
+                version = row[0] if row else 0
+                if snapshot is None or snapshot.version != version:
+                    data = self._loader(conn)
+                    snapshot = Snapshot(version, data, app.json.dumps(data).encode('utf-8'),
+                                        _parse_fecha_utc(row[1]) if row else None)
+                    self._snapshot = snapshot
+            finally:
+                conn.close()
+            self._verificado_en = time.monotonic()
+            return snapshot
+
+def _no_modificado(etag, last_modified=None):
+    """Evalúa If-None-Match / If-Modified-Since de la petición actual"""
+    if request.if_none_match:
+        # If-None-Match tiene prioridad y usa comparación débil (RFC 9110 13.1.2)
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+def respuesta_cacheable(endpoint, etag, body, last_modified=None):
+    """Respuesta JSON con validadores; 304 sin cuerpo si el cliente ya tiene esta versión.
+
+    body puede ser un callable para no construir el cuerpo cuando se responde 304; puede devolver
+    el cuerpo o (cuerpo, headers) si la respuesta lleva headers propios (p.ej. X-Next-Cursor).
+    """
+    if _no_modificado(etag, last_modified):
+        response = app.response_class(status=304)
+    else:
+        contenido = body() if callable(body) else body
+        headers = None
+        if isinstance(contenido, tuple):
+            contenido, headers = contenido
+        response = app.response_class(contenido, mimetype='application/json', headers=headers)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = PUBLIC_CACHE_CONTROL[endpoint]
+    return response
 
-@app.before_request
-def _ensure_db_initialized_once():
-    global _DB_INIT_DONE
-    if not _DB_INIT_DONE:
-        try:
-            init_db()
-            _DB_INIT_DONE = True
-            print("âœ… init_db ejecutado (before_request, una sola vez por worker)")
-        except Exception as e:
-            # No bloquear la peticiÃ³n, pero loguear el error para diagnÃ³stico
-            print(f"âš ï¸ Error ejecutando init_db en before_request: {e}")
+def respuesta_snapshot(endpoint, snapshot):
+    """Sirve un snapshot sin serializar ni comprimir: elige la variante según Accept-Encoding."""
+    codificacion, contenido = snapshot.variante(request.accept_encodings)
+    # Cada codificación es una representación distinta y necesita su propio ETag fuerte
+    etag = snapshot.etag if codificacion == 'identity' else f"{snapshot.etag}-{codificacion}"
+    if _no_modificado(etag, snapshot.last_modified):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(contenido, content_type=JSON_CONTENT_TYPE)
+        if codificacion != 'identity':
+            response.headers['Content-Encoding'] = codificacion
+    response.set_etag(etag)
+    if snapshot.last_modified is not None:
+        response.last_modified = snapshot.last_modified
+    response.headers['Cache-Control'] = PUBLIC_CACHE_CONTROL[endpoint]
+    if len(snapshot.variantes) > 1:
+        response.vary.add('Accept-Encoding')
+    return response
 
 # Endpoint pÃºblico de salud para verificar conexiÃ³n a SQLite en Render
 @app.route('/health/db', methods=['GET'])
@@ -462,16 +534,19 @@ def health_db():
             info['usuarios_total'] = int(res_user.fetchone()[0])
             res_admin = conn.execute(text('SELECT COUNT(*) FROM usuarios WHERE es_admin = 1'))
             info['admins_total'] = int(res_admin.fetchone()[0])
+            info['pragmas'] = get_sqlite_pragma_report(conn)
         finally:
             conn.close()
     except Exception as e:
         info['sqlalchemy_connect'] = False
         info['error'] = str(e)
+    info['pool'] = get_pool_stats()
     # TambiÃ©n probar con sqlite3 directa
     try:
         sconn = sqlite3.connect(db_path, timeout=5)
         try:
-            sconn.execute('PRAGMA user_version')
+            info['schema_version'] = int(sconn.execute('PRAGMA user_version').fetchone()[0])
+            info['schema_latest'] = migrations.LATEST_VERSION
             info['sqlite3_connect'] = True
         finally:
             sconn.close()
@@ -480,356 +555,9 @@ def health_db():
         info['sqlite3_error'] = str(e)
     return jsonify(info)
 
-def enviar_notificacion_orden(orden_data):
-    """EnvÃ­a notificaciÃ³n por correo de nueva orden"""
-    try:
-        # ConfiguraciÃ³n del correo
-        smtp_server = "smtp.gmail.com"
-        smtp_port = 587
-        email_usuario = "1yorbi1@gmail.com"
-        email_password = os.environ.get('GMAIL_APP_PASSWORD')
-
-        print(f"ðŸ”§ Intentando enviar notificaciÃ³n para orden #{orden_data['id']}")
-        print(f"ðŸ“§ Email configurado: {email_usuario}")
-
-        if not email_password:
-            print("âŒ ERROR: No se encontrÃ³ la contraseÃ±a de Gmail en los secretos")
-            print("ðŸ’¡ SoluciÃ³n: Agrega el secreto 'GMAIL_APP_PASSWORD' en Replit")
-            print("ðŸ’¡ Usa una contraseÃ±a de aplicaciÃ³n de Gmail, no tu contraseÃ±a normal")
-            return False
-
-        print("ðŸ”‘ ContraseÃ±a de aplicaciÃ³n encontrada")
-
-        # Crear mensaje
-        mensaje = MIMEMultipart()
-        mensaje['From'] = email_usuario
-        mensaje['To'] = email_usuario  # Enviamos a nosotros mismos
-        mensaje['Subject'] = f"ðŸ›’ Nueva Orden #{orden_data['id']} - tindostore"
-
-        # Cuerpo del mensaje
-        cuerpo = f"""
-        Â¡Nueva orden recibida en tindostore!
-
-        ðŸ“‹ Detalles de la Orden:
-        â€¢ ID: #{orden_data['id']}
-        â€¢ Juego: {orden_data.get('juego_nombre', 'N/A')}
-        â€¢ Paquete: {orden_data['paquete']}
-        â€¢ Monto: ${orden_data['monto']}
-        â€¢ Cliente: {orden_data['usuario_email']}
-        â€¢ TelÃ©fono: {orden_data.get('usuario_telefono', 'No especificado')}
-        â€¢ ID del Usuario en el Juego: {orden_data.get('usuario_id', 'No especificado')}
-        â€¢ MÃ©todo de Pago: {orden_data['metodo_pago']}
-        â€¢ Referencia: {orden_data['referencia_pago']}
-        â€¢ Estado: {orden_data['estado']}
-        â€¢ Fecha: {orden_data['fecha']}
-
-        ðŸŽ® Accede al panel de administraciÃ³n para gestionar esta orden.
-
-        Â¡Saludos del equipo de tindostore! ðŸš€
-        """
-
-        mensaje.attach(MIMEText(cuerpo, 'plain'))
-
-        print("ðŸ“¨ Conectando al servidor SMTP...")
-        # Enviar correo
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        print("ðŸ” Iniciando sesiÃ³n...")
-        server.login(email_usuario, email_password)
-        print("ðŸ“¤ Enviando correo...")
-        texto = mensaje.as_string()
-        server.sendmail(email_usuario, email_usuario, texto)
-        server.quit()
-
-        print(f"âœ… NotificaciÃ³n enviada exitosamente para orden #{orden_data['id']}")
-        print(f"ðŸ“¬ Revisa tu bandeja de entrada en: {email_usuario}")
-        return True
-
-    except smtplib.SMTPAuthenticationError as e:
-        print(f"âŒ ERROR DE AUTENTICACIÃ“N: {str(e)}")
-        print("ðŸ’¡ Verifica que tengas una contraseÃ±a de aplicaciÃ³n vÃ¡lida")
-        print("ðŸ’¡ AsegÃºrate de tener habilitada la verificaciÃ³n en 2 pasos")
-        return False
-    except smtplib.SMTPException as e:
-        print(f"âŒ ERROR SMTP: {str(e)}")
-        return False
-    except Exception as e:
-        print(f"âŒ Error general al enviar notificaciÃ³n: {str(e)}")
-        print(f"ðŸ” Tipo de error: {type(e).__name__}")
-        return False
-
 def init_db():
-    """Inicializa las tablas de la base de datos"""
-    conn = get_db_connection()
-
-    try:
-        # Asegurar tablas base (si no existen)
-        # Crear tablas usando SQLAlchemy (SQLite compatible)
-        conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS juegos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nombre TEXT,
-                descripcion TEXT,
-                imagen TEXT,
-                categoria TEXT DEFAULT 'juegos',
-                orden INTEGER DEFAULT 0,
-                etiquetas TEXT
-            );
-        '''))
-
-        # SQLite no soporta ADD COLUMN IF NOT EXISTS, pero las columnas ya estÃ¡n en CREATE TABLE
-
-        conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS paquetes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                juego_id INTEGER REFERENCES juegos(id),
-                nombre TEXT,
-                precio REAL,
-                orden INTEGER DEFAULT 0,
-                imagen TEXT
-            );
-        '''))
-
-        conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS ordenes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                juego_id INTEGER REFERENCES juegos(id),
-                paquete TEXT,
-                monto REAL,
-                usuario_email TEXT,
-                usuario_id TEXT,
-                usuario_telefono TEXT,
-                metodo_pago TEXT,
-                referencia_pago TEXT,
-                codigo_producto TEXT,
-                estado TEXT DEFAULT 'procesando',
-                fecha DATETIME DEFAULT CURRENT_TIMESTAMP
-            );
-        '''))
-
-        # SQLite migrations are handled by including all columns in CREATE TABLE statements above
-
-        # Crear tabla de valoraciones
-        conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS valoraciones (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                juego_id INTEGER REFERENCES juegos(id) ON DELETE CASCADE,
-                usuario_email TEXT NOT NULL,
-                calificacion INTEGER CHECK (calificacion >= 1 AND calificacion <= 5),
-                comentario TEXT,
-                fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(juego_id, usuario_email)
-            );
-        '''))
-
-        conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS imagenes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tipo TEXT,
-                ruta TEXT
-            );
-        '''))
-
-        conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS configuracion (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                campo TEXT UNIQUE,
-                valor TEXT
-            );
-        '''))
-
-        # Crear tabla de usuarios
-        conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS usuarios (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nombre TEXT NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                telefono TEXT,
-                password_hash TEXT NOT NULL,
-                es_admin INTEGER DEFAULT 0,
-                fecha_registro DATETIME DEFAULT CURRENT_TIMESTAMP
-            );
-        '''))
-
-        # Migraciones SQLite: aÃ±adir columnas faltantes si la DB ya existÃ­a sin estas columnas
-        _ensure_sqlite_column(conn, 'juegos', 'categoria', "categoria TEXT DEFAULT 'juegos'")
-        _ensure_sqlite_column(conn, 'juegos', 'orden', 'orden INTEGER DEFAULT 0')
-        _ensure_sqlite_column(conn, 'juegos', 'etiquetas', 'etiquetas TEXT')
-
-        _ensure_sqlite_column(conn, 'paquetes', 'orden', 'orden INTEGER DEFAULT 0')
-        _ensure_sqlite_column(conn, 'paquetes', 'imagen', 'imagen TEXT')
-
-        _ensure_sqlite_column(conn, 'ordenes', 'usuario_id', 'usuario_id TEXT')
-        _ensure_sqlite_column(conn, 'ordenes', 'usuario_telefono', 'usuario_telefono TEXT')
-        _ensure_sqlite_column(conn, 'ordenes', 'codigo_producto', 'codigo_producto TEXT')
-
-        _ensure_sqlite_column(conn, 'usuarios', 'telefono', 'telefono TEXT')
-        _ensure_sqlite_column(conn, 'usuarios', 'es_admin', 'es_admin INTEGER DEFAULT 0')
-
-        # Normalizar rutas de imÃ¡genes guardadas antiguas
-        try:
-            # Quitar prefijo '/static/' si existe (convierte '/static/images/x.jpg' -> 'images/x.jpg')
-            conn.execute(text("""
-                UPDATE imagenes
-                SET ruta = substr(ruta, length('/static/') + 1)
-                WHERE ruta LIKE '/static/%'
-            """))
-            # Normalizar separadores por si existen backslashes
-            conn.execute(text("""
-                UPDATE imagenes
-                SET ruta = REPLACE(ruta, '\\', '/')
-                WHERE instr(ruta, '\\') > 0
-            """))
-            print("ðŸ§¹ MigraciÃ³n: rutas de imÃ¡genes normalizadas")
-        except Exception as e:
-            print(f"âš ï¸ No se pudo normalizar rutas de imÃ¡genes: {e}")
-
-        # Verificar si ya hay productos
-        result = conn.execute(text('SELECT COUNT(*) FROM juegos'))
-        product_count = result.fetchone()[0]
-
-        # Insertar productos de ejemplo si no existen
-        if product_count == 0:
-            # Free Fire
-            conn.execute(text('''
-                INSERT INTO juegos (nombre, descripcion, imagen, categoria) 
-                VALUES (:nombre, :descripcion, :imagen, :categoria)
-            '''), {
-                'nombre': 'Free Fire',
-                'descripcion': 'Juego de batalla real con acciÃ³n intensa y grÃ¡ficos increÃ­bles',
-                'imagen': '/static/images/20250701_212818_free_fire.webp',
-                'categoria': 'juegos'
-            })
-            result = conn.execute(text('SELECT last_insert_rowid()'))
-            ff_id = result.scalar()
-
-            # Paquetes de Free Fire
-            ff_packages = [
-                ('100 Diamantes', 2.99, 1),
-                ('310 Diamantes', 9.99, 2),
-                ('520 Diamantes', 14.99, 3),
-                ('1080 Diamantes', 29.99, 4),
-                ('2200 Diamantes', 59.99, 5)
-            ]
-
-            for nombre, precio, orden in ff_packages:
-                conn.execute(text('''
-                    INSERT INTO paquetes (juego_id, nombre, precio, orden) 
-                    VALUES (:juego_id, :nombre, :precio, :orden)
-                '''), {'juego_id': ff_id, 'nombre': nombre, 'precio': precio, 'orden': orden})
-
-            # PUBG Mobile
-            conn.execute(text('''
-                INSERT INTO juegos (nombre, descripcion, imagen, categoria) 
-                VALUES (:nombre, :descripcion, :imagen, :categoria)
-            '''), {
-                'nombre': 'PUBG Mobile',
-                'descripcion': 'Battle royale de Ãºltima generaciÃ³n con mecÃ¡nicas realistas',
-                'imagen': '/static/images/default-product.jpg',
-                'categoria': 'juegos'
-            })
-            result = conn.execute(text('SELECT last_insert_rowid()'))
-            pubg_id = result.scalar()
-
-            # Paquetes de PUBG
-            pubg_packages = [
-                ('60 UC', 0.99, 1),
-                ('325 UC', 4.99, 2),
-                ('660 UC', 9.99, 3),
-                ('1800 UC', 24.99, 4),
-                ('3850 UC', 49.99, 5)
-            ]
-
-            for nombre, precio, orden in pubg_packages:
-                conn.execute(text('''
-                    INSERT INTO paquetes (juego_id, nombre, precio, orden) 
-                    VALUES (:juego_id, :nombre, :precio, :orden)
-                '''), {'juego_id': pubg_id, 'nombre': nombre, 'precio': precio, 'orden': orden})
-
-            # Call of Duty Mobile
-            conn.execute(text('''
-                INSERT INTO juegos (nombre, descripcion, imagen, categoria) 
-                VALUES (:nombre, :descripcion, :imagen, :categoria)
-            '''), {
-                'nombre': 'Call of Duty Mobile',
-                'descripcion': 'FPS de acciÃ³n con multijugador competitivo y battle royale',
-                'imagen': '/static/images/default-product.jpg',
-                'categoria': 'juegos'
-            })
-            result = conn.execute(text('SELECT last_insert_rowid()'))
-            cod_id = result.scalar()
-
-            # Paquetes de COD
-            cod_packages = [
-                ('80 CP', 0.99, 1),
-                ('400 CP', 4.99, 2),
-                ('800 CP', 9.99, 3),
-                ('2000 CP', 19.99, 4),
-                ('5000 CP', 49.99, 5)
-            ]
-
-            for nombre, precio, orden in cod_packages:
-                conn.execute(text('''
-                    INSERT INTO paquetes (juego_id, nombre, precio, orden) 
-                    VALUES (:juego_id, :nombre, :precio, :orden)
-                '''), {'juego_id': cod_id, 'nombre': nombre, 'precio': precio, 'orden': orden})
-
-        # Insertar configuraciÃ³n bÃ¡sica si no existe
-        result = conn.execute(text('SELECT COUNT(*) FROM configuracion'))
-        config_count = result.fetchone()[0]
-
-        if config_count == 0:
-            configs = [
-                ('tasa_usd_ves', '36.50'),
-                ('pago_movil', 'Banco: Banesco\nTelefono: 0412-1234567\nCÃ©dula: V-12345678\nNombre: Store Admin'),
-                ('binance', 'Email: admin@inefablestore.com\nID Binance: 123456789'),
-                ('carousel1', 'https://via.placeholder.com/800x300/007bff/ffffff?text=ðŸŽ®+Ofertas+Especiales+Free+Fire'),
-                ('carousel2', 'https://via.placeholder.com/800x300/28a745/ffffff?text=ðŸ”¥+Mejores+Precios+PUBG'),
-                ('carousel3', 'https://via.placeholder.com/800x300/dc3545/ffffff?text=âš¡+Entrega+Inmediata+COD')
-            ]
-
-            for campo, valor in configs:
-                conn.execute(text('''
-                    INSERT INTO configuracion (campo, valor) 
-                    VALUES (:campo, :valor)
-                '''), {'campo': campo, 'valor': valor})
-
-        # Crear usuario administrador por defecto si no existe
-        admin_email = os.environ.get('ADMIN_EMAIL')
-        admin_password = os.environ.get('ADMIN_PASSWORD')
-
-        if admin_email and admin_password:
-            # Verificar si ya existe un admin con ese email
-            result = conn.execute(text('SELECT id FROM usuarios WHERE email = :email'), 
-                                 {'email': admin_email})
-
-            if not result.fetchone():
-                # Crear usuario administrador
-                password_hash = generate_password_hash(admin_password)
-                conn.execute(text('''
-                    INSERT INTO usuarios (nombre, email, password_hash, es_admin)
-                    VALUES (:nombre, :email, :password_hash, 1)
-                '''), {
-                    'nombre': 'Administrador',
-                    'email': admin_email,
-                    'password_hash': password_hash
-                })
-                print(f"âœ… Usuario administrador creado: {admin_email}")
-            else:
-                # Actualizar usuario existente para que sea admin
-                password_hash = generate_password_hash(admin_password)
-                conn.execute(text('''
-                    UPDATE usuarios SET es_admin = 1, password_hash = :password_hash WHERE email = :email
-                '''), {'email': admin_email, 'password_hash': password_hash})
-                print(f"âœ… Usuario actualizado como administrador: {admin_email}")
-
-        conn.commit()
-
-    except Exception as e:
-        print(f"Error en init_db: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+    """Inicializa la base de datos aplicando las migraciones pendientes y sincronizando el admin"""
+    migrations.migrate(os.environ.get('DATABASE_PATH', 'inefablestore.db'))
 
 # =====================
 # Email / Notificaciones
@@ -849,8 +577,10 @@ def _smtp_config():
     use_ssl = os.getenv('SMTP_USE_SSL', '0') not in ('0', 'false', 'False')
     return host, port, user, password, sender, use_tls, use_ssl
 
-def _send_email_safe(to_email: str, subject: str, html_body: str, text_body: str = None):
+def _construir_correo(mensaje):
+    """EmailMessage para un mensaje de la outbox (destinatario, asunto, cuerpo_texto/cuerpo_html). Lanza excepción si falta configuración."""
     host, port, user, password, sender, use_tls, use_ssl = _smtp_config()
+    to_email = mensaje['destinatario']
     if not (host and port and sender and user and password and to_email):
         missing = []
         if not host: missing.append('SMTP_HOST')
@@ -859,164 +589,76 @@ def _send_email_safe(to_email: str, subject: str, html_body: str, text_body: str
         if not sender: missing.append('SMTP_FROM (o SMTP_USER)')
         if not password: missing.append('SMTP_PASSWORD')
         if not to_email: missing.append('DESTINATARIO (to_email)')
-        print('âœ‰ï¸ Aviso: SMTP no configurado completamente. Saltando envÃ­o de correo.')
-        print(f"Faltan: {', '.join(missing) if missing else 'campos desconocidos'}")
-        print(f'Subject: {subject} | To: {to_email}')
-        return False
-
-    try:
-        msg = EmailMessage()
-        msg['Subject'] = subject
-        msg['From'] = sender
-        msg['To'] = to_email
-        if text_body:
-            msg.set_content(text_body)
-        else:
-            plain = (html_body or '').replace('<br/>', '\n').replace('<br>', '\n')
-            for tag in ['<p>', '</p>', '<strong>', '</strong>', '<b>', '</b>', '<h1>', '</h1>', '<h2>', '</h2>', '<h3>', '</h3>', '<ul>', '</ul>', '<li>', '</li>']:
-                plain = plain.replace(tag, '')
-            msg.set_content(plain)
-        # Elegir modo de conexiÃ³n: SSL puro (465) o STARTTLS (587) o plano
-        if use_ssl or port == 465:
-            with smtplib.SMTP_SSL(host, port, timeout=30) as server:
-                server.login(user, password)
-                server.send_message(msg)
-        else:
-            with smtplib.SMTP(host, port, timeout=30) as server:
-                if use_tls:
-                    server.starttls()
-                server.login(user, password)
-                server.send_message(msg)
-        print(f'âœ… Correo enviado a {to_email}: {subject}')
-        return True
-    except Exception as e:
-        print(f'âŒ Error enviando correo a {to_email}: {e}')
-        return False
-
-def enviar_correo_recarga_completada(orden: dict):
-    # Asunto con marca Tindo Store (sin acentos para evitar problemas de codificacion)
-    asunto = f"Tu recarga esta lista - Orden #{orden.get('id','')} - Tindo Store"
-    to = orden.get('usuario_email')
-    # Formateo de fecha en espaÃ±ol sin depender del locale del sistema
-    meses_es = [
-        "enero", "febrero", "marzo", "abril", "mayo", "junio",
-        "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre"
-    ]
-    ahora = datetime.now()
-    fecha_es = f"{ahora.day} de {meses_es[ahora.month - 1]} de {ahora.year}"
-    # Datos dinÃ¡micos
-    juego = orden.get('juego_nombre', 'N/A')
-    usuario_id = orden.get('usuario_id', 'No especificado')
-    paquete = orden.get('paquete', 'N/A')
-    monto = orden.get('monto', '0.00')
-    # Cuerpo de texto plano sin emojis ni acentos
-    text = (
-        "Hola,\n\n"
-        "Gracias por tu compra. Nos complace informarte que tu pedido ha sido procesado con exito.\n\n"
-        "Detalles de la orden:\n"
-        f"- Fecha: {fecha_es}\n"
-        f"- Producto: {juego}\n"
-        f"- ID de jugador: {usuario_id}\n"
-        f"- Paquete adquirido: {paquete}\n"
-        f"- Costo: ${monto} USD\n\n"
-        "Si necesitas asistencia o tienes alguna consulta, estamos aqui para ayudarte.\n\n"
-        "Atentamente,\nEquipo de Tindo Store"
-    )
-    _send_email_safe(to, asunto, None, text)
-
-def enviar_correo_gift_card_completada(orden: dict):
-    asunto = f"Tu Gift Card de {orden.get('juego_nombre','Gift Card')} fue entregada"
-    to = orden.get('usuario_email')
-    codigo = orden.get('codigo_producto')
-    text = (
-        "Tu Gift Card esta lista.\n\n"
-        f"Producto: {orden.get('juego_nombre','Gift Card')}\n"
-        f"Codigo: {codigo}\n\n"
-        "Gracias por comprar en Tindo Store."
-    )
-    _send_email_safe(to, asunto, None, text)
-
-def enviar_correo_orden_rechazada(orden: dict):
-    asunto = f"Tu orden fue rechazada"
-    to = orden.get('usuario_email')
-    ref = orden.get('referencia_pago')
-    text = (
-        "Tu orden fue rechazada.\n\n"
-        f"Juego: {orden.get('juego_nombre','')}\n"
-        f"Paquete: {orden.get('paquete','')}\n"
-        f"Referencia: {ref}\n\n"
-        "Si crees que es un error, contactanos respondiendo este correo."
-    )
-    _send_email_safe(to, asunto, None, text)
-
-def enviar_notificacion_orden(orden: dict):
-    """Notifica creaciÃ³n de orden:
-    - EnvÃ­a un correo de confirmaciÃ³n al comprador (usuario_email).
-    - EnvÃ­a una copia resumida al correo de la tienda (SMTP_FROM/SMTP_USER).
+        raise RuntimeError(f"SMTP no configurado completamente. Faltan: {', '.join(missing) if missing else 'campos desconocidos'}")
+
+    msg = EmailMessage()
+    msg['Subject'] = mensaje['asunto']
+    msg['From'] = sender
+    msg['To'] = to_email
+    cuerpo_html = mensaje.get('cuerpo_html')
+    msg.set_content(mensaje.get('cuerpo_texto') or notificaciones.html_a_texto(cuerpo_html or ''))
+    if cuerpo_html:
+        msg.add_alternative(cuerpo_html, subtype='html')
+    return msg
+
+# Conexiones SMTP autenticadas reutilizadas entre envíos (ver smtp_pool.py)
+pool_smtp = smtp_pool.SmtpPool(_smtp_config)
+
+def _enviar_correo_smtp(mensaje):
+    """Envía un mensaje de la outbox por el pool SMTP. Lanza excepción si falla."""
+    pool_smtp.send(_construir_correo(mensaje))
+
+def _enviar_lote_smtp(mensajes):
+    """Envía varios mensajes de la outbox por una misma conexión. Devuelve None o la excepción de cada uno."""
+    resultados = [None] * len(mensajes)
+    correos, posiciones = [], []
+    for i, mensaje in enumerate(mensajes):
+        try:
+            correos.append(_construir_correo(mensaje))
+            posiciones.append(i)
+        except Exception as e:
+            resultados[i] = e
+    if correos:
+        for i, error in zip(posiciones, pool_smtp.send_batch(correos)):
+            resultados[i] = error
+    return resultados
+
+def enviar_notificacion_orden(conn, orden: dict):
+    """Notifica la creación de una orden (encola en la outbox dentro de la transacción de conn):
+    - Confirmación al comprador (usuario_email).
+    - Copia resumida al correo de la tienda (SMTP_FROM/SMTP_USER).
     """
-    try:
-        # Correo al comprador (texto plano sin emojis)
-        asunto_user = "Hemos recibido tu orden"
-        text_user = (
-            "Gracias por tu compra. Hemos recibido tu orden y esta en proceso.\n\n"
-            f"Orden: #{orden.get('id')}\n"
-            f"Juego: {orden.get('juego_nombre','')}\n"
-            f"Paquete: {orden.get('paquete','')}\n"
-            f"Monto: {orden.get('monto')}\n"
-            f"Metodo de pago: {orden.get('metodo_pago')}\n"
-            f"Referencia: {orden.get('referencia_pago')}\n\n"
-            "Te avisaremos cuando este procesada."
-        )
-        # Enviar al comprador si tiene email vÃ¡lido
-        to_user = (orden.get('usuario_email') or '').strip()
-        if to_user:
-            _send_email_safe(to_user, asunto_user, None, text_user)
-        else:
-            print('âœ‰ï¸ Aviso: correo del comprador vacÃ­o o invÃ¡lido, se omite envÃ­o al comprador.')
-
-        # Correo a la tienda
-        host, port, user, password, sender, use_tls, use_ssl = _smtp_config()
-        admin_mail = (sender or user or '').strip()
-        if admin_mail:
-            asunto_admin = f"Nueva orden #{orden.get('id')}"
-            text_admin = (
-                "Nueva orden recibida:\n"
-                f"- Orden: #{orden.get('id')}\n"
-                f"- Cliente: {orden.get('usuario_email')}\n"
-                f"- Telefono: {orden.get('usuario_telefono') or ''}\n"
-                f"- Juego: {orden.get('juego_nombre','')}\n"
-                f"- Paquete: {orden.get('paquete','')}\n"
-                f"- Monto: {orden.get('monto')}\n"
-                f"- Metodo de pago: {orden.get('metodo_pago')}\n"
-                f"- Referencia: {orden.get('referencia_pago')}\n"
-                f"- Fecha: {orden.get('fecha')}\n"
-            )
-            _send_email_safe(admin_mail, asunto_admin, None, text_admin)
-        else:
-            print('âœ‰ï¸ Aviso: no se encontrÃ³ SMTP_FROM ni SMTP_USER para notificar a la tienda. Se omite envÃ­o de copia a la tienda.')
-    except Exception as e:
-        print(f"âŒ Error en enviar_notificacion_orden: {e}")
+    to_user = (orden.get('usuario_email') or '').strip()
+    if to_user:
+        notificaciones.notificar(conn, 'orden_recibida', orden, to_user)
+    else:
+        log_correo.warning("Correo del comprador vacío o inválido, se omite envío al comprador")
 
-def limpiar_ordenes_antiguas(usuario_email):
-    """Mantiene solo las Ãºltimas 40 Ã³rdenes del usuario para evitar acumulaciÃ³n."""
-    try:
-        conn = get_db_connection()
-        try:
-            conn.execute(text('''
-                DELETE FROM ordenes 
-                WHERE usuario_email = :email 
-                AND id NOT IN (
-                    SELECT id FROM ordenes 
-                    WHERE usuario_email = :email 
-                    ORDER BY fecha DESC 
-                    LIMIT 40
-                )
-            '''), {'email': usuario_email})
-            conn.commit()
-        finally:
-            conn.close()
-    except Exception as e:
-        print(f"âš ï¸ Error limpiando Ã³rdenes antiguas: {e}")
+    host, port, user, password, sender, use_tls, use_ssl = _smtp_config()
+    admin_mail = (sender or user or '').strip()
+    if admin_mail:
+        notificaciones.notificar(conn, 'orden_nueva_tienda', orden, admin_mail)
+    else:
+        log_correo.warning("No se encontró SMTP_FROM ni SMTP_USER para notificar a la tienda, se omite la copia")
+
+# Los correos se encolan en la outbox junto con el cambio de la orden; este hilo los envía
+outbox_worker = outbox.OutboxWorker(get_db_connection, _enviar_correo_smtp, enviar_lote=_enviar_lote_smtp)
+# Con `python main.py`, los procesos del pool de contraseñas (spawn/forkserver) re-importan este
+# módulo como __mp_main__: ahí no deben arrancar los hilos de fondo
+_PROCESO_APP = __name__ != '__mp_main__'
+if _PROCESO_APP and os.environ.get('OUTBOX_WORKER', '1') != '0':
+    outbox_worker.start()
+    if hasattr(os, 'register_at_fork'):
+        # gunicorn --preload: el hilo no sobrevive al fork, cada worker arranca el suyo
+        os.register_at_fork(after_in_child=outbox_worker.start)
+
+# La retención (archivo de órdenes viejas) corre en segundo plano, no en POST /orden
+retencion_worker = retencion.RetencionWorker(
+    get_db_connection, lock_path=f"{os.environ.get('DATABASE_PATH', 'inefablestore.db')}.retencion.lock")
+if _PROCESO_APP and os.environ.get('RETENCION_WORKER', '1') != '0':
+    retencion_worker.start()
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=retencion_worker.start)
 
 @app.route('/')
 def index():
@@ -1045,6 +687,69 @@ def admin():
     return render_template('admin.html', cache_bust=cache_bust)
 
 # ENDPOINT PARA CREAR Ã“RDENES DESDE EL FRONTEND
+# INSERT ... RETURNING existe desde SQLite 3.35
+SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+SQL_INSERTAR_ORDEN = '''
+    INSERT INTO ordenes (juego_id, paquete, monto, usuario_email, usuario_id, usuario_telefono, metodo_pago, referencia_pago, estado, fecha)
+    VALUES (:juego_id, :paquete, :monto, :usuario_email, :usuario_id, :usuario_telefono, :metodo_pago, :referencia_pago, 'procesando', datetime('now'))
+'''
+
+IDEMPOTENCY_KEY_MAX = 128
+
+# Orden abierta que ocupa uq_ordenes_pago para el mismo pago e ítem
+SQL_ORDEN_MISMO_PAGO = '''
+    SELECT id, usuario_email FROM ordenes
+    WHERE metodo_pago = :metodo_pago AND referencia_pago = :referencia_pago
+      AND juego_id = :juego_id AND paquete = :paquete AND usuario_id = :usuario_id
+      AND referencia_pago IS NOT NULL AND referencia_pago <> ''
+      AND estado <> 'rechazado' AND pago_duplicado = 0
+'''
+
+def _orden_por_idempotencia(conn, usuario_email, clave):
+    """Orden creada con esta Idempotency-Key dentro del TTL (None si no hay)"""
+    return conn.execute(text('''
+        SELECT orden_id FROM idempotencia
+        WHERE usuario_email = :email AND clave = :clave AND creado >= datetime('now', :ttl)
+    '''), {'email': usuario_email, 'clave': clave, 'ttl': f'-{retencion.IDEMPOTENCIA_TTL_HORAS} hours'}).scalar()
+
+def _guardar_idempotencia(conn, usuario_email, clave, orden_id):
+    """Registra la clave en la transacción de la orden. False si ya estaba vigente (carrera)."""
+    return conn.execute(text('''
+        INSERT INTO idempotencia (usuario_email, clave, orden_id) VALUES (:email, :clave, :orden_id)
+        ON CONFLICT (usuario_email, clave) DO UPDATE
+        SET orden_id = excluded.orden_id, creado = CURRENT_TIMESTAMP
+        WHERE idempotencia.creado < datetime('now', :ttl)
+    '''), {'email': usuario_email, 'clave': clave, 'orden_id': orden_id,
+          'ttl': f'-{retencion.IDEMPOTENCIA_TTL_HORAS} hours'}).rowcount > 0
+
+def _orden_repetida(orden_id):
+    """Respuesta a un envío repetido: la orden original, sin escrituras ni correos"""
+    response = jsonify({'message': 'La orden ya estaba registrada', 'id': orden_id})
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def _juego_existe(conn, juegos, juego_id):
+    """True si el juego existe. juegos es catalogo_cache.get().por_id(), resuelto antes de abrir la
+    transacción; si el juego aún no está en el snapshot se consulta con conn, sin reconstruirlo."""
+    try:
+        juego_id = int(juego_id)
+    except (TypeError, ValueError):
+        return False
+    if juego_id in juegos:
+        return True
+    return conn.execute(text('SELECT 1 FROM juegos WHERE id = :id'), {'id': juego_id}).scalar() is not None
+
+def _nombre_juego(conn, juegos, juego_id):
+    """Nombre del juego desde el snapshot del catálogo (consulta con conn solo si aún no está en él)"""
+    try:
+        producto = juegos.get(int(juego_id))
+    except (TypeError, ValueError):
+        producto = None
+    if producto is not None:
+        return producto['nombre']
+    return conn.execute(text('SELECT nombre FROM juegos WHERE id = :id'), {'id': juego_id}).scalar()
+
 @app.route('/orden', methods=['POST'])
 def create_orden():
     # Verificar si el usuario estÃ¡ logueado
@@ -1062,21 +767,33 @@ def create_orden():
     # Usar el email del usuario logueado
     usuario_email = session['user_email']
 
+    clave = request.headers.get('Idempotency-Key')
+    if clave is not None:
+        clave = clave.strip()
+        if not clave or len(clave) > IDEMPOTENCY_KEY_MAX:
+            return jsonify({'error': f'Idempotency-Key inválida (1 a {IDEMPOTENCY_KEY_MAX} caracteres)'}), 400
+    if isinstance(referencia_pago, str):
+        referencia_pago = referencia_pago.strip()
+
+    # Snapshot del catálogo antes de tomar la conexión: si hubiera que reconstruirlo usaría otra
+    # conexión del pool mientras esta tiene abierta la transacción de la orden
+    juegos = catalogo_cache.get().por_id()
     conn = get_db_connection()
 
     try:
-        # Obtener el telÃ©fono del usuario desde la base de datos
-        result_user = conn.execute(text('''
-            SELECT telefono FROM usuarios WHERE email = :email
-        '''), {'email': usuario_email})
-
-        usuario_data = result_user.fetchone()
-        usuario_telefono = usuario_data[0] if usuario_data else None
+        # Reintento con la misma clave: devolver la orden original sin escribir nada
+        if clave:
+            orden_id = _orden_por_idempotencia(conn, usuario_email, clave)
+            if orden_id is not None:
+                return _orden_repetida(orden_id)
+
+        # Validar el producto antes del INSERT: así un IntegrityError solo puede venir de uq_ordenes_pago
+        if not _juego_existe(conn, juegos, juego_id):
+            return jsonify({'error': 'Producto no encontrado'}), 404
 
-        conn.execute(text('''
-            INSERT INTO ordenes (juego_id, paquete, monto, usuario_email, usuario_id, usuario_telefono, metodo_pago, referencia_pago, estado, fecha)
-            VALUES (:juego_id, :paquete, :monto, :usuario_email, :usuario_id, :usuario_telefono, :metodo_pago, :referencia_pago, 'procesando', datetime('now'))
-        '''), {
+        # El perfil (teléfono incluido) viene de la sesión del servidor, sin consultar usuarios
+        usuario_telefono = session.get('user_telefono')
+        params = {
             'juego_id': juego_id,
             'paquete': paquete,
             'monto': monto,
@@ -1085,32 +802,44 @@ def create_orden():
             'usuario_telefono': usuario_telefono,
             'metodo_pago': metodo_pago,
             'referencia_pago': referencia_pago
-        })
-
-        # Obtener ID insertado en SQLite de forma confiable
-        result = conn.execute(text('SELECT last_insert_rowid()'))
-        orden_id = result.scalar()
-
-        # Obtener datos completos de la orden para la notificaciÃ³n
-        result = conn.execute(text('''
-            SELECT o.*, j.nombre as juego_nombre 
-            FROM ordenes o 
-            LEFT JOIN juegos j ON o.juego_id = COALESCE(j.id, j.rowid)
-            WHERE o.id = :orden_id
-        '''), {'orden_id': orden_id})
-
-        orden_completa = result.fetchone()
+        }
+        try:
+            if SQLITE_RETURNING:
+                # Una sola sentencia inserta y devuelve la fila completa (id, fecha, estado)
+                orden_completa = conn.execute(text(SQL_INSERTAR_ORDEN + ' RETURNING *'), params).fetchone()
+            else:
+                conn.execute(text(SQL_INSERTAR_ORDEN), params)
+                orden_completa = conn.execute(text('SELECT * FROM ordenes WHERE id = last_insert_rowid()')).fetchone()
+        except IntegrityError:
+            # uq_ordenes_pago: ya hay una orden abierta con esta referencia para este ítem
+            conn.rollback()
+            existente = conn.execute(text(SQL_ORDEN_MISMO_PAGO), params).fetchone()
+            if existente is None:
+                # Otra restricción (FK, NOT NULL...): no es un pago repetido
+                raise
+            if existente[1] == usuario_email:
+                return _orden_repetida(existente[0])
+            return jsonify({'error': 'Esta referencia de pago ya fue registrada en otra orden'}), 409
+
+        orden_data = dict(orden_completa._mapping)
+        orden_id = orden_data['id']
+
+        if clave and not _guardar_idempotencia(conn, usuario_email, clave, orden_id):
+            # Otra petición con la misma clave se registró primero
+            conn.rollback()
+            return _orden_repetida(_orden_por_idempotencia(conn, usuario_email, clave))
+
+        # El nombre del juego sale del snapshot del catálogo en vez de un JOIN
+        orden_data['juego_nombre'] = _nombre_juego(conn, juegos, juego_id)
+        if log_correo.isEnabledFor(logging.DEBUG):
+            log_correo.debug("Datos para correo: %s", orden_data)
+
+        # Encolar la notificación en la misma transacción que la orden
+        enviar_notificacion_orden(conn, orden_data)
         conn.commit()
 
-        # Debug: mostrar datos de la orden creada
-        print(f"ðŸ” Orden creada - ID: {orden_id}")
-        if orden_completa:
-            print(f"ðŸ” Datos orden completa: {dict(orden_completa._mapping)}")
-        else:
-            print("âš ï¸ No se pudo obtener orden_completa tras INSERT")
-
-        # Limpiar Ã³rdenes antiguas del usuario (mantener solo las Ãºltimas 40)
-        limpiar_ordenes_antiguas(usuario_email)
+        if log_ordenes.isEnabledFor(logging.DEBUG):
+            log_ordenes.debug("Orden creada #%s: %s", orden_id, orden_data)
 
     except Exception as e:
         conn.rollback()
@@ -1118,32 +847,85 @@ def create_orden():
     finally:
         conn.close()
 
-    # Enviar notificaciÃ³n por correo en un hilo separado para no bloquear la respuesta
-    if orden_completa:
-        print("ðŸ“§ Preparando envÃ­o de notificaciÃ³n por correo...")
-        orden_data = {
-            'id': orden_completa[0],
-            'juego_id': orden_completa[1],
-            'paquete': orden_completa[2],
-            'monto': orden_completa[3],
-            'usuario_email': orden_completa[4],
-            'usuario_id': orden_completa[5],
-            'usuario_telefono': orden_completa[6],
-            'metodo_pago': orden_completa[7],
-            'referencia_pago': orden_completa[8],
-            'estado': orden_completa[9],
-            'fecha': orden_completa[10],
-            'juego_nombre': orden_completa[11]
-        }
-        print(f"ðŸ“§ Datos para correo: {orden_data}")
+    # Mantener solo las últimas órdenes del usuario (en segundo plano)
+    retencion_worker.marcar(usuario_email)
+    outbox_worker.notify()
+    return jsonify({'message': 'Orden creada correctamente', 'id': orden_id})
 
-        # Enviar notificaciÃ³n en hilo separado
-        print("ðŸ“§ Iniciando hilo de envÃ­o de correo...")
-        threading.Thread(target=enviar_notificacion_orden, args=(orden_data,)).start()
-    else:
-        print("âŒ No se enviarÃ¡ correo: orden_completa es None")
+class RoleCache:
+    """Cache LRU por worker de es_admin por id de usuario, con TTL.
 
-    return jsonify({'message': 'Orden creada correctamente', 'id': orden_id})
+    Las entradas viven ROLE_CACHE_TTL_SECONDS, pero además se relee la versión compartida 'roles'
+    de cache_versiones como mucho cada CACHE_VERSION_CHECK_SECONDS (igual que CacheSnapshot): si
+    cambió (sync_admin_user o cualquier cambio de usuarios.es_admin la incrementa) se descartan
+    todas las entradas de este worker, así un admin revocado pierde el acceso en ~1 s.
+    """
+
+    def __init__(self, ttl, max_entradas):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self._entradas = OrderedDict()  # user_id -> (es_admin, vence_en)
+        self._version = None
+        self._verificado_en = 0.0
+        self._lock = threading.Lock()
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entradas.clear()
+            else:
+                self._entradas.pop(user_id, None)
+
+    def _aplicar_version(self, version, ahora):
+        # Llamar con el lock tomado
+        if version != self._version:
+            self._entradas.clear()
+            self._version = version
+        self._verificado_en = ahora
+
+    def _verificar_version(self, ahora):
+        """Relee la versión 'roles' si pasó CACHE_VERSION_CHECK_SECONDS desde la última lectura"""
+        with self._lock:
+            if ahora - self._verificado_en < CACHE_VERSION_CHECK_SECONDS:
+                return
+            # Un solo hilo relee; los demás siguen con la cache mientras tanto
+            self._verificado_en = ahora
+        conn = get_db_connection()
+        try:
+            version = conn.execute(text("SELECT version FROM cache_versiones WHERE clave = 'roles'")).scalar() or 0
+        finally:
+            conn.close()
+        with self._lock:
+            self._aplicar_version(version, ahora)
+
+    def es_admin(self, user_id):
+        ahora = time.monotonic()
+        self._verificar_version(ahora)
+        with self._lock:
+            entrada = self._entradas.get(user_id)
+            if entrada is not None and entrada[1] > ahora:
+                self._entradas.move_to_end(user_id)
+                return entrada[0]
+        conn = get_db_connection()
+        try:
+            row = conn.execute(text('''
+                SELECT (SELECT es_admin FROM usuarios WHERE id = :user_id),
+                       (SELECT version FROM cache_versiones WHERE clave = 'roles')
+            '''), {'user_id': user_id}).fetchone()
+        finally:
+            conn.close()
+        # es_admin puede ser 0/1/NULL; usuario inexistente también cuenta como no admin
+        es_admin, version = bool(row[0]), row[1] or 0
+        with self._lock:
+            self._aplicar_version(version, ahora)
+            self._entradas[user_id] = (es_admin, ahora + self.ttl)
+            self._entradas.move_to_end(user_id)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+        return es_admin
+
+role_cache = RoleCache(float(os.environ.get('ROLE_CACHE_TTL_SECONDS', '60')),
+                       int(os.environ.get('ROLE_CACHE_MAX_ENTRIES', '1024')))
 
 # Decorador para proteger endpoints de admin
 def admin_required(f):
@@ -1152,19 +934,9 @@ def admin_required(f):
         if 'user_id' not in session:
             return jsonify({'error': 'Debes iniciar sesiÃ³n'}), 401
 
-        # Verificar si el usuario es administrador
-        conn = get_db_connection()
-        try:
-            result = conn.execute(text('SELECT es_admin FROM usuarios WHERE id = :user_id'), 
-                                 {'user_id': session['user_id']})
-            usuario = result.fetchone()
-
-            # usuario[0] puede ser 0/1; convertir a bool
-            if not usuario or not bool(usuario[0]):  # es_admin es False
-                return jsonify({'error': 'Acceso denegado. No tienes permisos de administrador.'}), 403
-
-        finally:
-            conn.close()
+        # Verificar si el usuario es administrador (cacheado por worker, ver RoleCache)
+        if not role_cache.es_admin(session['user_id']):
+            return jsonify({'error': 'Acceso denegado. No tienes permisos de administrador.'}), 403
 
         return f(*args, **kwargs)
     decorated_function.__name__ = f.__name__
@@ -1202,12 +974,20 @@ def admin_test_email():
             return jsonify({'ok': False, 'error': 'No se pudo determinar un destinatario. Configure SMTP_FROM o envÃ­e {"to": "correo@destino"}.',
                             'host': host, 'port': port, 'use_tls': use_tls, 'use_ssl': use_ssl}), 400
 
-        asunto = 'Prueba SMTP tindostore'
-        html = '<h3>Correo de prueba</h3><p>Este es un correo de prueba desde el panel admin.</p>'
-        ok = _send_email_safe(destino, asunto, html, 'Correo de prueba desde admin')
+        asunto, texto, html = notificaciones.render('prueba_smtp')
+        # Envío directo (sin outbox): es un diagnóstico de la configuración SMTP
+        error = None
+        try:
+            _enviar_correo_smtp({'destinatario': destino, 'asunto': asunto, 'cuerpo_html': html,
+                                 'cuerpo_texto': texto})
+        except Exception as e:
+            error = str(e)
+            log_correo.error("Error enviando correo de prueba a %s: %s", destino, e)
+        ok = error is None
         status = 200 if ok else 500
         return jsonify({
-            'ok': bool(ok),
+            'ok': ok,
+            'error': error,
             'to': destino,
             'from': sender or user,
             'host': host,
@@ -1225,30 +1005,140 @@ def admin_test_email():
         return jsonify({'ok': False, 'error': f'Error inesperado en test-email: {str(e)}',
                         'host': host, 'port': port, 'use_tls': use_tls, 'use_ssl': use_ssl}), 500
 
+# Estado de la outbox de correos (profundidad de la cola y mensajes descartados)
+@app.route('/admin/outbox', methods=['GET'])
+@admin_required
+def get_outbox():
+    conn = get_db_connection()
+    try:
+        data = outbox.resumen(conn)
+        fallidos = conn.execute(text('''
+            SELECT id, destinatario, asunto, tipo, orden_id, intentos, ultimo_error, creado
+            FROM outbox WHERE estado = 'fallido'
+            ORDER BY id DESC LIMIT 20
+        ''')).fetchall()
+        data['fallidos'] = [dict(f._mapping) for f in fallidos]
+        return jsonify(data)
+    finally:
+        conn.close()
+
+@app.route('/admin/outbox/<int:mensaje_id>/reintentar', methods=['POST'])
+@admin_required
+def reintentar_outbox(mensaje_id):
+    """Devuelve un mensaje descartado a la cola con los intentos en cero"""
+    conn = get_db_connection()
+    try:
+        result = conn.execute(text('''
+            UPDATE outbox SET estado = 'pendiente', intentos = 0, proximo_intento = CURRENT_TIMESTAMP
+            WHERE id = :id AND estado = 'fallido'
+        '''), {'id': mensaje_id})
+        if result.rowcount == 0:
+            return jsonify({'error': 'Mensaje no encontrado o no está descartado'}), 404
+        conn.commit()
+    finally:
+        conn.close()
+    outbox_worker.notify()
+    return jsonify({'message': 'Mensaje reencolado'})
+
 # ENDPOINTS PARA Ã“RDENES
+ADMIN_ORDENES_LIMIT_DEFAULT = 50
+ADMIN_ORDENES_LIMIT_MAX = 500
+
+def _encode_cursor(fecha, orden_id):
+    """Cursor opaco de paginación por (fecha, id). fecha nunca es NULL (migración 013)"""
+    return base64.urlsafe_b64encode(f"{fecha}|{orden_id}".encode('utf-8')).decode('ascii').rstrip('=')
+
+def _decode_cursor(cursor):
+    relleno = '=' * (-len(cursor) % 4)
+    fecha, orden_id = base64.urlsafe_b64decode(cursor + relleno).decode('utf-8').rsplit('|', 1)
+    return fecha, int(orden_id)
+
+def _parse_fecha_filtro(valor):
+    return datetime.strptime(valor, '%Y-%m-%d').strftime('%Y-%m-%d')
+
 @app.route('/admin/ordenes', methods=['GET'])
 @admin_required
 def get_ordenes():
+    """Órdenes de la más reciente a la más antigua, paginadas por cursor sobre (fecha, id).
+
+    Query: limit, cursor, estado, metodo_pago, juego_id, email, desde/hasta (YYYY-MM-DD, inclusive).
+    El cuerpo sigue siendo un array; el cursor de la página siguiente va en X-Next-Cursor.
+    """
+    filtros = []
+    params = {}
+    try:
+        limit = min(max(int(request.args.get('limit', ADMIN_ORDENES_LIMIT_DEFAULT)), 1), ADMIN_ORDENES_LIMIT_MAX)
+        cursor = request.args.get('cursor')
+        if cursor:
+            params['cursor_fecha'], params['cursor_id'] = _decode_cursor(cursor)
+            filtros.append('(o.fecha, o.id) < (:cursor_fecha, :cursor_id)')
+        for campo in ('estado', 'metodo_pago'):
+            valor = (request.args.get(campo) or '').strip()
+            if valor:
+                filtros.append(f'o.{campo} = :{campo}')
+                params[campo] = valor
+        if request.args.get('juego_id'):
+            filtros.append('o.juego_id = :juego_id')
+            params['juego_id'] = int(request.args['juego_id'])
+        email = (request.args.get('email') or '').strip()
+        if email:
+            filtros.append('o.usuario_email = :email')
+            params['email'] = email
+        if request.args.get('desde'):
+            filtros.append('o.fecha >= :desde')
+            params['desde'] = _parse_fecha_filtro(request.args['desde'])
+        if request.args.get('hasta'):
+            filtros.append("o.fecha < date(:hasta, '+1 day')")
+            params['hasta'] = _parse_fecha_filtro(request.args['hasta'])
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        return jsonify({'error': 'Parámetros de paginación o filtro inválidos'}), 400
+
+    where = f"WHERE {' AND '.join(filtros)}" if filtros else ''
+    params['limit'] = limit + 1
+
     conn = get_db_connection()
     try:
-        result = conn.execute(text('''
-            SELECT o.*, j.nombre as juego_nombre, j.categoria 
-            FROM ordenes o 
-            LEFT JOIN juegos j ON o.juego_id = COALESCE(j.id, j.rowid)
-            ORDER BY o.fecha DESC
-        '''))
-        ordenes = result.fetchall()
+        result = conn.execute(text(f'''
+            SELECT o.*, j.nombre as juego_nombre, j.categoria
+            FROM ordenes o
+            LEFT JOIN juegos j ON o.juego_id = j.id
+            {where}
+            ORDER BY o.fecha DESC, o.id DESC
+            LIMIT :limit
+        '''), params)
+        ordenes = [dict(row._mapping) for row in result]
+    finally:
+        conn.close()
 
-        # Convertir a lista de diccionarios
-        ordenes_dict = []
-        for orden in ordenes:
-            orden_dict = dict(orden._mapping)
-            ordenes_dict.append(orden_dict)
+    response = jsonify(ordenes[:limit])
+    if len(ordenes) > limit:
+        ultima = ordenes[limit - 1]
+        response.headers['X-Next-Cursor'] = _encode_cursor(ultima['fecha'], ultima['id'])
+    return response
 
-        return jsonify(ordenes_dict)
+@app.route('/admin/ordenes/total', methods=['GET'])
+@admin_required
+def get_ordenes_total():
+    """Total de órdenes y desglose por estado, leídos de los contadores mantenidos por triggers"""
+    conn = get_db_connection()
+    try:
+        filas = conn.execute(text('SELECT clave, total FROM ordenes_contadores')).fetchall()
     finally:
         conn.close()
 
+    total = 0
+    por_estado = {}
+    for clave, valor in filas:
+        if clave == 'total':
+            total = valor
+        elif clave.startswith('estado:') and valor:
+            por_estado[clave[len('estado:'):]] = valor
+
+    estado = (request.args.get('estado') or '').strip()
+    if estado:
+        return jsonify({'total': por_estado.get(estado, 0), 'estado': estado})
+    return jsonify({'total': total, 'por_estado': por_estado})
+
 @app.route('/admin/orden/<int:orden_id>', methods=['PATCH'])
 @admin_required
 def update_orden(orden_id):
@@ -1263,7 +1153,7 @@ def update_orden(orden_id):
         result = conn.execute(text('''
             SELECT o.*, j.nombre as juego_nombre, j.categoria 
             FROM ordenes o 
-            LEFT JOIN juegos j ON o.juego_id = COALESCE(j.id, j.rowid) 
+            LEFT JOIN juegos j ON o.juego_id = j.id 
             WHERE o.id = :orden_id
         '''), {'orden_id': orden_id})
         orden_info = result.fetchone()
@@ -1281,27 +1171,30 @@ def update_orden(orden_id):
             conn.execute(text('UPDATE ordenes SET estado = :estado WHERE id = :orden_id'), 
                         {'estado': nuevo_estado, 'orden_id': orden_id})
 
-        conn.commit()
-
         # Convertir orden_info a diccionario para envÃ­o de correo
         orden_dict = dict(orden_info._mapping)
         if codigo_producto:
             orden_dict['codigo_producto'] = codigo_producto
 
-        # Si el nuevo estado es "procesado", enviar correo de confirmaciÃ³n al usuario
+        # Si el nuevo estado es "procesado", encolar correo de confirmaciÃ³n al usuario
         if nuevo_estado == 'procesado':
             # Verificar si es Gift Card para enviar correo especÃ­fico
             es_gift_card = (orden_dict.get('categoria') == 'gift-cards' or 
-                           'gift' in (orden_dict.get('juego_nombre', '')).lower() or
-                           'steam' in (orden_dict.get('juego_nombre', '')).lower())
+                           'gift' in (orden_dict.get('juego_nombre') or '').lower() or
+                           'steam' in (orden_dict.get('juego_nombre') or '').lower())
 
-            if es_gift_card and codigo_producto:
-                threading.Thread(target=enviar_correo_gift_card_completada, args=(orden_dict,)).start()
-            else:
-                threading.Thread(target=enviar_correo_recarga_completada, args=(orden_dict,)).start()
+            tipo = 'gift_card_completada' if es_gift_card and codigo_producto else 'recarga_completada'
+            notificaciones.notificar(conn, tipo, orden_dict, orden_dict.get('usuario_email'))
+
+        conn.commit()
+        outbox_worker.notify()
 
         return jsonify({'message': 'Estado actualizado correctamente'})
 
+    except IntegrityError:
+        # Reabrir una orden rechazada cuya referencia ya usa otra orden abierta (uq_ordenes_pago)
+        conn.rollback()
+        return jsonify({'error': 'Otra orden abierta ya usa esta referencia de pago'}), 409
     except Exception as e:
         conn.rollback()
         return jsonify({'error': f'Error al actualizar orden: {str(e)}'}), 500
@@ -1318,7 +1211,7 @@ def rechazar_orden(orden_id):
         result = conn.execute(text('''
             SELECT o.*, j.nombre as juego_nombre, j.categoria 
             FROM ordenes o 
-            LEFT JOIN juegos j ON o.juego_id = COALESCE(j.id, j.rowid) 
+            LEFT JOIN juegos j ON o.juego_id = j.id 
             WHERE o.id = :orden_id
         '''), {'orden_id': orden_id})
         orden_info = result.fetchone()
@@ -1329,14 +1222,15 @@ def rechazar_orden(orden_id):
         # Actualizar estado a rechazado
         conn.execute(text('UPDATE ordenes SET estado = :estado WHERE id = :orden_id'), 
                     {'estado': 'rechazado', 'orden_id': orden_id})
-        
-        conn.commit()
 
         # Convertir orden_info a diccionario para envÃ­o de correo
         orden_dict = dict(orden_info._mapping)
 
-        # Enviar correo de notificaciÃ³n de rechazo al usuario
-        threading.Thread(target=enviar_correo_orden_rechazada, args=(orden_dict,)).start()
+        # Encolar correo de notificaciÃ³n de rechazo al usuario junto con el cambio de estado
+        notificaciones.notificar(conn, 'orden_rechazada', orden_dict, orden_dict.get('usuario_email'))
+
+        conn.commit()
+        outbox_worker.notify()
 
         return jsonify({'message': 'Orden rechazada y correo de notificaciÃ³n enviado al usuario'})
 
@@ -1350,31 +1244,56 @@ def rechazar_orden(orden_id):
 @app.route('/admin/productos', methods=['GET'])
 @admin_required
 def get_productos():
+    # Una sola consulta: productos con sus paquetes, agrupados en memoria
+    filtros = []
+    params = {}
+    categoria = (request.args.get('categoria') or '').strip()
+    if categoria:
+        filtros.append('j.categoria = :categoria')
+        params['categoria'] = categoria
+    q = (request.args.get('q') or '').strip()
+    if q:
+        filtros.append("(j.nombre LIKE :q ESCAPE '\\' OR j.etiquetas LIKE :q ESCAPE '\\')")
+        params['q'] = '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    where = f"WHERE {' AND '.join(filtros)}" if filtros else ''
+
     conn = get_db_connection()
     try:
-        # In SQLite, ensure we can fallback to rowid if an older table has a NULL id due to legacy
-        result = conn.execute(text('SELECT rowid as _rowid, * FROM juegos ORDER BY orden ASC, id ASC'))
-        productos = result.fetchall()
-
-        # Convertir a lista de diccionarios y obtener paquetes para cada producto
-        productos_list = []
-        for producto in productos:
-            producto_dict = dict(producto._mapping)
-            # Asegurar id vÃ¡lido (fallback a rowid si fuese None por alguna DB antigua)
-            if producto_dict.get('id') is None and producto_dict.get('_rowid') is not None:
-                producto_dict['id'] = producto_dict['_rowid']
-            # Remover helper interno
-            producto_dict.pop('_rowid', None)
-
-            # Obtener paquetes para este producto
-            paquetes_result = conn.execute(text('SELECT * FROM paquetes WHERE juego_id = :juego_id ORDER BY orden ASC, id ASC'), 
-                                         {'juego_id': producto_dict['id']})
-            paquetes = paquetes_result.fetchall()
-            producto_dict['paquetes'] = [dict(paq._mapping) for paq in paquetes]
-
-            productos_list.append(producto_dict)
-
-        return jsonify(productos_list)
+        result = conn.execute(text(f'''
+            SELECT
+                j.id, j.nombre, j.descripcion, j.imagen, j.categoria, j.orden, j.etiquetas,
+                p.id as paquete_id, p.nombre as paquete_nombre, p.precio, p.orden as paquete_orden, p.imagen as paquete_imagen
+            FROM juegos j
+            LEFT JOIN paquetes p ON p.juego_id = j.id
+            {where}
+            ORDER BY j.orden ASC, j.id ASC, p.orden ASC, p.id ASC
+        '''), params)
+
+        productos_dict = {}
+        for row in result:
+            producto = productos_dict.get(row.id)
+            if producto is None:
+                producto = productos_dict[row.id] = {
+                    'id': row.id,
+                    'nombre': row.nombre,
+                    'descripcion': row.descripcion,
+                    'imagen': row.imagen,
+                    'categoria': row.categoria,
+                    'orden': row.orden,
+                    'etiquetas': row.etiquetas,
+                    'paquetes': []
+                }
+            if row.paquete_id is not None:
+                producto['paquetes'].append({
+                    'id': row.paquete_id,
+                    'juego_id': row.id,
+                    'nombre': row.paquete_nombre,
+                    'precio': row.precio,
+                    'orden': row.paquete_orden,
+                    'imagen': row.paquete_imagen
+                })
+
+        return jsonify(list(productos_dict.values()))
     finally:
         conn.close()
 
@@ -1391,8 +1310,7 @@ def create_producto():
     paquetes = data.get('paquetes', [])
 
     # Debug: Imprimir los datos recibidos
-    print(f"ðŸ” Creando producto con categorÃ­a: {categoria}")
-    print(f"ðŸ” Datos completos: {data}")
+    log_catalogo.debug("Creando producto con categoría: %s", categoria)
 
     conn = get_db_connection()
     try:
@@ -1413,7 +1331,7 @@ def create_producto():
         result = conn.execute(text('SELECT last_insert_rowid()'))
         producto_id = result.scalar()
 
-        print(f"âœ… Producto creado con ID: {producto_id}, categorÃ­a: {categoria}")
+        log_catalogo.info("Producto creado con ID: %s, categoría: %s", producto_id, categoria)
 
         # Insertar paquetes
         for index, paquete in enumerate(paquetes):
@@ -1428,10 +1346,12 @@ def create_producto():
                 'imagen': paquete.get('imagen')
             })
 
+        bump_cache_version(conn, 'catalogo')
         conn.commit()
+        catalogo_cache.invalidate()
         return jsonify({'message': 'Producto creado correctamente', 'id': producto_id})
     except Exception as e:
-        print(f"âŒ Error al crear producto: {str(e)}")
+        log_catalogo.exception("Error al crear producto: %s", e)
         conn.rollback()
         return jsonify({'error': f'Error al crear producto: {str(e)}'}), 500
     finally:
@@ -1451,43 +1371,25 @@ def update_producto(producto_id):
 
     conn = get_db_connection()
     try:
-        # Resolver clave del producto (id o rowid para legados)
-        res = conn.execute(text('SELECT rowid as _rowid, id FROM juegos WHERE id = :pid OR rowid = :pid'), {'pid': producto_id}).fetchone()
+        res = conn.execute(text('SELECT id FROM juegos WHERE id = :pid'), {'pid': producto_id}).fetchone()
         if not res:
             return jsonify({'error': 'Producto no encontrado'}), 404
-        rowid = res._mapping.get('_rowid')
-        real_id = res._mapping.get('id') if res._mapping.get('id') is not None else rowid
 
-        # Actualizar producto por rowid si id es NULL
-        if res._mapping.get('id') is None:
-            conn.execute(text('''
-                UPDATE juegos SET nombre = :nombre, descripcion = :descripcion, imagen = :imagen, categoria = :categoria, orden = :orden, etiquetas = :etiquetas 
-                WHERE rowid = :rid
-            '''), {
-                'nombre': nombre,
-                'descripcion': descripcion,
-                'imagen': imagen,
-                'categoria': categoria,
-                'orden': orden,
-                'etiquetas': etiquetas,
-                'rid': rowid
-            })
-        else:
-            conn.execute(text('''
-                UPDATE juegos SET nombre = :nombre, descripcion = :descripcion, imagen = :imagen, categoria = :categoria, orden = :orden, etiquetas = :etiquetas 
-                WHERE id = :pid
-            '''), {
-                'nombre': nombre,
-                'descripcion': descripcion,
-                'imagen': imagen,
-                'categoria': categoria,
-                'orden': orden,
-                'etiquetas': etiquetas,
-                'pid': producto_id
-            })
+        conn.execute(text('''
+            UPDATE juegos SET nombre = :nombre, descripcion = :descripcion, imagen = :imagen, categoria = :categoria, orden = :orden, etiquetas = :etiquetas 
+            WHERE id = :pid
+        '''), {
+            'nombre': nombre,
+            'descripcion': descripcion,
+            'imagen': imagen,
+            'categoria': categoria,
+            'orden': orden,
+            'etiquetas': etiquetas,
+            'pid': producto_id
+        })
 
-        # Eliminar paquetes existentes por juego_id resuelto y crear nuevos
-        conn.execute(text('DELETE FROM paquetes WHERE juego_id = :jid'), {'jid': real_id})
+        # Eliminar paquetes existentes y crear nuevos
+        conn.execute(text('DELETE FROM paquetes WHERE juego_id = :jid'), {'jid': producto_id})
 
         # Insertar nuevos paquetes
         for paquete in paquetes:
@@ -1495,14 +1397,16 @@ def update_producto(producto_id):
                 INSERT INTO paquetes (juego_id, nombre, precio, orden, imagen) 
                 VALUES (:juego_id, :nombre, :precio, :orden, :imagen)
             '''), {
-                'juego_id': real_id,
+                'juego_id': producto_id,
                 'nombre': paquete['nombre'],
                 'precio': paquete['precio'],
                 'orden': paquete.get('orden', 1),
                 'imagen': paquete.get('imagen')
             })
 
+        bump_cache_version(conn, 'catalogo')
         conn.commit()
+        catalogo_cache.invalidate()
         return jsonify({'message': 'Producto actualizado correctamente'})
     except Exception as e:
         conn.rollback()
@@ -1515,24 +1419,21 @@ def update_producto(producto_id):
 def delete_producto(producto_id):
     conn = get_db_connection()
     try:
-        # Resolver la clave del producto (id o rowid)
-        res = conn.execute(text('SELECT rowid as _rowid, id FROM juegos WHERE id = :pid OR rowid = :pid'), {'pid': producto_id}).fetchone()
+        res = conn.execute(text('SELECT id FROM juegos WHERE id = :pid'), {'pid': producto_id}).fetchone()
         if not res:
             return jsonify({'error': 'Producto no encontrado'}), 404
-        rowid = res._mapping.get('_rowid')
-        real_id = res._mapping.get('id') if res._mapping.get('id') is not None else rowid
 
-        # Eliminar Ã³rdenes y paquetes asociados usando la clave resuelta
-        conn.execute(text('DELETE FROM ordenes WHERE juego_id = :jid'), {'jid': real_id})
-        conn.execute(text('DELETE FROM paquetes WHERE juego_id = :jid'), {'jid': real_id})
-
-        # Eliminar producto por id o rowid segÃºn corresponda
-        if res._mapping.get('id') is None:
-            conn.execute(text('DELETE FROM juegos WHERE rowid = :rid'), {'rid': rowid})
-        else:
-            conn.execute(text('DELETE FROM juegos WHERE id = :pid'), {'pid': producto_id})
+        # Eliminar Ã³rdenes y paquetes asociados
+        conn.execute(text('DELETE FROM ordenes WHERE juego_id = :jid'), {'jid': producto_id})
+        conn.execute(text('DELETE FROM paquetes WHERE juego_id = :jid'), {'jid': producto_id})
+        # Valoraciones y su resumen antes que el juego, sin depender del orden del ON DELETE CASCADE
+        conn.execute(text('DELETE FROM valoraciones WHERE juego_id = :jid'), {'jid': producto_id})
+        conn.execute(text('DELETE FROM valoraciones_resumen WHERE juego_id = :jid'), {'jid': producto_id})
+        conn.execute(text('DELETE FROM juegos WHERE id = :pid'), {'pid': producto_id})
 
+        bump_cache_version(conn, 'catalogo')
         conn.commit()
+        catalogo_cache.invalidate()
         return jsonify({'message': 'Producto eliminado correctamente'})
 
     except Exception as e:
@@ -1542,102 +1443,120 @@ def delete_producto(producto_id):
         conn.close()
 
 # ENDPOINT PÃšBLICO PARA PRODUCTOS (FRONTEND DE USUARIOS)
-@app.route('/productos', methods=['GET'])
-def get_productos_publico():
-    conn = get_db_connection()
-    try:
-        # OptimizaciÃ³n: Una sola consulta con JOIN para obtener productos, paquetes y valoraciones
-        result = conn.execute(text('''
-            SELECT 
-                j.rowid as _rowid,
-                j.id, j.nombre, j.descripcion, j.imagen, j.categoria, j.orden, j.etiquetas,
-                p.id as paquete_id, p.nombre as paquete_nombre, p.precio, p.orden as paquete_orden, p.imagen as paquete_imagen,
-                v.promedio_valoracion, v.total_valoraciones
-            FROM juegos j
-            LEFT JOIN paquetes p ON (p.juego_id = COALESCE(j.id, j.rowid))
-            LEFT JOIN (
-                SELECT 
-                    juego_id,
-                    ROUND(AVG(calificacion), 1) as promedio_valoracion,
-                    COUNT(*) as total_valoraciones
-                FROM valoraciones 
-                GROUP BY juego_id
-            ) v ON COALESCE(j.id, j.rowid) = v.juego_id
-            ORDER BY j.orden ASC, COALESCE(j.id, j.rowid) ASC, p.orden ASC, p.precio ASC
-        '''))
-
-        rows = result.fetchall()
-
-        # Agrupar productos con sus paquetes
-        productos_dict = {}
-        for row in rows:
-            row_dict = dict(row._mapping)
-            # Fallback a rowid si id es NULL (bases antiguas)
-            producto_id = row_dict['id'] if row_dict.get('id') is not None else row_dict.get('_rowid')
-
-            if producto_id not in productos_dict:
-                # Asegurar que la categorÃ­a no sea None
-                categoria = row_dict.get('categoria') or 'juegos'
-
-                productos_dict[producto_id] = {
-                    'id': producto_id,
-                    'nombre': row_dict['nombre'],
-                    'descripcion': row_dict['descripcion'],
-                    'imagen': row_dict['imagen'],
-                    'categoria': categoria,
-                    'orden': row_dict['orden'],
-                    'etiquetas': row_dict['etiquetas'],
-                    'promedio_valoracion': row_dict['promedio_valoracion'],
-                    'total_valoraciones': row_dict['total_valoraciones'],
-                    'paquetes': []
-                }
+def _cargar_catalogo_publico(conn):
+    """Productos con sus paquetes y valoraciones, tal como los sirve /productos"""
+    # OptimizaciÃ³n: Una sola consulta con JOIN para obtener productos, paquetes y valoraciones
+    result = conn.execute(text('''
+        SELECT 
+            j.id, j.nombre, j.descripcion, j.imagen, j.categoria, j.orden, j.etiquetas,
+            p.id as paquete_id, p.nombre as paquete_nombre, p.precio, p.orden as paquete_orden, p.imagen as paquete_imagen,
+            ROUND(CAST(v.suma AS REAL) / NULLIF(v.total, 0), 1) as promedio_valoracion,
+            NULLIF(v.total, 0) as total_valoraciones
+        FROM juegos j
+        LEFT JOIN paquetes p ON p.juego_id = j.id
+        -- Agregados mantenidos por triggers (migración 010), no se recorre valoraciones
+        LEFT JOIN valoraciones_resumen v ON v.juego_id = j.id
+        ORDER BY j.orden ASC, j.id ASC, p.orden ASC, p.precio ASC
+    '''))
+
+    rows = result.fetchall()
+
+    # Agrupar productos con sus paquetes
+    productos_dict = {}
+    for row in rows:
+        row_dict = dict(row._mapping)
+        producto_id = row_dict['id']
+
+        if producto_id not in productos_dict:
+            # Asegurar que la categorÃ­a no sea None
+            categoria = row_dict.get('categoria') or 'juegos'
+
+            productos_dict[producto_id] = {
+                'id': producto_id,
+                'nombre': row_dict['nombre'],
+                'descripcion': row_dict['descripcion'],
+                'imagen': row_dict['imagen'],
+                'categoria': categoria,
+                'orden': row_dict['orden'],
+                'etiquetas': row_dict['etiquetas'],
+                'promedio_valoracion': row_dict['promedio_valoracion'],
+                'total_valoraciones': row_dict['total_valoraciones'],
+                'paquetes': []
+            }
 
-                # Debug: imprimir categorÃ­a de cada producto
-                print(f"ðŸ“¦ Producto: {row_dict['nombre']} | CategorÃ­a: {categoria}")
-
-            # Agregar paquete si existe
-            if row_dict['paquete_id'] is not None:
-                productos_dict[producto_id]['paquetes'].append({
-                    'id': row_dict['paquete_id'],
-                    'nombre': row_dict['paquete_nombre'],
-                    'precio': row_dict['precio'],
-                    'orden': row_dict['paquete_orden'],
-                    'imagen': row_dict['paquete_imagen']
-                })
 
-        # Convertir a lista
-        productos_list = list(productos_dict.values())
+        # Agregar paquete si existe
+        if row_dict['paquete_id'] is not None:
+            productos_dict[producto_id]['paquetes'].append({
+                'id': row_dict['paquete_id'],
+                'nombre': row_dict['paquete_nombre'],
+                'precio': row_dict['precio'],
+                'orden': row_dict['paquete_orden'],
+                'imagen': row_dict['paquete_imagen']
+            })
+
+    # Convertir a lista
+    productos_list = list(productos_dict.values())
 
-        # Debug: contar productos por categorÃ­a
+    # Resumen por categoría solo con LOG_LEVEL=DEBUG
+    if log_catalogo.isEnabledFor(logging.DEBUG):
         categorias_count = {}
         for producto in productos_list:
             cat = producto['categoria']
             categorias_count[cat] = categorias_count.get(cat, 0) + 1
+        log_catalogo.debug("Catálogo recargado: %d productos, por categoría: %s", len(productos_list), categorias_count)
 
-        print(f"ðŸ“Š Productos por categorÃ­a: {categorias_count}")
+    return productos_list
 
-        return jsonify(productos_list)
-    finally:
-        conn.close()
+catalogo_cache = CacheSnapshot('catalogo', _cargar_catalogo_publico)
+
+@app.route('/productos', methods=['GET'])
+def get_productos_publico():
+    return respuesta_snapshot('productos', catalogo_cache.get())
+
+def _cargar_config_publica(conn):
+    result = conn.execute(text('SELECT campo, valor FROM configuracion'))
+    configs = result.fetchall()
+
+    # Convertir a diccionario usando Ã­ndices numÃ©ricos
+    config_dict = {}
+    for config in configs:
+        config_dict[config[0]] = config[1]  # campo, valor
+
+    return config_dict
+
+config_cache = CacheSnapshot('config', _cargar_config_publica)
 
 # ENDPOINT PÃšBLICO PARA CONFIGURACIÃ“N (FRONTEND DE USUARIOS)
 @app.route('/config', methods=['GET'])
 def get_config_publico():
-    conn = get_db_connection()
-    try:
-        result = conn.execute(text('SELECT campo, valor FROM configuracion'))
-        configs = result.fetchall()
-
-        # Convertir a diccionario usando Ã­ndices numÃ©ricos
-        config_dict = {}
-        for config in configs:
-            config_dict[config[0]] = config[1]  # campo, valor
-
-        return jsonify(config_dict)
-    finally:
-        conn.close()
+    return respuesta_snapshot('config', config_cache.get())
 
 # ENDPOINTS PARA VALORACIONES
+def _compro_producto(conn, juego_id, usuario_email):
+    """True si el usuario tiene una orden procesada del juego (también entre las archivadas)"""
+    return bool(conn.execute(text('''
+        SELECT EXISTS (
+            SELECT 1 FROM ordenes
+            WHERE juego_id = :juego_id AND usuario_email = :usuario_email AND estado = 'procesado'
+        ) OR EXISTS (
+            SELECT 1 FROM ordenes_archivo
+            WHERE juego_id = :juego_id AND usuario_email = :usuario_email AND estado = 'procesado'
+        )
+    '''), {'juego_id': juego_id, 'usuario_email': usuario_email}).scalar())
+
+def _autor_valoracion(nombre, email):
+    """Nombre que se muestra en la valoración: el del usuario o su email oculto ('ab***@dominio.com').
+    Se guarda al escribirla (migración 011 rellena las anteriores con el mismo criterio)."""
+    if nombre:
+        return nombre
+    if not email:
+        return None
+    partes = email.split('@')
+    if len(partes) == 2:
+        return partes[0][:2] + '***@' + partes[1]
+    return '***'
+
 @app.route('/valoracion', methods=['POST'])
 def crear_valoracion():
     # Verificar si el usuario estÃ¡ logueado
@@ -1661,30 +1580,28 @@ def crear_valoracion():
     conn = get_db_connection()
     try:
         # Verificar que el usuario haya comprado este juego
-        result = conn.execute(text('''
-            SELECT COUNT(*) FROM ordenes 
-            WHERE juego_id = :juego_id AND usuario_email = :usuario_email AND estado = 'procesado'
-        '''), {'juego_id': juego_id, 'usuario_email': usuario_email})
-
-        compras = result.fetchone()[0]
-
-        if compras == 0:
+        if not _compro_producto(conn, juego_id, usuario_email):
             return jsonify({'error': 'Solo puedes valorar productos que hayas comprado'}), 403
 
         # Insertar o actualizar valoraciÃ³n
         conn.execute(text('''
-            INSERT INTO valoraciones (juego_id, usuario_email, calificacion, comentario)
-            VALUES (:juego_id, :usuario_email, :calificacion, :comentario)
+            INSERT INTO valoraciones (juego_id, usuario_email, calificacion, comentario, autor)
+            VALUES (:juego_id, :usuario_email, :calificacion, :comentario, :autor)
             ON CONFLICT (juego_id, usuario_email) 
-            DO UPDATE SET calificacion = EXCLUDED.calificacion, comentario = EXCLUDED.comentario, fecha = CURRENT_TIMESTAMP
+            DO UPDATE SET calificacion = EXCLUDED.calificacion, comentario = EXCLUDED.comentario,
+                          autor = EXCLUDED.autor, fecha = CURRENT_TIMESTAMP
         '''), {
             'juego_id': juego_id,
             'usuario_email': usuario_email,
             'calificacion': calificacion,
-            'comentario': comentario
+            'comentario': comentario,
+            'autor': _autor_valoracion(session.get('user_name'), usuario_email)
         })
 
+        # El promedio y total de valoraciones forman parte del catÃ¡logo pÃºblico
+        bump_cache_version(conn, 'catalogo')
         conn.commit()
+        catalogo_cache.invalidate()
         return jsonify({'message': 'ValoraciÃ³n guardada correctamente'})
 
     except Exception as e:
@@ -1693,63 +1610,108 @@ def crear_valoracion():
     finally:
         conn.close()
 
+VALORACIONES_LIMIT_DEFAULT = 10
+VALORACIONES_LIMIT_MAX = 50
+# orden -> (ORDER BY, condición de la página siguiente dado el cursor). Cada ORDER BY sigue
+# un índice de valoraciones (migraciones 002 y 011), sin ordenar en memoria.
+VALORACIONES_ORDENES = {
+    'recientes': ('fecha DESC, id DESC',
+                  '(fecha, id) < (:cursor_fecha, :cursor_id)'),
+    'mayor': ('calificacion DESC, fecha DESC, id DESC',
+              '(calificacion, fecha, id) < (:cursor_calificacion, :cursor_fecha, :cursor_id)'),
+    'menor': ('calificacion ASC, fecha DESC, id DESC',
+              '(calificacion > :cursor_calificacion OR (calificacion = :cursor_calificacion'
+              ' AND (fecha, id) < (:cursor_fecha, :cursor_id)))'),
+}
+
 @app.route('/valoraciones/<int:juego_id>', methods=['GET'])
 def get_valoraciones_producto(juego_id):
+    """Valoraciones de un producto paginadas por cursor y sus estadísticas.
+
+    Query: limit, cursor, orden (recientes | mayor | menor calificación). El cuerpo sigue siendo
+    {valoraciones, estadisticas}; el cursor de la página siguiente va en X-Next-Cursor.
+    """
+    orden = request.args.get('orden', 'recientes')
+    params = {'juego_id': juego_id}
+    try:
+        if orden not in VALORACIONES_ORDENES:
+            raise ValueError(orden)
+        limit = min(max(int(request.args.get('limit', VALORACIONES_LIMIT_DEFAULT)), 1), VALORACIONES_LIMIT_MAX)
+        cursor = request.args.get('cursor')
+        if cursor:
+            fecha, params['cursor_id'] = _decode_cursor(cursor)
+            if orden == 'recientes':
+                params['cursor_fecha'] = fecha
+            else:
+                # En los órdenes por calificación el cursor lleva 'calificacion|fecha'
+                calificacion, params['cursor_fecha'] = fecha.split('|', 1)
+                params['cursor_calificacion'] = int(calificacion)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        return jsonify({'error': 'Parámetros de paginación u orden inválidos'}), 400
+    params['limit'] = limit + 1
+
+    # Cada valoración nueva sube la versión del catálogo: el ETag se resuelve sin consultar la base
+    catalogo = catalogo_cache.get()
+    etag = f"v{catalogo.version}-{juego_id}"
+    if request.query_string:
+        etag += '-' + hashlib.sha1(request.query_string).hexdigest()[:12]
+    return respuesta_cacheable('valoraciones', etag,
+                               lambda: _valoraciones_producto_json(juego_id, orden, cursor is not None, params),
+                               catalogo.last_modified)
+
+def _estadisticas_valoraciones(resumen):
+    """{promedio, total, estrellas_5..estrellas_1} desde la fila de valoraciones_resumen (o None)"""
+    total = resumen.total if resumen else 0
+    stats = {
+        'promedio': round(resumen.suma / total, 1) if total else None,
+        'total': total,
+    }
+    for n in range(5, 0, -1):
+        stats[f'estrellas_{n}'] = getattr(resumen, f'estrellas_{n}') if resumen else 0
+    return stats
+
+def _valoraciones_producto_json(juego_id, orden, con_cursor, params):
+    """(cuerpo JSON, headers extra) para respuesta_cacheable"""
+    order_by, condicion_cursor = VALORACIONES_ORDENES[orden]
+    where = 'juego_id = :juego_id'
+    if con_cursor:
+        where += f' AND {condicion_cursor}'
+    limit = params['limit'] - 1
+
     conn = get_db_connection()
     try:
-        # Obtener valoraciones del producto
-        result = conn.execute(text('''
-            SELECT v.*, u.nombre as usuario_nombre
-            FROM valoraciones v
-            LEFT JOIN usuarios u ON v.usuario_email = u.email
-            WHERE v.juego_id = :juego_id
-            ORDER BY v.fecha DESC
-        '''), {'juego_id': juego_id})
-
-        valoraciones = result.fetchall()
-
-        # Obtener estadÃ­sticas
-        stats_result = conn.execute(text('''
-            SELECT 
-                AVG(calificacion) as promedio,
-                COUNT(*) as total,
-                COUNT(CASE WHEN calificacion = 5 THEN 1 END) as estrellas_5,
-                COUNT(CASE WHEN calificacion = 4 THEN 1 END) as estrellas_4,
-                COUNT(CASE WHEN calificacion = 3 THEN 1 END) as estrellas_3,
-                COUNT(CASE WHEN calificacion = 2 THEN 1 END) as estrellas_2,
-                COUNT(CASE WHEN calificacion = 1 THEN 1 END) as estrellas_1
-            FROM valoraciones 
+        # Solo lo que muestra la página; el autor ya viene oculto desde que se escribió
+        result = conn.execute(text(f'''
+            SELECT id, juego_id, calificacion, comentario, fecha, autor AS usuario_nombre
+            FROM valoraciones
+            WHERE {where}
+            ORDER BY {order_by}
+            LIMIT :limit
+        '''), params)
+        valoraciones_list = [dict(row._mapping) for row in result]
+
+        # Estadísticas: una fila de valoraciones_resumen (mantenida por triggers)
+        resumen = conn.execute(text('''
+            SELECT total, suma, estrellas_1, estrellas_2, estrellas_3, estrellas_4, estrellas_5
+            FROM valoraciones_resumen
             WHERE juego_id = :juego_id
-        '''), {'juego_id': juego_id})
-
-        stats = stats_result.fetchone()
-
-        # Convertir a diccionarios
-        valoraciones_list = []
-        for val in valoraciones:
-            val_dict = dict(val._mapping)
-            # Ocultar email completo por privacidad
-            email = val_dict['usuario_email']
-            if email:
-                email_parts = email.split('@')
-                if len(email_parts) == 2:
-                    val_dict['usuario_email_oculto'] = email_parts[0][:2] + '***@' + email_parts[1]
-                else:
-                    val_dict['usuario_email_oculto'] = '***'
-            valoraciones_list.append(val_dict)
+        '''), {'juego_id': juego_id}).fetchone()
+    finally:
+        conn.close()
 
-        # Preparar estadÃ­sticas
-        stats_dict = dict(stats._mapping) if stats else {}
-        if stats_dict.get('promedio'):
-            stats_dict['promedio'] = round(float(stats_dict['promedio']), 1)
+    headers = {}
+    if len(valoraciones_list) > limit:
+        ultima = valoraciones_list[limit - 1]
+        clave = ultima['fecha'] if orden == 'recientes' else f"{ultima['calificacion']}|{ultima['fecha']}"
+        headers['X-Next-Cursor'] = _encode_cursor(clave, ultima['id'])
 
-        return jsonify({
-            'valoraciones': valoraciones_list,
-            'estadisticas': stats_dict
-        })
+    # Preparar estadÃ­sticas
+    stats_dict = _estadisticas_valoraciones(resumen)
 
-    finally:
-        conn.close()
+    return app.json.dumps({
+        'valoraciones': valoraciones_list[:limit],
+        'estadisticas': stats_dict
+    }), headers
 
 @app.route('/valoracion/usuario/<int:juego_id>', methods=['GET'])
 def get_valoracion_usuario(juego_id):
@@ -1762,12 +1724,7 @@ def get_valoracion_usuario(juego_id):
     conn = get_db_connection()
     try:
         # Verificar si el usuario puede valorar (ha comprado el producto)
-        result = conn.execute(text('''
-            SELECT COUNT(*) FROM ordenes 
-            WHERE juego_id = :juego_id AND usuario_email = :usuario_email AND estado = 'procesado'
-        '''), {'juego_id': juego_id, 'usuario_email': usuario_email})
-
-        puede_valorar = result.fetchone()[0] > 0
+        puede_valorar = _compro_producto(conn, juego_id, usuario_email)
 
         # Obtener valoraciÃ³n existente del usuario
         result = conn.execute(text('''
@@ -1987,7 +1944,7 @@ def delete_imagen(imagen_id):
             try:
                 os.remove(file_path)
             except Exception as e:
-                print(f"Error al eliminar archivo: {e}")
+                log.warning("Error al eliminar archivo %s: %s", file_path, e)
 
         # Eliminar de la base de datos
         conn.execute(text('DELETE FROM imagenes WHERE id = :imagen_id'), 
@@ -2030,11 +1987,37 @@ def update_config():
                 ON CONFLICT (campo) DO UPDATE SET valor = EXCLUDED.valor
             '''), {'campo': campo, 'valor': valor})
 
+        bump_cache_version(conn, 'config')
         conn.commit()
+        config_cache.invalidate()
         return jsonify({'message': 'ConfiguraciÃ³n actualizada correctamente'})
     finally:
         conn.close()
 
+# Hash de contraseñas en un pool de procesos acotado y límite de intentos por email/IP
+pool_password = password_pool.PasswordPool()
+limite_intentos_email = password_pool.TokenBucket(password_pool.INTENTOS_POR_EMAIL, password_pool.VENTANA_SECONDS)
+limite_intentos_ip = password_pool.TokenBucket(password_pool.INTENTOS_POR_IP, password_pool.VENTANA_SECONDS)
+
+def _respuesta_espera(mensaje, codigo, segundos):
+    response = jsonify({'error': mensaje})
+    response.status_code = codigo
+    response.headers['Retry-After'] = str(max(1, int(segundos + 0.999)))
+    return response
+
+def _limitar_intentos(email=None):
+    """Respuesta 429 si la IP (o el email) se quedó sin intentos; None si puede seguir"""
+    espera = limite_intentos_ip.consumir(request.remote_addr)
+    if email and not espera:
+        espera = limite_intentos_email.consumir(email.strip().lower())
+    if espera:
+        return _respuesta_espera('Demasiados intentos, espera un momento e intenta de nuevo', 429, espera)
+    return None
+
+def _servidor_ocupado():
+    log.warning("Pool de contraseñas saturado, se responde 503 en %s", request.path)
+    return _respuesta_espera('Hay muchas solicitudes en este momento, intenta de nuevo en unos segundos', 503, 2)
+
 # ENDPOINTS DE AUTENTICACIÃ“N
 @app.route('/registro', methods=['POST'])
 def registro():
@@ -2047,6 +2030,10 @@ def registro():
     if not nombre or not email or not telefono or not password:
         return jsonify({'error': 'Todos los campos son requeridos'}), 400
 
+    limitada = _limitar_intentos()
+    if limitada:
+        return limitada
+
     # Verificar si el email ya existe
     conn = get_db_connection()
     try:
@@ -2054,10 +2041,17 @@ def registro():
                              {'email': email})
         if result.fetchone():
             return jsonify({'error': 'El email ya estÃ¡ registrado'}), 400
+    finally:
+        conn.close()
 
-        # Crear nuevo usuario
-        password_hash = generate_password_hash(password)
+    # El hash corre en el pool, sin retener una conexión de la base mientras tanto
+    try:
+        password_hash = pool_password.hash(password)
+    except password_pool.PoolSaturado:
+        return _servidor_ocupado()
 
+    conn = get_db_connection()
+    try:
         result = conn.execute(text('''
             INSERT INTO usuarios (nombre, email, telefono, password_hash, fecha_registro)
             VALUES (:nombre, :email, :telefono, :password_hash, datetime('now'))
@@ -2068,6 +2062,10 @@ def registro():
 
         return jsonify({'message': 'Usuario registrado correctamente', 'user_id': user_id})
 
+    except IntegrityError:
+        # Otro registro con el mismo email ganó mientras se calculaba el hash
+        conn.rollback()
+        return jsonify({'error': 'El email ya estÃ¡ registrado'}), 400
     except Exception as e:
         conn.rollback()
         return jsonify({'error': 'Error al registrar usuario'}), 500
@@ -2083,49 +2081,78 @@ def login():
     if not email or not password:
         return jsonify({'error': 'Email y contraseÃ±a son requeridos'}), 400
 
+    limitada = _limitar_intentos(email)
+    if limitada:
+        return limitada
+
     conn = get_db_connection()
     try:
-        result = conn.execute(text("SELECT id, nombre, email, password_hash, es_admin, fecha_registro FROM usuarios WHERE email = :email"), { 'email': email })
+        result = conn.execute(text("SELECT id, nombre, email, password_hash, es_admin, fecha_registro, telefono FROM usuarios WHERE email = :email"), { 'email': email })
         row = result.fetchone()
-
-        if row:
-            # Mapear fila a dict
-            user = dict(row._mapping)
-            pwd_hash = user.get('password_hash')
-            if pwd_hash and check_password_hash(pwd_hash, password):
-                # Guardar sesiÃ³n permanente con tiempo de expiraciÃ³n
-                session.permanent = True
-                session['user_id'] = user['id']
-                session['user_email'] = user['email']
-                session['user_name'] = user['nombre']
-                session['es_admin'] = bool(user.get('es_admin', 0))
-
-                # fecha_registro puede ser str en SQLite
-                fecha_registro = user.get('fecha_registro')
-                fecha_registro_out = None
-                if fecha_registro:
-                    try:
-                        # Intentar parsear a ISO si viene como datetime
-                        fecha_registro_out = fecha_registro.isoformat()
-                    except AttributeError:
-                        # Si ya es str, devolverla tal cual
-                        fecha_registro_out = str(fecha_registro)
-
-                return jsonify({
-                    'message': 'SesiÃ³n iniciada correctamente',
-                    'usuario': {
-                        'id': user['id'],
-                        'nombre': user['nombre'],
-                        'email': user['email'],
-                        'fecha_registro': fecha_registro_out,
-                        'es_admin': bool(user.get('es_admin', 0))
-                    }
-                })
-
-        return jsonify({'error': 'Email o contraseÃ±a incorrectos'}), 401
     finally:
         conn.close()
 
+    if row:
+        # Mapear fila a dict
+        user = dict(row._mapping)
+        pwd_hash = user.get('password_hash')
+        try:
+            password_ok, hash_nuevo = pool_password.verificar(pwd_hash, password)
+        except password_pool.PoolSaturado:
+            return _servidor_ocupado()
+        if password_ok:
+            if hash_nuevo:
+                # Hash con otro método/costo que PASSWORD_HASH_METHOD: reemplazarlo ahora que
+                # tenemos la contraseña en claro (solo si nadie lo cambió mientras tanto)
+                conn = get_db_connection()
+                try:
+                    conn.execute(text('''
+                        UPDATE usuarios SET password_hash = :nuevo
+                        WHERE id = :id AND password_hash = :anterior
+                    '''), {'nuevo': hash_nuevo, 'id': user['id'], 'anterior': pwd_hash})
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    log.warning("No se pudo actualizar el hash de %s: %s", user['email'], e)
+                finally:
+                    conn.close()
+
+            # fecha_registro puede ser str en SQLite
+            fecha_registro = user.get('fecha_registro')
+            fecha_registro_out = None
+            if fecha_registro:
+                try:
+                    # Intentar parsear a ISO si viene como datetime
+                    fecha_registro_out = fecha_registro.isoformat()
+                except AttributeError:
+                    # Si ya es str, devolverla tal cual
+                    fecha_registro_out = str(fecha_registro)
+
+            # Guardar sesiÃ³n permanente con tiempo de expiraciÃ³n
+            # (id nuevo en cada login; el perfil queda guardado para /usuario y POST /orden)
+            session.clear()
+            session.rotar()
+            session.permanent = True
+            session['user_id'] = user['id']
+            session['user_email'] = user['email']
+            session['user_name'] = user['nombre']
+            session['es_admin'] = bool(user.get('es_admin', 0))
+            session['user_telefono'] = user.get('telefono')
+            session['user_fecha_registro'] = fecha_registro_out
+
+            return jsonify({
+                'message': 'SesiÃ³n iniciada correctamente',
+                'usuario': {
+                    'id': user['id'],
+                    'nombre': user['nombre'],
+                    'email': user['email'],
+                    'fecha_registro': fecha_registro_out,
+                    'es_admin': bool(user.get('es_admin', 0))
+                }
+            })
+
+    return jsonify({'error': 'Email o contraseÃ±a incorrectos'}), 401
+
 @app.route('/logout', methods=['POST'])
 def logout():
     session.clear()
@@ -2138,74 +2165,80 @@ def obtener_usuario():
     if 'user_id' not in session:
         return jsonify({'error': 'No hay sesiÃ³n activa'}), 401
 
-    conn = get_db_connection()
-    try:
-        result = conn.execute(text("""
-            SELECT id, nombre, email, fecha_registro, es_admin 
-            FROM usuarios 
-            WHERE id = :user_id
-        """), {'user_id': session['user_id']})
-
-        usuario = result.fetchone()
-
-        if not usuario:
-            return jsonify({'error': 'Usuario no encontrado'}), 404
-
-        # Manejar fecha_registro que puede venir como datetime o como string (SQLite)
-        fecha_val = usuario[3]
-        try:
-            fecha_out = fecha_val.isoformat() if fecha_val else None
-        except AttributeError:
-            fecha_out = str(fecha_val) if fecha_val else None
-
-        # es_admin entero 0/1 -> booleano
-        es_admin_val = bool(usuario[4]) if usuario[4] is not None else False
-
-        return jsonify({
-            'usuario': {
-                'id': usuario[0],
-                'nombre': usuario[1],
-                'email': usuario[2],
-                'fecha_registro': fecha_out,
-                'es_admin': es_admin_val
-            }
-        })
+    # Perfil guardado en la sesión al iniciar sesión (sin consultar usuarios). es_admin sale de
+    # RoleCache, igual que en admin_required: un admin revocado deja de verse como admin aunque su
+    # sesión todavía diga lo contrario.
+    return jsonify({
+        'usuario': {
+            'id': session['user_id'],
+            'nombre': session.get('user_name'),
+            'email': session.get('user_email'),
+            'fecha_registro': session.get('user_fecha_registro'),
+            'es_admin': role_cache.es_admin(session['user_id'])
+        }
+    })
 
-    except Exception as e:
-        print(f"Error al obtener usuario: {e}")
-        return jsonify({'error': 'Error interno del servidor'}), 500
-    finally:
-        conn.close()
+HISTORIAL_LIMIT_DEFAULT = 20
+HISTORIAL_LIMIT_MAX = 100
+HISTORIAL_COLUMNAS = 'id, juego_id, paquete, monto, estado, fecha, metodo_pago, referencia_pago, codigo_producto'
 
 @app.route('/usuario/historial', methods=['GET'])
 def get_historial_compras():
+    """Compras del usuario logueado, de la más reciente a la más antigua, paginadas por cursor
+    sobre (fecha, id). Incluye las órdenes archivadas por la retención.
+
+    Query: limit, cursor, estado. El cuerpo es un array; el cursor siguiente va en X-Next-Cursor.
+    """
     if 'user_id' not in session:
         return jsonify({'error': 'No hay sesiÃ³n activa'}), 401
 
-    conn = get_db_connection()
+    filtros = ['usuario_email = :email']
+    params = {'email': session['user_email']}
     try:
-        # Obtener historial de compras del usuario logueado
-        result = conn.execute(text('''
-            SELECT o.*, j.nombre as juego_nombre, j.imagen as juego_imagen
-            FROM ordenes o 
-            LEFT JOIN juegos j ON o.juego_id = j.id 
-            LEFT JOIN usuarios u ON o.usuario_email = u.email
-            WHERE u.id = :user_id
-            ORDER BY o.fecha DESC
-        '''), {'user_id': session['user_id']})
-
-        historial = result.fetchall()
+        limit = min(max(int(request.args.get('limit', HISTORIAL_LIMIT_DEFAULT)), 1), HISTORIAL_LIMIT_MAX)
+        cursor = request.args.get('cursor')
+        if cursor:
+            params['cursor_fecha'], params['cursor_id'] = _decode_cursor(cursor)
+            filtros.append('(fecha, id) < (:cursor_fecha, :cursor_id)')
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        return jsonify({'error': 'Parámetros de paginación inválidos'}), 400
+    estado = (request.args.get('estado') or '').strip()
+    if estado:
+        # '+' evita que SQLite elija idx_ordenes_estado_fecha: recorrer el índice
+        # (usuario_email, fecha) del usuario ya viene ordenado y es acotado
+        filtros.append('+estado = :estado')
+        params['estado'] = estado
+    where = ' AND '.join(filtros)
+    params['limit'] = limit + 1
 
-        # Convertir a lista de diccionarios
-        historial_list = []
-        for compra in historial:
-            compra_dict = dict(compra._mapping)
-            historial_list.append(compra_dict)
-
-        return jsonify(historial_list)
+    conn = get_db_connection()
+    try:
+        # Cada lado baja por su índice (usuario_email, fecha) y SQLite los mezcla ya ordenados
+        result = conn.execute(text(f'''
+            SELECT {HISTORIAL_COLUMNAS} FROM ordenes WHERE {where}
+            UNION ALL
+            SELECT {HISTORIAL_COLUMNAS} FROM ordenes_archivo WHERE {where}
+            ORDER BY fecha DESC, id DESC
+            LIMIT :limit
+        '''), params)
+        compras = [dict(row._mapping) for row in result]
     finally:
         conn.close()
 
+    # Nombre, imagen y categoría del juego desde el snapshot del catálogo, sin JOIN
+    juegos = catalogo_cache.get().por_id()
+    for compra in compras[:limit]:
+        juego = juegos.get(compra['juego_id']) or {}
+        compra['juego_nombre'] = juego.get('nombre')
+        compra['juego_imagen'] = juego.get('imagen')
+        compra['categoria'] = juego.get('categoria')
+
+    response = jsonify(compras[:limit])
+    if len(compras) > limit:
+        ultima = compras[limit - 1]
+        response.headers['X-Next-Cursor'] = _encode_cursor(ultima['fecha'], ultima['id'])
+    return response
+
 @app.route('/images/<path:filename>')
 def serve_image(filename):
     """Endpoint para servir imÃ¡genes desde la base de datos"""
@@ -2226,7 +2259,7 @@ def serve_image(filename):
             # Si no se encuentra, devolver imagen por defecto disponible
             return redirect('/static/images/20250706_020025_20250705_163435_Recurso-40.png')
     except Exception as e:
-        print(f"Error al servir imagen {filename}: {e}")
+        log.warning("Error al servir imagen %s: %s", filename, e)
         # En caso de error, devolver imagen por defecto
         return redirect('/static/images/20250706_020025_20250705_163435_Recurso-40.png')
     finally:
@@ -2249,12 +2282,12 @@ if __name__ == '__main__':
     # Inicializar base de datos
     try:
         init_db()
-        print("Base de datos inicializada correctamente")
+        log.info("Base de datos inicializada correctamente")
     except Exception as e:
-        print(f"Error al inicializar la base de datos: {e}")
+        log.error("Error al inicializar la base de datos: %s", e)
 
     port = int(os.environ.get('PORT', 5000))
-    print(f'ðŸš€ Iniciando servidor en puerto {port}')
+    log.info("Iniciando servidor en puerto %s", port)
     app.run(host='0.0.0.0', port=port, debug=True)
 
 
@@ -0,0 +1,238 @@
+"""
+Métricas HTTP en formato Prometheus, agregadas entre workers de gunicorn.
+
+Cada worker acumula en memoria, por endpoint de Flask:
+  - peticiones por método y código de estado
+  - histograma de latencia de la petición
+  - histograma del tiempo pasado en la base de datos (medido por query_profiler)
+y el número de peticiones en curso. Un hilo de cada worker vuelca su estado cada
+METRICS_FLUSH_SECONDS a <METRICS_DIR>/<pid>.json; /metrics suma los archivos de todos
+los workers. Los contadores de workers que ya terminaron se conservan (los totales no
+retroceden al reiniciar un worker); el gauge de peticiones en curso solo cuenta procesos vivos.
+
+Variables de entorno:
+  METRICS_DIR            directorio compartido por los workers (por defecto uno temporal por master)
+  METRICS_FLUSH_SECONDS  cada cuánto vuelca cada worker su estado (por defecto 5)
+  METRICS_TOKEN          si se define, /metrics exige 'Authorization: Bearer <token>'
+"""
+import os
+import json
+import time
+import tempfile
+import threading
+
+from flask import Response, g, request
+
+import query_profiler
+
+# Límites superiores (segundos) de los buckets de los histogramas
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', '5'))
+
+
+def metrics_dir():
+    # Todos los workers de un mismo master comparten el ppid
+    return os.environ.get('METRICS_DIR') or os.path.join(tempfile.gettempdir(), f'tindo-metrics-{os.getppid()}')
+
+
+class Histogram:
+    __slots__ = ('buckets', 'sum', 'count')
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, valor):
+        for i, limite in enumerate(BUCKETS):
+            if valor <= limite:
+                self.buckets[i] += 1
+                break
+        self.sum += valor
+        self.count += 1
+
+
+class WorkerMetrics:
+    """Estado de métricas de este proceso"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}   # (endpoint, method, status) -> n
+        self.latency = {}    # endpoint -> Histogram
+        self.db_time = {}    # endpoint -> Histogram
+        self.in_flight = 0
+
+    def observe(self, endpoint, method, status, segundos, db_segundos):
+        with self.lock:
+            clave = (endpoint, method, status)
+            self.requests[clave] = self.requests.get(clave, 0) + 1
+            self.latency.setdefault(endpoint, Histogram()).observe(segundos)
+            self.db_time.setdefault(endpoint, Histogram()).observe(db_segundos)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'in_flight': self.in_flight,
+                'requests': [[e, m, s, n] for (e, m, s), n in self.requests.items()],
+                'latency': [[e, h.buckets, h.sum, h.count] for e, h in self.latency.items()],
+                'db_time': [[e, h.buckets, h.sum, h.count] for e, h in self.db_time.items()],
+            }
+
+
+_metrics = WorkerMetrics()
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def _archivo_worker(pid=None):
+    return os.path.join(metrics_dir(), f'{pid or os.getpid()}.json')
+
+
+def flush():
+    """Vuelca el estado de este worker a su archivo (escritura atómica)"""
+    directorio = metrics_dir()
+    os.makedirs(directorio, exist_ok=True)
+    destino = _archivo_worker()
+    tmp = f'{destino}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(_metrics.to_dict(), f)
+    os.replace(tmp, destino)
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        try:
+            flush()
+        except Exception:
+            pass
+
+
+def _ensure_flusher():
+    # Se arranca en la primera petición de cada worker (después del fork)
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher_pid != os.getpid():
+            threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+            _flusher_pid = os.getpid()
+
+
+def _pid_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def aggregate():
+    """Suma el estado volcado por todos los workers"""
+    requests_total = {}
+    latency = {}
+    db_time = {}
+    in_flight = 0
+    directorio = metrics_dir()
+    try:
+        archivos = [a for a in os.listdir(directorio) if a.endswith('.json')]
+    except FileNotFoundError:
+        archivos = []
+    for archivo in archivos:
+        try:
+            with open(os.path.join(directorio, archivo), encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if _pid_vivo(data.get('pid', 0)):
+            in_flight += data.get('in_flight', 0)
+        for e, m, s, n in data.get('requests', []):
+            requests_total[(e, m, s)] = requests_total.get((e, m, s), 0) + n
+        for destino, clave in ((latency, 'latency'), (db_time, 'db_time')):
+            for e, buckets, suma, count in data.get(clave, []):
+                h = destino.setdefault(e, Histogram())
+                h.buckets = [a + b for a, b in zip(h.buckets, buckets)]
+                h.sum += suma
+                h.count += count
+    return requests_total, latency, db_time, in_flight
+
+
+def _escape(valor):
+    return str(valor).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _render_histogram(lineas, nombre, ayuda, histogramas):
+    lineas.append(f'# HELP {nombre} {ayuda}')
+    lineas.append(f'# TYPE {nombre} histogram')
+    for endpoint in sorted(histogramas):
+        h = histogramas[endpoint]
+        etiqueta = f'endpoint="{_escape(endpoint)}"'
+        acumulado = 0
+        for limite, n in zip(BUCKETS, h.buckets):
+            acumulado += n
+            lineas.append(f'{nombre}_bucket{{{etiqueta},le="{limite}"}} {acumulado}')
+        lineas.append(f'{nombre}_bucket{{{etiqueta},le="+Inf"}} {h.count}')
+        lineas.append(f'{nombre}_sum{{{etiqueta}}} {h.sum:.6f}')
+        lineas.append(f'{nombre}_count{{{etiqueta}}} {h.count}')
+
+
+def render():
+    """Texto de exposición de Prometheus (version 0.0.4)"""
+    requests_total, latency, db_time, in_flight = aggregate()
+    lineas = [
+        '# HELP tindo_http_requests_total Peticiones HTTP atendidas',
+        '# TYPE tindo_http_requests_total counter',
+    ]
+    for (endpoint, method, status), n in sorted(requests_total.items()):
+        lineas.append(f'tindo_http_requests_total{{endpoint="{_escape(endpoint)}",method="{method}",status="{status}"}} {n}')
+    _render_histogram(lineas, 'tindo_http_request_duration_seconds', 'Latencia de las peticiones HTTP', latency)
+    _render_histogram(lineas, 'tindo_http_request_db_seconds', 'Tiempo en la base de datos por petición HTTP', db_time)
+    lineas.append('# HELP tindo_http_requests_in_flight Peticiones HTTP en curso')
+    lineas.append('# TYPE tindo_http_requests_in_flight gauge')
+    lineas.append(f'tindo_http_requests_in_flight {in_flight}')
+    return '\n'.join(lineas) + '\n'
+
+
+def init_app(app):
+    """Registra los hooks de medición y el endpoint /metrics"""
+
+    @app.before_request
+    def _metrics_inicio():
+        _ensure_flusher()
+        g._metrics_inicio = time.perf_counter()
+        with _metrics.lock:
+            _metrics.in_flight += 1
+
+    @app.after_request
+    def _metrics_fin(response):
+        inicio = g.pop('_metrics_inicio', None)
+        if inicio is not None:
+            endpoint = request.endpoint or 'sin_ruta'
+            perfil = query_profiler.current()
+            _metrics.observe(endpoint, request.method, response.status_code,
+                             time.perf_counter() - inicio, perfil.segundos if perfil else 0.0)
+            with _metrics.lock:
+                _metrics.in_flight -= 1
+        return response
+
+    @app.teardown_request
+    def _metrics_teardown(exc):
+        # Si after_request no llegó a ejecutarse (error no manejado) igual liberar el gauge
+        if g.pop('_metrics_inicio', None) is not None:
+            with _metrics.lock:
+                _metrics.in_flight -= 1
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        token = os.environ.get('METRICS_TOKEN')
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            return Response('unauthorized\n', status=401, mimetype='text/plain')
+        # El worker que atiende vuelca primero su propio estado para no servir datos atrasados
+        try:
+            flush()
+        except OSError:
+            pass
+        return Response(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
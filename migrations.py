@@ -0,0 +1,810 @@
+#!/usr/bin/env python3
+"""
+Migraciones de esquema versionadas para la base SQLite del proyecto.
+
+La versión aplicada se guarda en PRAGMA user_version. Cada migración numerada se
+ejecuta una sola vez por base de datos, dentro de su propia transacción y bajo un
+lock de archivo (<db>.migrate.lock) para que varios workers de gunicorn no la
+apliquen a la vez.
+
+Uso (en el deploy, antes de arrancar gunicorn):
+  python migrations.py              # aplica migraciones pendientes y sincroniza el admin
+  python migrations.py --status     # muestra versión actual y pendientes
+  python migrations.py --db /ruta/inefablestore.db
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Tuple
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+import app_logging
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin flock; en local se ejecuta un solo proceso
+    fcntl = None
+
+log = app_logging.get_logger('migraciones')
+
+
+def default_db_path() -> str:
+    return os.environ.get('DATABASE_PATH', 'inefablestore.db')
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """Conexión en modo autocommit: cada migración abre su propia transacción explícita."""
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.execute('PRAGMA busy_timeout=30000')
+    return conn
+
+
+def get_version(conn: sqlite3.Connection) -> int:
+    return int(conn.execute('PRAGMA user_version').fetchone()[0])
+
+
+def _column_exists(conn: sqlite3.Connection, table: str, column: str) -> bool:
+    cols = [row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+    return column in cols
+
+
+def _ensure_column(conn: sqlite3.Connection, table: str, column: str, ddl: str) -> None:
+    """Añade la columna si falta. ddl debe ser 'columna TIPO [DEFAULT ...]'."""
+    if not _column_exists(conn, table, column):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {ddl}")
+        log.info("Añadida columna %s.%s", table, column)
+
+
+# =====================
+# Migraciones
+# =====================
+
+def _m001_esquema_base(conn: sqlite3.Connection) -> None:
+    """Tablas base, columnas añadidas después, rutas de imágenes y datos iniciales."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS juegos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT,
+            descripcion TEXT,
+            imagen TEXT,
+            categoria TEXT DEFAULT 'juegos',
+            orden INTEGER DEFAULT 0,
+            etiquetas TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS paquetes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            juego_id INTEGER REFERENCES juegos(id),
+            nombre TEXT,
+            precio REAL,
+            orden INTEGER DEFAULT 0,
+            imagen TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ordenes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            juego_id INTEGER REFERENCES juegos(id),
+            paquete TEXT,
+            monto REAL,
+            usuario_email TEXT,
+            usuario_id TEXT,
+            usuario_telefono TEXT,
+            metodo_pago TEXT,
+            referencia_pago TEXT,
+            codigo_producto TEXT,
+            estado TEXT DEFAULT 'procesando',
+            fecha DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS valoraciones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            juego_id INTEGER REFERENCES juegos(id) ON DELETE CASCADE,
+            usuario_email TEXT NOT NULL,
+            calificacion INTEGER CHECK (calificacion >= 1 AND calificacion <= 5),
+            comentario TEXT,
+            fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(juego_id, usuario_email)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS imagenes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT,
+            ruta TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS configuracion (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campo TEXT UNIQUE,
+            valor TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS usuarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            telefono TEXT,
+            password_hash TEXT NOT NULL,
+            es_admin INTEGER DEFAULT 0,
+            fecha_registro DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Bases antiguas creadas sin estas columnas
+    _ensure_column(conn, 'juegos', 'categoria', "categoria TEXT DEFAULT 'juegos'")
+    _ensure_column(conn, 'juegos', 'orden', 'orden INTEGER DEFAULT 0')
+    _ensure_column(conn, 'juegos', 'etiquetas', 'etiquetas TEXT')
+    _ensure_column(conn, 'paquetes', 'orden', 'orden INTEGER DEFAULT 0')
+    _ensure_column(conn, 'paquetes', 'imagen', 'imagen TEXT')
+    _ensure_column(conn, 'ordenes', 'usuario_id', 'usuario_id TEXT')
+    _ensure_column(conn, 'ordenes', 'usuario_telefono', 'usuario_telefono TEXT')
+    _ensure_column(conn, 'ordenes', 'codigo_producto', 'codigo_producto TEXT')
+    _ensure_column(conn, 'usuarios', 'telefono', 'telefono TEXT')
+    _ensure_column(conn, 'usuarios', 'es_admin', 'es_admin INTEGER DEFAULT 0')
+
+    # Normalizar rutas de imágenes antiguas: '/static/images/x.jpg' -> 'images/x.jpg' y sin backslashes
+    conn.execute("""
+        UPDATE imagenes
+        SET ruta = substr(ruta, length('/static/') + 1)
+        WHERE ruta LIKE '/static/%'
+    """)
+    conn.execute("""
+        UPDATE imagenes
+        SET ruta = REPLACE(ruta, '\\', '/')
+        WHERE instr(ruta, '\\') > 0
+    """)
+
+    # Productos de ejemplo si la tabla está vacía
+    if conn.execute('SELECT COUNT(*) FROM juegos').fetchone()[0] == 0:
+        ejemplos = [
+            ('Free Fire', 'Juego de batalla real con acción intensa y gráficos increíbles',
+             '/static/images/20250701_212818_free_fire.webp', [
+                 ('100 Diamantes', 2.99, 1),
+                 ('310 Diamantes', 9.99, 2),
+                 ('520 Diamantes', 14.99, 3),
+                 ('1080 Diamantes', 29.99, 4),
+                 ('2200 Diamantes', 59.99, 5),
+             ]),
+            ('PUBG Mobile', 'Battle royale de última generación con mecánicas realistas',
+             '/static/images/default-product.jpg', [
+                 ('60 UC', 0.99, 1),
+                 ('325 UC', 4.99, 2),
+                 ('660 UC', 9.99, 3),
+                 ('1800 UC', 24.99, 4),
+                 ('3850 UC', 49.99, 5),
+             ]),
+            ('Call of Duty Mobile', 'FPS de acción con multijugador competitivo y battle royale',
+             '/static/images/default-product.jpg', [
+                 ('80 CP', 0.99, 1),
+                 ('400 CP', 4.99, 2),
+                 ('800 CP', 9.99, 3),
+                 ('2000 CP', 19.99, 4),
+                 ('5000 CP', 49.99, 5),
+             ]),
+        ]
+        for nombre, descripcion, imagen, paquetes in ejemplos:
+            cur = conn.execute('''
+                INSERT INTO juegos (nombre, descripcion, imagen, categoria)
+                VALUES (:nombre, :descripcion, :imagen, 'juegos')
+            ''', {'nombre': nombre, 'descripcion': descripcion, 'imagen': imagen})
+            juego_id = cur.lastrowid
+            conn.executemany('''
+                INSERT INTO paquetes (juego_id, nombre, precio, orden)
+                VALUES (?, ?, ?, ?)
+            ''', [(juego_id, p_nombre, precio, orden) for p_nombre, precio, orden in paquetes])
+
+    # Configuración básica si no existe
+    if conn.execute('SELECT COUNT(*) FROM configuracion').fetchone()[0] == 0:
+        conn.executemany('INSERT INTO configuracion (campo, valor) VALUES (?, ?)', [
+            ('tasa_usd_ves', '36.50'),
+            ('pago_movil', 'Banco: Banesco\nTelefono: 0412-1234567\nCédula: V-12345678\nNombre: Store Admin'),
+            ('binance', 'Email: admin@inefablestore.com\nID Binance: 123456789'),
+            ('carousel1', 'https://via.placeholder.com/800x300/007bff/ffffff?text=🎮+Ofertas+Especiales+Free+Fire'),
+            ('carousel2', 'https://via.placeholder.com/800x300/28a745/ffffff?text=🔥+Mejores+Precios+PUBG'),
+            ('carousel3', 'https://via.placeholder.com/800x300/dc3545/ffffff?text=⚡+Entrega+Inmediata+COD'),
+        ])
+
+
+# Índices secundarios gestionados: (nombre, tabla, columnas). Las consultas calientes de main.py
+# se verifican contra este conjunto con scripts/check_query_plans.py.
+INDEXES: List[Tuple[str, str, str]] = [
+    ('idx_ordenes_fecha', 'ordenes', 'fecha'),
+    ('idx_ordenes_usuario_fecha', 'ordenes', 'usuario_email, fecha'),
+    ('idx_ordenes_juego_usuario_estado', 'ordenes', 'juego_id, usuario_email, estado'),
+    ('idx_ordenes_estado_fecha', 'ordenes', 'estado, fecha'),
+    ('idx_ordenes_juego_fecha', 'ordenes', 'juego_id, fecha'),
+    ('idx_paquetes_juego_orden', 'paquetes', 'juego_id, orden'),
+    ('idx_valoraciones_juego_fecha', 'valoraciones', 'juego_id, fecha'),
+    ('idx_imagenes_tipo', 'imagenes', 'tipo'),
+]
+
+
+def ensure_indexes(conn: sqlite3.Connection) -> None:
+    for nombre, tabla, columnas in INDEXES:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {nombre} ON {tabla} ({columnas})")
+
+
+def _m002_indices_secundarios(conn: sqlite3.Connection) -> None:
+    ensure_indexes(conn)
+
+
+def _m003_reparar_ids_juegos(conn: sqlite3.Connection) -> None:
+    """Bases heredadas de PostgreSQL crearon juegos con 'id SERIAL PRIMARY KEY': en SQLite eso no es
+    alias de rowid y admite NULL, por eso las consultas usaban COALESCE(j.id, j.rowid). Se rellenan
+    los id nulos con su rowid y se reconstruye la tabla con 'id INTEGER PRIMARY KEY' para que los
+    joins sean igualdad sobre la clave primaria."""
+    info = {row[1]: row for row in conn.execute('PRAGMA table_info(juegos)').fetchall()}
+    id_col = info.get('id')
+    if id_col is not None and id_col[2].upper() == 'INTEGER' and id_col[5] == 1:
+        return  # ya es alias de rowid: no puede haber id nulos
+
+    # Las filas hijas de productos sin id apuntan a su rowid: conservarlo como id. Todos esos rowid
+    # se reservan antes de elegir ids nuevos para que una colisión no le quite el suyo a otra fila.
+    ids = {row[0] for row in conn.execute('SELECT id FROM juegos WHERE id IS NOT NULL')}
+    sin_id = [row[0] for row in conn.execute('SELECT rowid FROM juegos WHERE id IS NULL ORDER BY rowid')]
+    usados = ids | set(sin_id)
+    tablas = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    hijas = [t for t in ('paquetes', 'ordenes', 'ordenes_archivo', 'valoraciones') if t in tablas]
+    for rowid in sin_id:
+        if rowid not in ids:
+            conn.execute('UPDATE juegos SET id = ? WHERE rowid = ?', (rowid, rowid))
+            continue
+        # El rowid choca con el id de otro producto: las filas con juego_id = rowid pueden ser de
+        # cualquiera de los dos y no hay forma de saberlo. Solo se sigue si no hay ninguna.
+        referencias = {t: conn.execute(f'SELECT COUNT(*) FROM {t} WHERE juego_id = ?', (rowid,)).fetchone()[0]
+                       for t in hijas}
+        if any(referencias.values()):
+            detalle = ', '.join(f'{t}={n}' for t, n in referencias.items() if n)
+            raise RuntimeError(
+                f"juegos rowid={rowid} no tiene id y su rowid coincide con el id de otro producto; "
+                f"las filas con juego_id={rowid} ({detalle}) son ambiguas. Asigne el id a mano y "
+                f"vuelva a ejecutar las migraciones.")
+        nuevo_id = max(usados) + 1
+        usados.add(nuevo_id)
+        conn.execute('UPDATE juegos SET id = ? WHERE rowid = ?', (nuevo_id, rowid))
+        log.warning("juegos rowid=%s sin id choca con un id existente y no tiene filas hijas; se asigna id=%s",
+                    rowid, nuevo_id)
+
+    conn.execute('''
+        CREATE TABLE juegos_nuevo (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT,
+            descripcion TEXT,
+            imagen TEXT,
+            categoria TEXT DEFAULT 'juegos',
+            orden INTEGER DEFAULT 0,
+            etiquetas TEXT
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO juegos_nuevo (id, nombre, descripcion, imagen, categoria, orden, etiquetas)
+        SELECT CAST(id AS INTEGER), nombre, descripcion, imagen, categoria, orden, etiquetas FROM juegos
+    ''')
+    conn.execute('DROP TABLE juegos')
+    conn.execute('ALTER TABLE juegos_nuevo RENAME TO juegos')
+    log.info("Tabla juegos reconstruida con id INTEGER PRIMARY KEY")
+
+
+def _m004_versiones_cache(conn: sqlite3.Connection) -> None:
+    """Contadores de versión compartidos entre workers para invalidar las caches en memoria."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cache_versiones (
+            clave TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            actualizado DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute("INSERT OR IGNORE INTO cache_versiones (clave, version) VALUES ('catalogo', 1)")
+
+
+def _m005_contadores_ordenes(conn: sqlite3.Connection) -> None:
+    """Contadores de órdenes (total y por estado) mantenidos por triggers, para que el panel no
+    haga COUNT(*) sobre toda la tabla en cada refresco. Se recalculan al aplicar la migración."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ordenes_contadores (
+            clave TEXT PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('DELETE FROM ordenes_contadores')
+    conn.execute("INSERT INTO ordenes_contadores (clave, total) SELECT 'total', COUNT(*) FROM ordenes")
+    conn.execute('''
+        INSERT INTO ordenes_contadores (clave, total)
+        SELECT 'estado:' || COALESCE(estado, ''), COUNT(*) FROM ordenes GROUP BY COALESCE(estado, '')
+    ''')
+
+    sumar = '''
+        INSERT INTO ordenes_contadores (clave, total) VALUES ({clave}, 1)
+        ON CONFLICT (clave) DO UPDATE SET total = total + 1;
+    '''
+    restar = "UPDATE ordenes_contadores SET total = total - 1 WHERE clave = {clave};"
+    conn.execute('DROP TRIGGER IF EXISTS trg_ordenes_contadores_insert')
+    conn.execute(f'''
+        CREATE TRIGGER trg_ordenes_contadores_insert AFTER INSERT ON ordenes
+        BEGIN
+            {sumar.format(clave="'total'")}
+            {sumar.format(clave="'estado:' || COALESCE(NEW.estado, '')")}
+        END
+    ''')
+    conn.execute('DROP TRIGGER IF EXISTS trg_ordenes_contadores_delete')
+    conn.execute(f'''
+        CREATE TRIGGER trg_ordenes_contadores_delete AFTER DELETE ON ordenes
+        BEGIN
+            {restar.format(clave="'total'")}
+            {restar.format(clave="'estado:' || COALESCE(OLD.estado, '')")}
+        END
+    ''')
+    conn.execute('DROP TRIGGER IF EXISTS trg_ordenes_contadores_estado')
+    conn.execute(f'''
+        CREATE TRIGGER trg_ordenes_contadores_estado AFTER UPDATE OF estado ON ordenes
+        WHEN OLD.estado IS NOT NEW.estado
+        BEGIN
+            {restar.format(clave="'estado:' || COALESCE(OLD.estado, '')")}
+            {sumar.format(clave="'estado:' || COALESCE(NEW.estado, '')")}
+        END
+    ''')
+    # Listado paginado del panel filtrando por estado o producto
+    ensure_indexes(conn)
+
+
+def _m006_outbox(conn: sqlite3.Connection) -> None:
+    """Cola durable de correos salientes (ver outbox.py)."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            destinatario TEXT NOT NULL,
+            asunto TEXT NOT NULL,
+            cuerpo_texto TEXT,
+            cuerpo_html TEXT,
+            tipo TEXT,
+            orden_id INTEGER,
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            intentos INTEGER NOT NULL DEFAULT 0,
+            proximo_intento DATETIME DEFAULT CURRENT_TIMESTAMP,
+            bloqueado_hasta DATETIME,
+            reclamado_por TEXT,
+            ultimo_error TEXT,
+            creado DATETIME DEFAULT CURRENT_TIMESTAMP,
+            enviado DATETIME
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_estado_proximo ON outbox (estado, proximo_intento)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_reclamado ON outbox (reclamado_por)')
+
+
+def _m007_archivo_ordenes(conn: sqlite3.Connection) -> None:
+    """Órdenes movidas fuera de la tabla caliente por la retención (ver retencion.py)."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ordenes_archivo (
+            id INTEGER PRIMARY KEY,
+            juego_id INTEGER,
+            paquete TEXT,
+            monto REAL,
+            usuario_email TEXT,
+            usuario_id TEXT,
+            usuario_telefono TEXT,
+            metodo_pago TEXT,
+            referencia_pago TEXT,
+            codigo_producto TEXT,
+            estado TEXT,
+            fecha DATETIME,
+            archivado DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Historial archivado por usuario y chequeo de compra al valorar
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ordenes_archivo_usuario_fecha ON ordenes_archivo (usuario_email, fecha)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ordenes_archivo_juego_usuario_estado ON ordenes_archivo (juego_id, usuario_email, estado)')
+
+
+def _m008_idempotencia_ordenes(conn: sqlite3.Connection) -> None:
+    """Idempotency-Key de POST /orden y unicidad de la referencia de pago por ítem."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS idempotencia (
+            usuario_email TEXT NOT NULL,
+            clave TEXT NOT NULL,
+            orden_id INTEGER,
+            creado DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (usuario_email, clave)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_idempotencia_creado ON idempotencia (creado)')
+
+    # El carrito crea una orden por ítem con la misma referencia, así que la unicidad es por
+    # referencia + ítem. Los duplicados que ya existían quedan marcados (pago_duplicado = 1)
+    # y fuera del índice; se conserva sin marcar la orden más antigua de cada grupo.
+    columnas = {fila[1] for fila in conn.execute('PRAGMA table_info(ordenes)')}
+    if 'pago_duplicado' not in columnas:
+        conn.execute('ALTER TABLE ordenes ADD COLUMN pago_duplicado INTEGER NOT NULL DEFAULT 0')
+    marcadas = conn.execute('''
+        UPDATE ordenes SET pago_duplicado = 1
+        WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (
+                    PARTITION BY metodo_pago, referencia_pago, juego_id, paquete, usuario_id ORDER BY id
+                ) AS n
+                FROM ordenes
+                WHERE referencia_pago IS NOT NULL AND referencia_pago <> '' AND estado <> 'rechazado'
+            ) WHERE n > 1
+        )
+    ''').rowcount
+    if marcadas:
+        log.warning("%d órdenes con referencia de pago repetida quedaron marcadas con pago_duplicado = 1", marcadas)
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_ordenes_pago
+        ON ordenes (metodo_pago, referencia_pago, juego_id, paquete, usuario_id)
+        WHERE referencia_pago IS NOT NULL AND referencia_pago <> '' AND estado <> 'rechazado' AND pago_duplicado = 0
+    ''')
+
+
+def _m009_sesiones(conn: sqlite3.Connection) -> None:
+    """Sesiones del lado del servidor (ver sesiones.py): la cookie solo lleva el identificador."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sesiones (
+            id TEXT PRIMARY KEY,
+            usuario_id INTEGER,
+            datos TEXT NOT NULL,
+            expira REAL NOT NULL
+        )
+    ''')
+    # Purga de vencidas y actualización del perfil guardado en las sesiones de un usuario
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sesiones_expira ON sesiones (expira)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sesiones_usuario ON sesiones (usuario_id)')
+
+
+def reconstruir_resumen_valoraciones(conn: sqlite3.Connection) -> int:
+    """Recalcula valoraciones_resumen desde valoraciones (migración 010 y reparación con
+    --rebuild-aggregates). Devuelve cuántos productos tienen valoraciones."""
+    conn.execute('DELETE FROM valoraciones_resumen')
+    return conn.execute('''
+        INSERT INTO valoraciones_resumen (juego_id, total, suma, estrellas_1, estrellas_2, estrellas_3, estrellas_4, estrellas_5)
+        SELECT juego_id, COUNT(*), COALESCE(SUM(calificacion), 0),
+               COUNT(CASE WHEN calificacion = 1 THEN 1 END),
+               COUNT(CASE WHEN calificacion = 2 THEN 1 END),
+               COUNT(CASE WHEN calificacion = 3 THEN 1 END),
+               COUNT(CASE WHEN calificacion = 4 THEN 1 END),
+               COUNT(CASE WHEN calificacion = 5 THEN 1 END)
+        FROM valoraciones
+        WHERE juego_id IS NOT NULL
+        GROUP BY juego_id
+    ''').rowcount
+
+
+def _crear_triggers_resumen_valoraciones(conn: sqlite3.Connection) -> None:
+    """Triggers que mantienen valoraciones_resumen (migraciones 010 y 014)"""
+    def aplicar(fila, signo):
+        # Suma (signo '+') o resta ('-') la valoración fila (NEW u OLD) en el resumen de su producto.
+        # Restar solo actualiza: al borrar un juego, el ON DELETE CASCADE de valoraciones dispara
+        # este trigger y un INSERT recrearía el resumen del juego que se está borrando (error de FK).
+        estrellas = ', '.join(
+            f"estrellas_{n} = estrellas_{n} {signo} ({fila}.calificacion IS {n})" for n in range(1, 6))
+        crear = f'''
+            INSERT INTO valoraciones_resumen (juego_id) SELECT {fila}.juego_id WHERE {fila}.juego_id IS NOT NULL
+            ON CONFLICT (juego_id) DO NOTHING;''' if signo == '+' else ''
+        return f'''{crear}
+            UPDATE valoraciones_resumen
+            SET total = total {signo} 1, suma = suma {signo} COALESCE({fila}.calificacion, 0), {estrellas}
+            WHERE juego_id = {fila}.juego_id;
+        '''
+
+    conn.execute('DROP TRIGGER IF EXISTS trg_valoraciones_resumen_insert')
+    conn.execute(f'''
+        CREATE TRIGGER trg_valoraciones_resumen_insert AFTER INSERT ON valoraciones
+        BEGIN
+            {aplicar('NEW', '+')}
+        END
+    ''')
+    conn.execute('DROP TRIGGER IF EXISTS trg_valoraciones_resumen_delete')
+    conn.execute(f'''
+        CREATE TRIGGER trg_valoraciones_resumen_delete AFTER DELETE ON valoraciones
+        BEGIN
+            {aplicar('OLD', '-')}
+        END
+    ''')
+    # El upsert de crear_valoracion (editar la valoración) pasa por aquí
+    conn.execute('DROP TRIGGER IF EXISTS trg_valoraciones_resumen_update')
+    conn.execute(f'''
+        CREATE TRIGGER trg_valoraciones_resumen_update AFTER UPDATE OF calificacion, juego_id ON valoraciones
+        WHEN OLD.calificacion IS NOT NEW.calificacion OR OLD.juego_id IS NOT NEW.juego_id
+        BEGIN
+            {aplicar('OLD', '-')}
+            {aplicar('NEW', '+')}
+        END
+    ''')
+
+
+def _m010_resumen_valoraciones(conn: sqlite3.Connection) -> None:
+    """Total, suma e histograma de estrellas por producto mantenidos por triggers, para que
+    /productos y /valoraciones/<id> no agreguen toda la tabla valoraciones en cada petición."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS valoraciones_resumen (
+            juego_id INTEGER PRIMARY KEY REFERENCES juegos(id) ON DELETE CASCADE,
+            total INTEGER NOT NULL DEFAULT 0,
+            suma INTEGER NOT NULL DEFAULT 0,
+            estrellas_1 INTEGER NOT NULL DEFAULT 0,
+            estrellas_2 INTEGER NOT NULL DEFAULT 0,
+            estrellas_3 INTEGER NOT NULL DEFAULT 0,
+            estrellas_4 INTEGER NOT NULL DEFAULT 0,
+            estrellas_5 INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    reconstruir_resumen_valoraciones(conn)
+    _crear_triggers_resumen_valoraciones(conn)
+
+
+def _m011_autor_valoraciones(conn: sqlite3.Connection) -> None:
+    """Nombre visible del autor guardado con la valoración (nombre o email oculto) e índices
+    para listar las valoraciones de un producto por calificación, paginadas por cursor."""
+    columnas = {fila[1] for fila in conn.execute('PRAGMA table_info(valoraciones)')}
+    if 'autor' not in columnas:
+        conn.execute('ALTER TABLE valoraciones ADD COLUMN autor TEXT')
+    # Mismo criterio que _autor_valoracion en main.py: 'ab***@dominio.com' o '***'
+    conn.execute('''
+        UPDATE valoraciones SET autor = COALESCE(
+            NULLIF((SELECT nombre FROM usuarios u WHERE u.email = valoraciones.usuario_email), ''),
+            CASE
+                WHEN usuario_email = '' THEN NULL
+                WHEN instr(usuario_email, '@') > 0
+                     AND instr(substr(usuario_email, instr(usuario_email, '@') + 1), '@') = 0
+                THEN substr(usuario_email, 1, 2) || '***@' || substr(usuario_email, instr(usuario_email, '@') + 1)
+                ELSE '***'
+            END)
+        WHERE autor IS NULL
+    ''')
+    # orden=mayor recorre el primero hacia atrás; orden=menor (estrellas ascendentes, recientes
+    # primero) necesita el segundo con fecha/id descendentes
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_valoraciones_juego_calificacion ON valoraciones (juego_id, calificacion, fecha, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_valoraciones_juego_calificacion_desc ON valoraciones (juego_id, calificacion, fecha DESC, id DESC)')
+
+
+def _m012_version_roles(conn: sqlite3.Connection) -> None:
+    """Cualquier cambio de usuarios.es_admin (también un UPDATE manual para revocar un admin)
+    incrementa la versión 'roles', que RoleCache relee en cada worker."""
+    conn.execute('DROP TRIGGER IF EXISTS trg_usuarios_version_roles')
+    conn.execute('''
+        CREATE TRIGGER trg_usuarios_version_roles AFTER UPDATE OF es_admin ON usuarios
+        WHEN OLD.es_admin IS NOT NEW.es_admin
+        BEGIN
+            INSERT INTO cache_versiones (clave, version, actualizado) VALUES ('roles', 1, CURRENT_TIMESTAMP)
+            ON CONFLICT(clave) DO UPDATE SET version = version + 1, actualizado = CURRENT_TIMESTAMP;
+        END
+    ''')
+
+
+def _m013_fecha_obligatoria(conn: sqlite3.Connection) -> None:
+    """fecha no nula en las tablas que se paginan por cursor (fecha, id): con fecha NULL la
+    comparación (fecha, id) < (...) nunca es verdadera y esas filas desaparecían tras la página 1.
+    SQLite no permite agregar NOT NULL a una columna existente, así que lo imponen triggers."""
+    for tabla in ('ordenes', 'ordenes_archivo', 'valoraciones'):
+        # Los id crecen con el tiempo: la fecha de la fila anterior es la mejor aproximación
+        conn.execute(f'''
+            UPDATE {tabla} SET fecha = COALESCE(
+                (SELECT p.fecha FROM {tabla} p WHERE p.id < {tabla}.id AND p.fecha IS NOT NULL
+                 ORDER BY p.id DESC LIMIT 1),
+                (SELECT MIN(fecha) FROM {tabla}),
+                CURRENT_TIMESTAMP)
+            WHERE fecha IS NULL
+        ''')
+        for evento in ('INSERT', 'UPDATE OF fecha'):
+            nombre = f"trg_{tabla}_fecha_{evento.split()[0].lower()}"
+            conn.execute(f'DROP TRIGGER IF EXISTS {nombre}')
+            conn.execute(f'''
+                CREATE TRIGGER {nombre} BEFORE {evento} ON {tabla}
+                WHEN NEW.fecha IS NULL
+                BEGIN
+                    SELECT RAISE(ABORT, 'NOT NULL constraint failed: {tabla}.fecha');
+                END
+            ''')
+
+
+def _m014_triggers_resumen_sin_insert_al_borrar(conn: sqlite3.Connection) -> None:
+    """Recrea los triggers de valoraciones_resumen: el de DELETE ya no inserta filas, así borrar un
+    producto con valoraciones (ON DELETE CASCADE) no falla por la FK del resumen."""
+    _crear_triggers_resumen_valoraciones(conn)
+
+
+# (versión, descripción, función). Nunca reordenar ni renumerar: solo añadir al final.
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, 'esquema base', _m001_esquema_base),
+    (2, 'índices secundarios', _m002_indices_secundarios),
+    (3, 'reparar id nulos de juegos', _m003_reparar_ids_juegos),
+    (4, 'versiones de cache compartidas', _m004_versiones_cache),
+    (5, 'contadores de órdenes', _m005_contadores_ordenes),
+    (6, 'outbox de correos', _m006_outbox),
+    (7, 'archivo de órdenes', _m007_archivo_ordenes),
+    (8, 'idempotencia de órdenes', _m008_idempotencia_ordenes),
+    (9, 'sesiones del servidor', _m009_sesiones),
+    (10, 'resumen de valoraciones', _m010_resumen_valoraciones),
+    (11, 'autor y orden de valoraciones', _m011_autor_valoraciones),
+    (12, 'versión de roles al cambiar es_admin', _m012_version_roles),
+    (13, 'fecha obligatoria en tablas paginadas', _m013_fecha_obligatoria),
+    (14, 'triggers de resumen sin insert al borrar', _m014_triggers_resumen_sin_insert_al_borrar),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# =====================
+# Ejecución
+# =====================
+
+@contextmanager
+def _file_lock(db_path: str):
+    lock_path = f"{db_path}.migrate.lock"
+    with open(lock_path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def _bump_cache_version(conn: sqlite3.Connection, clave: str) -> None:
+    """Como bump_cache_version de main.py: los workers recargan esa cache (p.ej. 'roles' -> RoleCache)"""
+    conn.execute('''
+        INSERT INTO cache_versiones (clave, version, actualizado) VALUES (?, 1, CURRENT_TIMESTAMP)
+        ON CONFLICT(clave) DO UPDATE SET version = version + 1, actualizado = CURRENT_TIMESTAMP
+    ''', (clave,))
+
+
+def _refrescar_sesiones_admin(conn: sqlite3.Connection, email: str) -> None:
+    """El perfil cacheado en las sesiones abiertas del usuario pasa a es_admin = true"""
+    conn.execute('''
+        UPDATE sesiones SET datos = json_set(datos, '$.es_admin', json('true'))
+        WHERE usuario_id = (SELECT id FROM usuarios WHERE email = ?)
+    ''', (email,))
+
+
+def sync_admin_user(conn: sqlite3.Connection, email: Optional[str], password: Optional[str]) -> bool:
+    """Crea o promueve el admin de ADMIN_EMAIL/ADMIN_PASSWORD. Solo re-hashea si la contraseña cambió."""
+    if not (email and password):
+        return False
+    row = conn.execute('SELECT id, password_hash, es_admin FROM usuarios WHERE email = ?', (email,)).fetchone()
+    if row is None:
+        conn.execute('''
+            INSERT INTO usuarios (nombre, email, password_hash, es_admin)
+            VALUES (?, ?, ?, 1)
+        ''', ('Administrador', email, generate_password_hash(password)))
+        _bump_cache_version(conn, 'roles')
+        log.info("Usuario administrador creado: %s", email)
+        return True
+    _, pwd_hash, es_admin = row
+    password_ok = bool(pwd_hash) and check_password_hash(pwd_hash, password)
+    if password_ok and es_admin:
+        return False
+    if password_ok:
+        conn.execute('UPDATE usuarios SET es_admin = 1 WHERE email = ?', (email,))
+    else:
+        conn.execute('UPDATE usuarios SET es_admin = 1, password_hash = ? WHERE email = ?',
+                     (generate_password_hash(password), email))
+    _bump_cache_version(conn, 'roles')
+    _refrescar_sesiones_admin(conn, email)
+    log.info("Usuario actualizado como administrador: %s", email)
+    return True
+
+
+def migrate(db_path: Optional[str] = None, sync_admin: bool = True) -> List[int]:
+    """Aplica las migraciones pendientes bajo el lock de archivo. Devuelve las versiones aplicadas."""
+    db_path = db_path or default_db_path()
+    applied: List[int] = []
+    with _file_lock(db_path):
+        conn = connect(db_path)
+        try:
+            # Releer dentro del lock: otro worker pudo haber migrado mientras esperábamos
+            current = get_version(conn)
+            for version, descripcion, fn in MIGRATIONS:
+                if version <= current:
+                    continue
+                inicio = time.perf_counter()
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    fn(conn)
+                    conn.execute(f'PRAGMA user_version = {int(version)}')
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+                applied.append(version)
+                log.info("Migración %03d aplicada: %s (%.0f ms)", version, descripcion, (time.perf_counter() - inicio) * 1000)
+
+            if sync_admin:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    sync_admin_user(conn, os.environ.get('ADMIN_EMAIL'), os.environ.get('ADMIN_PASSWORD'))
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+        finally:
+            conn.close()
+    return applied
+
+
+def rebuild_aggregates(db_path: Optional[str] = None) -> int:
+    """Recalcula los agregados mantenidos por triggers (reparación de desvíos)"""
+    db_path = db_path or default_db_path()
+    conn = connect(db_path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            productos = reconstruir_resumen_valoraciones(conn)
+            # El promedio y total de valoraciones forman parte del catálogo cacheado
+            _bump_cache_version(conn, 'catalogo')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close()
+    return productos
+
+
+def ensure_schema(db_path: Optional[str] = None) -> List[int]:
+    """Chequeo rápido al arrancar un worker: si user_version está al día no hace nada más."""
+    db_path = db_path or default_db_path()
+    if os.path.exists(db_path):
+        conn = sqlite3.connect(db_path, timeout=30)
+        try:
+            if get_version(conn) >= LATEST_VERSION:
+                return []
+        finally:
+            conn.close()
+    return migrate(db_path)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Aplicar migraciones de esquema a la base SQLite')
+    parser.add_argument('--db', dest='db_path', default=None, help='Ruta de la base SQLite. Por defecto DATABASE_PATH o inefablestore.db')
+    parser.add_argument('--status', action='store_true', help='Solo mostrar la versión actual y las migraciones pendientes')
+    parser.add_argument('--no-admin', action='store_true', help='No crear/actualizar el admin de ADMIN_EMAIL/ADMIN_PASSWORD')
+    parser.add_argument('--rebuild-aggregates', action='store_true',
+                        help='Recalcular valoraciones_resumen desde valoraciones (tras aplicar las migraciones)')
+    args = parser.parse_args(argv)
+
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+    app_logging.configure_logging()
+
+    db_path = args.db_path or default_db_path()
+    db_dir = os.path.dirname(db_path)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+
+    if args.status:
+        conn = connect(db_path)
+        try:
+            current = get_version(conn)
+        finally:
+            conn.close()
+        print(f"Base de datos: {db_path}")
+        print(f"Versión actual: {current} | Última: {LATEST_VERSION}")
+        for version, descripcion, _ in MIGRATIONS:
+            if version > current:
+                print(f"  pendiente {version:03d}: {descripcion}")
+        return 0
+
+    applied = migrate(db_path, sync_admin=not args.no_admin)
+    if applied:
+        print(f"✅ {len(applied)} migración(es) aplicada(s). Versión actual: {applied[-1]}")
+    else:
+        print(f"✅ Esquema al día (versión {LATEST_VERSION})")
+    if args.rebuild_aggregates:
+        productos = rebuild_aggregates(db_path)
+        print(f"✅ valoraciones_resumen recalculado ({productos} producto(s) con valoraciones)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+Correos de notificación.
+
+Cada tipo de correo tiene un asunto y dos plantillas Jinja en templates/correos/:
+<tipo>.txt (texto plano) y <tipo>.html (con autoescape). Todas se compilan una sola vez al
+importar el módulo, así un error de sintaxis en una plantilla falla al arrancar y no al
+primer envío, y renderizar un correo no vuelve a parsear nada.
+
+  render(tipo, orden)              -> (asunto, texto, html), sin efectos; sirve para probar en lote
+  notificar(conn, tipo, orden, to) -> encola el correo en la outbox dentro de la transacción de conn
+"""
+import os
+import re
+import html as html_lib
+from datetime import date
+from functools import lru_cache
+from typing import NamedTuple
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+import outbox
+
+PLANTILLAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'correos')
+
+MESES_ES = (
+    'enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio',
+    'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre',
+)
+
+# tipo -> asunto (también es plantilla). Los asuntos van sin acentos, como siempre.
+ASUNTOS = {
+    'orden_recibida': 'Hemos recibido tu orden',
+    'orden_nueva_tienda': 'Nueva orden #{{ orden.id }}',
+    'recarga_completada': 'Tu recarga esta lista - Orden #{{ orden.id }} - Tindo Store',
+    'gift_card_completada': "Tu Gift Card de {{ orden.juego_nombre | default('Gift Card') }} fue entregada",
+    'orden_rechazada': 'Tu orden fue rechazada',
+    'prueba_smtp': 'Prueba SMTP tindostore',
+}
+
+
+@lru_cache(maxsize=366)
+def fecha_es(dia: date) -> str:
+    """date(2025, 3, 7) -> '7 de marzo de 2025' (sin depender del locale del sistema)"""
+    return f"{dia.day} de {MESES_ES[dia.month - 1]} de {dia.year}"
+
+
+_RE_PARRAFOS = re.compile(r'</(?:p|div|h[1-6]|ul|ol|table)>\s*', re.I)
+_RE_SALTOS = re.compile(r'(?:<br\s*/?>|</(?:li|tr)>)\s*', re.I)
+_RE_ITEM = re.compile(r'<li[^>]*>', re.I)
+_RE_TAGS = re.compile(r'<[^>]+>')
+_RE_LINEAS_VACIAS = re.compile(r'\n\s*\n+')
+
+
+def html_a_texto(contenido: str) -> str:
+    """Versión de texto plano de un cuerpo HTML (para clientes sin HTML)"""
+    texto = _RE_SALTOS.sub('\n', contenido)
+    texto = _RE_PARRAFOS.sub('\n\n', texto)
+    texto = _RE_ITEM.sub('- ', texto)
+    texto = html_lib.unescape(_RE_TAGS.sub('', texto))
+    lineas = (linea.strip() for linea in texto.split('\n'))
+    return _RE_LINEAS_VACIAS.sub('\n\n', '\n'.join(lineas)).strip()
+
+
+class Plantilla(NamedTuple):
+    asunto: object
+    texto: object
+    html: object
+
+
+def _compilar():
+    env = Environment(
+        loader=FileSystemLoader(PLANTILLAS_DIR),
+        autoescape=select_autoescape(enabled_extensions=('html',), default_for_string=False),
+        trim_blocks=True,
+        lstrip_blocks=True,
+    )
+    return {
+        tipo: Plantilla(env.from_string(asunto), env.get_template(f'{tipo}.txt'), env.get_template(f'{tipo}.html'))
+        for tipo, asunto in ASUNTOS.items()
+    }
+
+
+PLANTILLAS = _compilar()
+
+
+def render(tipo, orden=None, hoy=None):
+    """(asunto, texto, html) del correo tipo para la orden (dict)"""
+    plantilla = PLANTILLAS[tipo]
+    contexto = {'orden': orden or {}, 'fecha': fecha_es(hoy or date.today())}
+    return plantilla.asunto.render(contexto), plantilla.texto.render(contexto), plantilla.html.render(contexto)
+
+
+def notificar(conn, tipo, orden, destinatario):
+    """Encola el correo tipo para la orden en la outbox (no hace commit)"""
+    asunto, texto, html = render(tipo, orden)
+    outbox.encolar(conn, destinatario, asunto, texto, html, tipo=tipo, orden_id=orden.get('id'))
@@ -0,0 +1,236 @@
+"""
+Outbox de correos.
+
+Los endpoints no envían correos: insertan el mensaje en la tabla outbox dentro de la misma
+transacción que el cambio de la orden (si la orden no se guarda, el correo tampoco existe) y
+responden sin tocar la red. Un hilo por worker de gunicorn drena la tabla:
+
+  - reclama lotes con un UPDATE atómico (estado 'enviando' + lease), así dos workers nunca
+    envían el mismo mensaje; si un worker muere, el lease vence y otro lo retoma
+  - envía con concurrencia acotada (OUTBOX_CONCURRENCIA hilos); con enviar_lote cada hilo
+    manda su parte del lote por una sola conexión SMTP del pool
+  - ante un error reprograma con backoff exponencial; tras OUTBOX_MAX_INTENTOS el mensaje
+    queda 'fallido' (dead letter) para revisarlo desde /admin/outbox
+  - borra los enviados más viejos que OUTBOX_RETENCION_DIAS
+
+Estados: pendiente -> enviando -> enviado | pendiente (reintento) | fallido
+"""
+import os
+import time
+import uuid
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+
+import app_logging
+
+log = app_logging.get_logger('outbox')
+
+MAX_INTENTOS = int(os.environ.get('OUTBOX_MAX_INTENTOS', '6'))
+CONCURRENCIA = int(os.environ.get('OUTBOX_CONCURRENCIA', '2'))
+LOTE = int(os.environ.get('OUTBOX_LOTE', '20'))
+POLL_SECONDS = float(os.environ.get('OUTBOX_POLL_SECONDS', '2'))
+BACKOFF_BASE_SECONDS = float(os.environ.get('OUTBOX_BACKOFF_BASE_SECONDS', '30'))
+BACKOFF_MAX_SECONDS = float(os.environ.get('OUTBOX_BACKOFF_MAX_SECONDS', '3600'))
+LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_SECONDS', '300'))
+RETENCION_DIAS = int(os.environ.get('OUTBOX_RETENCION_DIAS', '7'))
+
+ESTADOS = ('pendiente', 'enviando', 'enviado', 'fallido')
+
+
+def encolar(conn, destinatario, asunto, texto=None, html=None, tipo=None, orden_id=None):
+    """Agrega un correo a la outbox usando la transacción abierta de conn (no hace commit)"""
+    conn.execute(text('''
+        INSERT INTO outbox (destinatario, asunto, cuerpo_texto, cuerpo_html, tipo, orden_id)
+        VALUES (:destinatario, :asunto, :texto, :html, :tipo, :orden_id)
+    '''), {
+        'destinatario': destinatario,
+        'asunto': asunto,
+        'texto': texto,
+        'html': html,
+        'tipo': tipo,
+        'orden_id': orden_id,
+    })
+
+
+def backoff_seconds(intentos):
+    """30s, 60s, 120s, ... hasta BACKOFF_MAX_SECONDS, con ±10% de jitter"""
+    espera = min(BACKOFF_BASE_SECONDS * (2 ** max(intentos - 1, 0)), BACKOFF_MAX_SECONDS)
+    return espera * random.uniform(0.9, 1.1)
+
+
+def resumen(conn):
+    """Profundidad de la cola por estado y antigüedad del pendiente más viejo"""
+    por_estado = {estado: 0 for estado in ESTADOS}
+    for estado, total in conn.execute(text('SELECT estado, COUNT(*) FROM outbox GROUP BY estado')):
+        por_estado[estado] = total
+    mas_antiguo = conn.execute(text('''
+        SELECT MIN(creado) FROM outbox WHERE estado IN ('pendiente', 'enviando')
+    ''')).scalar()
+    return {'por_estado': por_estado, 'pendiente_mas_antiguo': mas_antiguo}
+
+
+class OutboxWorker:
+    """Hilo que drena la outbox de este proceso.
+
+    get_connection() devuelve una conexión SQLAlchemy; enviar(mensaje) envía un dict con
+    destinatario/asunto/cuerpo_texto/cuerpo_html y lanza una excepción si falla.
+    enviar_lote(mensajes), opcional, envía varios y devuelve None o la excepción de cada uno.
+    """
+
+    def __init__(self, get_connection, enviar, enviar_lote=None):
+        self._get_connection = get_connection
+        self._enviar = enviar
+        self._enviar_lote = enviar_lote
+        self._despertar = threading.Event()
+        self._pid = None
+        self._lock = threading.Lock()
+        self._ultima_purga = 0.0
+
+    def start(self):
+        """Arranca el hilo una vez por proceso (también en cada worker tras un fork)"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._loop, name='outbox', daemon=True).start()
+        log.info("Worker de outbox iniciado (concurrencia=%d, lote=%d)", CONCURRENCIA, LOTE)
+
+    def notify(self):
+        """Despierta al hilo tras encolar, sin esperar al siguiente sondeo"""
+        self._despertar.set()
+
+    def _loop(self):
+        with ThreadPoolExecutor(max_workers=CONCURRENCIA, thread_name_prefix='outbox-envio') as pool:
+            while True:
+                self._despertar.wait(POLL_SECONDS)
+                self._despertar.clear()
+                try:
+                    while self.drain_once(pool) == LOTE:
+                        pass
+                    self._purgar_enviados()
+                except Exception as e:
+                    log.exception("Error drenando la outbox: %s", e)
+
+    def drain_once(self, pool=None):
+        """Reclama un lote, lo envía y registra el resultado. Devuelve cuántos mensajes procesó."""
+        mensajes = self._reclamar()
+        if not mensajes:
+            return 0
+        if self._enviar_lote is not None:
+            # Un trozo por hilo: cada trozo viaja por una misma conexión SMTP
+            partes = [mensajes[i::CONCURRENCIA] for i in range(CONCURRENCIA) if mensajes[i::CONCURRENCIA]]
+            if pool is None:
+                for parte in partes:
+                    self._entregar_lote(parte)
+            else:
+                list(pool.map(self._entregar_lote, partes))
+        elif pool is None:
+            for mensaje in mensajes:
+                self._entregar(mensaje)
+        else:
+            list(pool.map(self._entregar, mensajes))
+        return len(mensajes)
+
+    def _reclamar(self):
+        token = uuid.uuid4().hex
+        conn = self._get_connection()
+        try:
+            # Un solo UPDATE toma el lock de escritura: dos workers no pueden reclamar la misma fila.
+            # También recupera mensajes 'enviando' cuyo lease venció (worker muerto a mitad de envío).
+            conn.execute(text('''
+                UPDATE outbox
+                SET estado = 'enviando', reclamado_por = :token, intentos = intentos + 1,
+                    bloqueado_hasta = datetime('now', :lease)
+                WHERE id IN (
+                    SELECT id FROM outbox
+                    WHERE (estado = 'pendiente' AND proximo_intento <= datetime('now'))
+                       OR (estado = 'enviando' AND bloqueado_hasta <= datetime('now'))
+                    ORDER BY id
+                    LIMIT :lote
+                )
+            '''), {'token': token, 'lease': f'+{LEASE_SECONDS} seconds', 'lote': LOTE})
+            filas = conn.execute(text('''
+                SELECT id, destinatario, asunto, cuerpo_texto, cuerpo_html, tipo, orden_id, intentos
+                FROM outbox WHERE reclamado_por = :token AND estado = 'enviando'
+            '''), {'token': token}).fetchall()
+            conn.commit()
+            return [dict(fila._mapping) for fila in filas]
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _entregar(self, mensaje):
+        try:
+            self._enviar(mensaje)
+        except Exception as e:
+            self._registrar_fallo(mensaje, e)
+        else:
+            self._registrar_envio(mensaje)
+
+    def _entregar_lote(self, mensajes):
+        try:
+            errores = self._enviar_lote(mensajes)
+        except Exception as e:
+            errores = [e] * len(mensajes)
+        for mensaje, error in zip(mensajes, errores):
+            if error is None:
+                self._registrar_envio(mensaje)
+            else:
+                self._registrar_fallo(mensaje, error)
+
+    def _registrar_envio(self, mensaje):
+        conn = self._get_connection()
+        try:
+            conn.execute(text('''
+                UPDATE outbox SET estado = 'enviado', enviado = CURRENT_TIMESTAMP,
+                    ultimo_error = NULL, bloqueado_hasta = NULL
+                WHERE id = :id
+            '''), {'id': mensaje['id']})
+            conn.commit()
+        finally:
+            conn.close()
+        log.info("Correo #%s enviado a %s: %s", mensaje['id'], mensaje['destinatario'], mensaje['asunto'])
+
+    def _registrar_fallo(self, mensaje, error):
+        intentos = mensaje['intentos']
+        definitivo = intentos >= MAX_INTENTOS
+        conn = self._get_connection()
+        try:
+            conn.execute(text('''
+                UPDATE outbox
+                SET estado = :estado, ultimo_error = :error, bloqueado_hasta = NULL,
+                    proximo_intento = datetime('now', :espera)
+                WHERE id = :id
+            '''), {
+                'id': mensaje['id'],
+                'estado': 'fallido' if definitivo else 'pendiente',
+                'error': f'{type(error).__name__}: {error}'[:500],
+                'espera': f'+{int(backoff_seconds(intentos))} seconds',
+            })
+            conn.commit()
+        finally:
+            conn.close()
+        if definitivo:
+            log.error("Correo #%s a %s descartado tras %d intentos: %s",
+                      mensaje['id'], mensaje['destinatario'], intentos, error)
+        else:
+            log.warning("Correo #%s a %s falló (intento %d/%d), se reintentará: %s",
+                        mensaje['id'], mensaje['destinatario'], intentos, MAX_INTENTOS, error)
+
+    def _purgar_enviados(self):
+        if time.monotonic() - self._ultima_purga < 3600:
+            return
+        self._ultima_purga = time.monotonic()
+        conn = self._get_connection()
+        try:
+            conn.execute(text('''
+                DELETE FROM outbox WHERE estado = 'enviado' AND enviado < datetime('now', :dias)
+            '''), {'dias': f'-{RETENCION_DIAS} days'})
+            conn.commit()
+        finally:
+            conn.close()
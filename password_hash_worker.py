@@ -0,0 +1,28 @@
+"""
+Funciones que corren en los procesos del pool de contraseñas (password_pool.py).
+
+Este módulo es lo único que importa un proceso hijo: solo depende de Werkzeug, nada de
+main.py, la base ni los hilos de outbox/retención.
+"""
+from functools import lru_cache
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+@lru_cache(maxsize=8)
+def _prefijo(metodo):
+    # 'scrypt' -> 'scrypt:32768:8:1': el prefijo completo que Werkzeug guarda en el hash
+    return generate_password_hash('', method=metodo).split('$', 1)[0]
+
+
+def hashear(password, metodo):
+    return generate_password_hash(password, method=metodo)
+
+
+def verificar(pwd_hash, password, metodo):
+    """(ok, hash_nuevo): hash_nuevo solo si la contraseña es correcta y el hash usa otro método/costo"""
+    if not check_password_hash(pwd_hash, password):
+        return False, None
+    if pwd_hash.split('$', 1)[0] == _prefijo(metodo):
+        return True, None
+    return True, generate_password_hash(password, method=metodo)
@@ -0,0 +1,159 @@
+"""
+Hash y verificación de contraseñas fuera del hilo de la petición.
+
+scrypt (el método por defecto de Werkzeug) cuesta decenas de ms de CPU por intento; una ráfaga
+de logins en los dos workers de gunicorn dejaba sin CPU al catálogo. Aquí el trabajo va a un
+pool de procesos acotado por worker:
+
+  - PASSWORD_POOL_WORKERS        procesos de hash por worker de gunicorn (0 = en el hilo de la petición)
+  - PASSWORD_POOL_MAX_PENDING    trabajos en espera además de los que corren; si se llena -> PoolSaturado (503)
+  - PASSWORD_POOL_TIMEOUT_SECONDS  espera máxima por un resultado -> PoolSaturado
+  - PASSWORD_HASH_METHOD         método/costo para hashes nuevos (por defecto 'scrypt'). Al verificar un
+                                 hash con otro método se devuelve uno nuevo para reemplazarlo.
+
+Además TokenBucket limita los intentos por email y por IP en memoria (por worker, así que el
+límite efectivo se multiplica por el número de workers):
+
+  - LOGIN_INTENTOS_POR_EMAIL / LOGIN_INTENTOS_POR_IP  intentos por ventana (ráfaga máxima)
+  - LOGIN_VENTANA_SECONDS                             ventana en la que se recargan
+"""
+import os
+import time
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import app_logging
+import password_hash_worker
+
+log = app_logging.get_logger('password')
+
+METODO = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+WORKERS = int(os.environ.get('PASSWORD_POOL_WORKERS', '1'))
+MAX_PENDING = int(os.environ.get('PASSWORD_POOL_MAX_PENDING', '8'))
+TIMEOUT_SECONDS = float(os.environ.get('PASSWORD_POOL_TIMEOUT_SECONDS', '10'))
+
+INTENTOS_POR_EMAIL = int(os.environ.get('LOGIN_INTENTOS_POR_EMAIL', '5'))
+INTENTOS_POR_IP = int(os.environ.get('LOGIN_INTENTOS_POR_IP', '30'))
+VENTANA_SECONDS = float(os.environ.get('LOGIN_VENTANA_SECONDS', '60'))
+
+
+class PoolSaturado(Exception):
+    """No hay lugar en la cola del pool (o el resultado tardó demasiado)"""
+
+
+# --- Lado del worker de gunicorn ---
+
+def _contexto():
+    # Nunca fork: el hijo heredaría las conexiones SQLite abiertas y los hooks at-fork de main.py
+    # (hilos de outbox y retención). forkserver/spawn arrancan un intérprete limpio que importa
+    # password_hash_worker (con `python main.py` también re-importa main.py como __mp_main__,
+    # donde los hilos de fondo no arrancan).
+    metodos = multiprocessing.get_all_start_methods()
+    if 'forkserver' in metodos:
+        contexto = multiprocessing.get_context('forkserver')
+        contexto.set_forkserver_preload(['password_hash_worker'])
+        return contexto
+    return multiprocessing.get_context('spawn')
+
+
+class PasswordPool:
+    """Pool de procesos acotado de este worker (se crea al primer uso, uno por pid)"""
+
+    def __init__(self, workers=None, max_pending=None, timeout=None, metodo=None):
+        self.workers = WORKERS if workers is None else workers
+        self.max_pending = MAX_PENDING if max_pending is None else max_pending
+        self.timeout = TIMEOUT_SECONDS if timeout is None else timeout
+        self.metodo = metodo or METODO
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._cupos = threading.BoundedSemaphore(max(self.workers, 1) + self.max_pending)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Tras un fork el executor del padre no sirve; el nuevo proceso arma el suyo
+                self._executor = None
+                self._cupos = threading.BoundedSemaphore(max(self.workers, 1) + self.max_pending)
+                self._pid = os.getpid()
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=_contexto())
+            return self._executor
+
+    def _ejecutar(self, fn, *args):
+        if self.workers <= 0:
+            if not self._cupos.acquire(blocking=False):
+                raise PoolSaturado()
+            try:
+                return fn(*args)
+            finally:
+                self._cupos.release()
+        executor = self._get_executor()
+        cupos = self._cupos
+        if not cupos.acquire(blocking=False):
+            raise PoolSaturado()
+        try:
+            futuro = executor.submit(fn, *args)
+        except BaseException:
+            cupos.release()
+            raise
+        # El cupo se libera cuando el trabajo termina, aunque la petición ya no lo espere
+        futuro.add_done_callback(lambda _: cupos.release())
+        try:
+            return futuro.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise PoolSaturado() from None
+        except BrokenProcessPool:
+            log.error("El pool de contraseñas se rompió (proceso hijo terminado); se recrea")
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            raise PoolSaturado() from None
+
+    def hash(self, password):
+        """Hash nuevo con PASSWORD_HASH_METHOD"""
+        return self._ejecutar(password_hash_worker.hashear, password, self.metodo)
+
+    def verificar(self, pwd_hash, password):
+        """(ok, hash_nuevo). hash_nuevo != None -> guardar en lugar del actual (rehash transparente)"""
+        if not pwd_hash:
+            return False, None
+        return self._ejecutar(password_hash_worker.verificar, pwd_hash, password, self.metodo)
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class TokenBucket:
+    """Token bucket por clave en memoria, acotado a max_claves (las menos usadas se descartan)"""
+
+    def __init__(self, capacidad, ventana_seconds, max_claves=10000):
+        self.capacidad = capacidad
+        self.recarga = capacidad / ventana_seconds if ventana_seconds > 0 else float('inf')
+        self.max_claves = max_claves
+        self._claves = OrderedDict()  # clave -> (tokens, instante)
+        self._lock = threading.Lock()
+
+    def consumir(self, clave):
+        """0 si hay token (y lo consume); si no, segundos hasta el próximo"""
+        if self.capacidad <= 0 or not clave:
+            return 0
+        ahora = time.monotonic()
+        with self._lock:
+            tokens, antes = self._claves.pop(clave, (self.capacidad, ahora))
+            tokens = min(self.capacidad, tokens + (ahora - antes) * self.recarga)
+            if tokens >= 1:
+                tokens -= 1
+                espera = 0
+            else:
+                espera = (1 - tokens) / self.recarga
+            self._claves[clave] = (tokens, ahora)
+            if len(self._claves) > self.max_claves:
+                self._claves.popitem(last=False)
+            return espera
@@ -0,0 +1,180 @@
+"""
+Perfilado de SQL por petición.
+
+Escucha before_cursor_execute / after_cursor_execute del engine de SQLAlchemy y, para cada
+petición HTTP, acumula número de sentencias, tiempo total en la base y cuántas veces se
+ejecutó cada huella (la sentencia normalizada, sin literales ni parámetros).
+
+  - Sentencias que superan SLOW_QUERY_MS van al log 'tindo.sql' como WARNING junto con su
+    EXPLAIN QUERY PLAN (se captura una vez por huella y proceso).
+  - Al terminar la petición, cada huella repetida N_PLUS_ONE_THRESHOLD veces o más se
+    reporta como posible N+1 indicando el endpoint.
+  - Con QUERY_PROFILE_HEADERS=1 las respuestas llevan X-DB-Queries y Server-Timing.
+
+metrics.py toma de aquí el tiempo en DB de cada petición.
+"""
+import os
+import re
+import logging
+import time
+import threading
+from functools import lru_cache
+
+from flask import request
+
+import app_logging
+
+log = app_logging.get_logger('sql')
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', '5'))
+PROFILE_HEADERS = os.environ.get('QUERY_PROFILE_HEADERS', '0') == '1'
+
+# Máximo de planes guardados por proceso (uno por huella lenta)
+_MAX_PLANES = 256
+
+_RE_COMENTARIOS = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+_RE_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_RE_NUMEROS = re.compile(r'\b\d+(?:\.\d+)?\b')
+_RE_PARAMS = re.compile(r'\?|(?<!:):\w+')
+_RE_LISTAS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_RE_ESPACIOS = re.compile(r'\s+')
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(statement):
+    """SELECT * FROM t WHERE id = 5 AND x IN (1, 2) -> SELECT * FROM t WHERE id = ? AND x IN (?+)"""
+    s = _RE_COMENTARIOS.sub(' ', statement)
+    s = _RE_STRINGS.sub('?', s)
+    s = _RE_NUMEROS.sub('?', s)
+    s = _RE_PARAMS.sub('?', s)
+    s = _RE_LISTAS.sub('(?+)', s)
+    return _RE_ESPACIOS.sub(' ', s).strip()
+
+
+class RequestProfile:
+    """Sentencias ejecutadas durante una petición"""
+    __slots__ = ('count', 'segundos', 'huellas')
+
+    def __init__(self):
+        self.count = 0
+        self.segundos = 0.0
+        self.huellas = {}  # huella -> [veces, segundos]
+
+    def registrar(self, huella, segundos):
+        self.count += 1
+        self.segundos += segundos
+        actual = self.huellas.get(huella)
+        if actual is None:
+            self.huellas[huella] = [1, segundos]
+        else:
+            actual[0] += 1
+            actual[1] += segundos
+
+    def repetidas(self, umbral=None):
+        """[(huella, veces, segundos)] ejecutadas umbral veces o más, de mayor a menor"""
+        umbral = umbral or N_PLUS_ONE_THRESHOLD
+        return sorted(((h, v, s) for h, (v, s) in self.huellas.items() if v >= umbral),
+                      key=lambda x: x[1], reverse=True)
+
+
+_local = threading.local()
+_planes = {}
+_planes_lock = threading.Lock()
+
+
+def begin():
+    _local.profile = RequestProfile()
+    return _local.profile
+
+
+def current():
+    """Perfil de la petición en curso en este hilo (None fuera de una petición)"""
+    return getattr(_local, 'profile', None)
+
+
+def finish():
+    profile = current()
+    _local.profile = None
+    return profile
+
+
+def _explain(cursor, statement, parameters):
+    try:
+        filas = cursor.connection.execute(f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall()
+        return ' | '.join(str(fila[-1]) for fila in filas)
+    except Exception as e:
+        return f'(sin plan: {e})'
+
+
+def _plan_para(huella, cursor, statement, parameters, executemany):
+    plan = _planes.get(huella)
+    if plan is not None or executemany:
+        return plan
+    if not statement.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')):
+        return None
+    plan = _explain(cursor, statement, parameters)
+    with _planes_lock:
+        if len(_planes) < _MAX_PLANES:
+            _planes[huella] = plan
+    return plan
+
+
+def instrument_engine(engine):
+    """Registra los eventos de cursor en el engine"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _antes(conn, cursor, statement, parameters, context, executemany):
+        _local.inicio = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _despues(conn, cursor, statement, parameters, context, executemany):
+        inicio = getattr(_local, 'inicio', None)
+        if inicio is None:
+            return
+        _local.inicio = None
+        segundos = time.perf_counter() - inicio
+        huella = fingerprint(statement)
+        profile = current()
+        if profile is not None:
+            profile.registrar(huella, segundos)
+        if SLOW_QUERY_MS > 0 and segundos * 1000 >= SLOW_QUERY_MS:
+            log.warning("Consulta lenta (%.1f ms) [%s]: %s | plan: %s",
+                        segundos * 1000, _endpoint_actual(), huella,
+                        _plan_para(huella, cursor, statement, parameters, executemany))
+
+
+def _endpoint_actual():
+    try:
+        return request.endpoint or request.path
+    except RuntimeError:
+        return 'fuera de petición'
+
+
+def init_app(app):
+    """Abre y cierra el perfil de cada petición y reporta N+1"""
+
+    @app.before_request
+    def _profiler_inicio():
+        begin()
+
+    @app.after_request
+    def _profiler_fin(response):
+        profile = current()
+        if profile is None:
+            return response
+        for huella, veces, segundos in profile.repetidas():
+            log.warning("Posible N+1 en %s: %d ejecuciones (%.1f ms) de %s",
+                        request.endpoint, veces, segundos * 1000, huella)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s %s: %d sentencias, %.1f ms en DB", request.method, request.path,
+                      profile.count, profile.segundos * 1000)
+        if PROFILE_HEADERS:
+            response.headers['X-DB-Queries'] = str(profile.count)
+            response.headers['Server-Timing'] = f'db;dur={profile.segundos * 1000:.1f};desc="{profile.count} queries"'
+        return response
+
+    @app.teardown_request
+    def _profiler_teardown(exc):
+        finish()
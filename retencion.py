@@ -0,0 +1,246 @@
+"""
+Retención y archivo de órdenes, fuera del camino de la petición.
+
+Las órdenes viejas no se borran: se mueven por lotes de la tabla caliente ordenes a
+ordenes_archivo (mismas columnas + fecha de archivado). Así el historial por usuario y los
+listados del panel siguen rápidos sin perder el historial de ventas.
+
+Se archivan solo órdenes cerradas ('procesado' o 'rechazado') que cumplan alguna regla:
+  - RETENCION_ORDENES_POR_USUARIO  las que quedan fuera de las N más recientes del usuario (0 = sin límite)
+  - RETENCION_DIAS                 las más viejas que N días (0 = sin límite)
+
+Cada lote (RETENCION_LOTE filas) es una transacción corta INSERT + DELETE seguida de una pausa
+de RETENCION_PAUSA_MS, así el job nunca retiene el lock de escritura por mucho tiempo.
+
+El mismo job borra las Idempotency-Key de POST /orden con más de IDEMPOTENCIA_TTL_HORAS y
+las sesiones vencidas (sesiones.py).
+
+Un hilo por worker corre el job cada RETENCION_INTERVALO_SECONDS; un lock de archivo evita
+que dos workers lo corran a la vez. create_orden marca al usuario para recortarlo en la
+siguiente vuelta y cada RETENCION_BARRIDO_HORAS se revisan todos los usuarios.
+
+Uso manual o desde cron:
+  python retencion.py [--db ruta]
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import bindparam, text
+
+import app_logging
+
+try:
+    import fcntl
+except ImportError:  # Windows (desarrollo local)
+    fcntl = None
+
+log = app_logging.get_logger('retencion')
+
+ORDENES_POR_USUARIO = int(os.environ.get('RETENCION_ORDENES_POR_USUARIO', '40'))
+DIAS = int(os.environ.get('RETENCION_DIAS', '0'))
+LOTE = int(os.environ.get('RETENCION_LOTE', '200'))
+PAUSA_SECONDS = float(os.environ.get('RETENCION_PAUSA_MS', '50')) / 1000
+INTERVALO_SECONDS = float(os.environ.get('RETENCION_INTERVALO_SECONDS', '300'))
+BARRIDO_SECONDS = float(os.environ.get('RETENCION_BARRIDO_HORAS', '24')) * 3600
+IDEMPOTENCIA_TTL_HORAS = int(os.environ.get('IDEMPOTENCIA_TTL_HORAS', '24'))
+
+ESTADOS_ARCHIVABLES = ('procesado', 'rechazado')
+COLUMNAS = ('id, juego_id, paquete, monto, usuario_email, usuario_id, usuario_telefono, '
+            'metodo_pago, referencia_pago, codigo_producto, estado, fecha')
+
+SQL_ARCHIVAR = text(f'''
+    INSERT OR IGNORE INTO ordenes_archivo ({COLUMNAS})
+    SELECT {COLUMNAS} FROM ordenes WHERE id IN :ids
+''').bindparams(bindparam('ids', expanding=True))
+SQL_BORRAR = text('DELETE FROM ordenes WHERE id IN :ids').bindparams(bindparam('ids', expanding=True))
+
+# Órdenes cerradas anteriores a la N-ésima más reciente del usuario; si tiene N o menos la
+# subconsulta no devuelve fila, la comparación da NULL y no se elige nada.
+SQL_EXCEDENTES_USUARIO = text('''
+    SELECT id FROM ordenes
+    WHERE usuario_email = :email
+      AND estado IN ('procesado', 'rechazado')
+      AND (fecha, id) < (
+          SELECT fecha, id FROM ordenes
+          WHERE usuario_email = :email
+          ORDER BY fecha DESC, id DESC
+          LIMIT 1 OFFSET :offset
+      )
+    ORDER BY fecha, id
+    LIMIT :lote
+''')
+SQL_VENCIDAS = text('''
+    SELECT id FROM ordenes
+    WHERE estado IN ('procesado', 'rechazado') AND fecha < datetime('now', :dias)
+    ORDER BY fecha
+    LIMIT :lote
+''')
+SQL_PURGAR_IDEMPOTENCIA = text('''
+    DELETE FROM idempotencia WHERE rowid IN (
+        SELECT rowid FROM idempotencia WHERE creado < datetime('now', :ttl) LIMIT :lote
+    )
+''')
+SQL_PURGAR_SESIONES = text('''
+    DELETE FROM sesiones WHERE rowid IN (
+        SELECT rowid FROM sesiones WHERE expira < :ahora LIMIT :lote
+    )
+''')
+SQL_USUARIOS_EXCEDIDOS = text('''
+    SELECT usuario_email FROM ordenes
+    GROUP BY usuario_email
+    HAVING COUNT(*) > :limite
+''')
+
+
+@contextmanager
+def _lock_job(lock_path):
+    """Lock de archivo no bloqueante: si otro proceso ya corre el job, devuelve False"""
+    if not lock_path or fcntl is None:
+        yield True
+        return
+    with open(lock_path, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class RetencionWorker:
+    """Job de retención de este proceso"""
+
+    def __init__(self, get_connection, lock_path=None, limite=None, dias=None):
+        self._get_connection = get_connection
+        self._lock_path = lock_path
+        self.limite = ORDENES_POR_USUARIO if limite is None else limite
+        self.dias = DIAS if dias is None else dias
+        self._pendientes = set()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._ultimo_barrido = 0.0
+
+    def start(self):
+        """Arranca el hilo una vez por proceso (también en cada worker tras un fork)"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._pendientes = set()
+            threading.Thread(target=self._loop, name='retencion', daemon=True).start()
+
+    def marcar(self, email):
+        """Anota que el usuario creó una orden; no toca la base"""
+        with self._lock:
+            self._pendientes.add(email)
+
+    def _loop(self):
+        while True:
+            time.sleep(INTERVALO_SECONDS)
+            try:
+                self.ejecutar()
+            except Exception as e:
+                log.exception("Error en el job de retención de órdenes: %s", e)
+
+    def ejecutar(self, barrido=None):
+        """Una pasada del job. Devuelve cuántas órdenes archivó (None si otro proceso lo está corriendo)."""
+        with self._lock:
+            emails, self._pendientes = self._pendientes, set()
+        if barrido is None:
+            barrido = time.monotonic() - self._ultimo_barrido >= BARRIDO_SECONDS
+        with _lock_job(self._lock_path) as adquirido:
+            if not adquirido:
+                with self._lock:
+                    self._pendientes |= emails
+                return None
+            archivadas = 0
+            conn = self._get_connection()
+            try:
+                if self.limite > 0:
+                    if barrido:
+                        emails |= {fila[0] for fila in conn.execute(SQL_USUARIOS_EXCEDIDOS, {'limite': self.limite})}
+                        conn.commit()
+                        self._ultimo_barrido = time.monotonic()
+                    for email in emails:
+                        archivadas += self._archivar_mientras(conn, SQL_EXCEDENTES_USUARIO,
+                                                              {'email': email, 'offset': self.limite - 1})
+                if self.dias > 0:
+                    archivadas += self._archivar_mientras(conn, SQL_VENCIDAS, {'dias': f'-{self.dias} days'})
+                self._purgar_idempotencia(conn)
+                self._purgar_sesiones(conn)
+            except Exception:
+                conn.rollback()
+                with self._lock:
+                    self._pendientes |= emails
+                raise
+            finally:
+                conn.close()
+        if archivadas:
+            log.info("Retención: %d órdenes archivadas", archivadas)
+        return archivadas
+
+    def _purgar_idempotencia(self, conn):
+        while True:
+            borradas = conn.execute(SQL_PURGAR_IDEMPOTENCIA,
+                                    {'ttl': f'-{IDEMPOTENCIA_TTL_HORAS} hours', 'lote': LOTE}).rowcount
+            conn.commit()
+            if borradas < LOTE:
+                return
+            time.sleep(PAUSA_SECONDS)
+
+    def _purgar_sesiones(self, conn):
+        while True:
+            borradas = conn.execute(SQL_PURGAR_SESIONES, {'ahora': time.time(), 'lote': LOTE}).rowcount
+            conn.commit()
+            if borradas < LOTE:
+                return
+            time.sleep(PAUSA_SECONDS)
+
+    def _archivar_mientras(self, conn, consulta, params):
+        """Archiva por lotes las órdenes que devuelve consulta hasta agotarlas"""
+        total = 0
+        while True:
+            ids = [fila[0] for fila in conn.execute(consulta, dict(params, lote=LOTE))]
+            if not ids:
+                return total
+            conn.execute(SQL_ARCHIVAR, {'ids': ids})
+            total += conn.execute(SQL_BORRAR, {'ids': ids}).rowcount
+            conn.commit()
+            if len(ids) < LOTE:
+                return total
+            # Dejar pasar a las escrituras de las peticiones entre lote y lote
+            time.sleep(PAUSA_SECONDS)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Archivar órdenes antiguas en ordenes_archivo')
+    parser.add_argument('--db', dest='db_path', default=None, help='Ruta de la base SQLite. Por defecto DATABASE_PATH o inefablestore.db')
+    args = parser.parse_args(argv)
+
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+    app_logging.configure_logging()
+
+    from sqlalchemy import create_engine
+    db_path = args.db_path or os.environ.get('DATABASE_PATH', 'inefablestore.db')
+    engine = create_engine(f'sqlite:///{db_path}', connect_args={'timeout': 30})
+    archivadas = RetencionWorker(engine.connect, lock_path=f'{db_path}.retencion.lock').ejecutar(barrido=True)
+    if archivadas is None:
+        print("⏳ Otro proceso está corriendo la retención, no se hizo nada")
+        return 1
+    print(f"✅ {archivadas} orden(es) archivada(s)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
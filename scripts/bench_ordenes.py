@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Benchmark POST /orden under concurrent checkout.
+
+Creates a throwaway database (all migrations applied), registers --users
+customers, logs each one in with its own Flask test client and has --threads
+threads place --orders orders in total. Reports orders/sec, latency
+percentiles and the number of SQL statements per order (X-DB-Queries).
+
+The outbox and retention background threads and the per-IP login throttle
+are disabled so the numbers only cover the request path.
+
+Usage examples:
+  python scripts/bench_ordenes.py
+  python scripts/bench_ordenes.py --orders 2000 --threads 8 --users 50
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure POST /orden throughput with concurrent clients')
+    parser.add_argument('--orders', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--db', help='database path (default: new temporary file)')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_PATH'] = args.db or os.path.join(tempfile.mkdtemp(prefix='bench-ordenes-'), 'bench.db')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('SMTP_FROM', 'tienda@example.com')
+    os.environ['OUTBOX_WORKER'] = '0'
+    os.environ['RETENCION_WORKER'] = '0'
+    # Every client logs in from the same address; do not let the login throttle get in the way
+    os.environ['LOGIN_INTENTOS_POR_IP'] = '0'
+    os.environ['QUERY_PROFILE_HEADERS'] = '1'
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    sys.path.insert(0, root)
+    os.chdir(root)
+    import main as app_main  # noqa: E402
+
+    app = app_main.app
+    productos = app.test_client().get('/productos').get_json() or []
+    juego_id = productos[0]['id'] if productos else 1
+
+    clients = []
+    for i in range(args.users):
+        client = app.test_client()
+        email = f'bench{i}@example.com'
+        client.post('/registro', json={'nombre': f'Bench {i}', 'email': email, 'telefono': '555', 'password': 'bench'})
+        r = client.post('/login', json={'email': email, 'password': 'bench'})
+        if r.status_code != 200:
+            print(f'login failed for {email}: {r.status_code} {r.get_data(as_text=True)[:200]}')
+            return 1
+        clients.append((client, threading.Lock()))
+
+    latencies = []
+    queries = []
+    errors = []
+    lock = threading.Lock()
+
+    def place(n):
+        client, client_lock = clients[n % len(clients)]
+        body = {'juego_id': juego_id, 'paquete': 'Bench', 'monto': 1.0, 'usuario_id': str(n),
+                'metodo_pago': 'bench', 'referencia_pago': f'B{n}'}
+        # A test client keeps a cookie jar: one request at a time per client
+        with client_lock:
+            start = time.perf_counter()
+            r = client.post('/orden', json=body)
+            elapsed = time.perf_counter() - start
+        with lock:
+            if r.status_code == 200:
+                latencies.append(elapsed)
+                queries.append(int(r.headers.get('X-DB-Queries', 0)))
+            else:
+                errors.append(r.status_code)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(place, range(args.orders)))
+    total = time.perf_counter() - start
+
+    print(f'{len(latencies)} orders in {total:.2f}s with {args.threads} threads, {args.users} users')
+    print(f'  throughput: {len(latencies) / total:8.1f} orders/s')
+    print(f'  latency:    p50 {percentile(latencies, 50) * 1000:.1f} ms, '
+          f'p95 {percentile(latencies, 95) * 1000:.1f} ms, p99 {percentile(latencies, 99) * 1000:.1f} ms')
+    if queries:
+        print(f'  SQL per order: {sum(queries) / len(queries):.1f}')
+    if errors:
+        print(f'  errors: {len(errors)} (status codes: {sorted(set(errors))})')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Check that the app's hot SQL queries are served by indexes.
+
+Runs EXPLAIN QUERY PLAN for each query in HOT_QUERIES and fails (exit code 1)
+if any of them does a full table scan on a table that is not explicitly
+allowed for that query (e.g. the whole catalog in /productos).
+
+Usage examples:
+  - Fresh temporary database with all migrations applied (default, for CI):
+      python scripts/check_query_plans.py
+  - Check an existing database as-is:
+      python scripts/check_query_plans.py --db /path/to/inefablestore.db
+"""
+import os
+import sys
+import sqlite3
+import argparse
+import tempfile
+from typing import Dict, List, NamedTuple, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import migrations  # noqa: E402
+
+
+class HotQuery(NamedTuple):
+    name: str
+    sql: str
+    params: Dict
+    allow_scan: Tuple[str, ...] = ()
+
+
+# Keep these in sync with the queries in main.py (and retencion.py / outbox.py)
+HOT_QUERIES: List[HotQuery] = [
+    HotQuery('retencion (excedentes por usuario)', '''
+        SELECT id FROM ordenes
+        WHERE usuario_email = :email
+          AND estado IN ('procesado', 'rechazado')
+          AND (fecha, id) < (
+              SELECT fecha, id FROM ordenes
+              WHERE usuario_email = :email
+              ORDER BY fecha DESC, id DESC
+              LIMIT 1 OFFSET :offset
+          )
+        ORDER BY fecha, id
+        LIMIT :lote
+    ''', {'email': 'a@b.c', 'offset': 39, 'lote': 200}),
+    HotQuery('retencion (vencidas)', '''
+        SELECT id FROM ordenes
+        WHERE estado IN ('procesado', 'rechazado') AND fecha < datetime('now', :dias)
+        ORDER BY fecha
+        LIMIT :lote
+    ''', {'dias': '-365 days', 'lote': 200}),
+    HotQuery('create_orden (insert returning)', '''
+        INSERT INTO ordenes (juego_id, paquete, monto, usuario_email, usuario_id, usuario_telefono, metodo_pago, referencia_pago, estado, fecha)
+        VALUES (:juego_id, :paquete, :monto, :usuario_email, :usuario_id, :usuario_telefono, :metodo_pago, :referencia_pago, 'procesando', datetime('now'))
+        RETURNING *
+    ''', {'juego_id': 1, 'paquete': 'p', 'monto': 1, 'usuario_email': 'a@b.c', 'usuario_id': '1',
+          'usuario_telefono': None, 'metodo_pago': 'pm', 'referencia_pago': 'r'}),
+    HotQuery('get_historial_compras (página con cursor y estado)', '''
+        SELECT id, fecha FROM ordenes
+        WHERE usuario_email = :email AND (fecha, id) < (:cursor_fecha, :cursor_id) AND +estado = :estado
+        UNION ALL
+        SELECT id, fecha FROM ordenes_archivo
+        WHERE usuario_email = :email AND (fecha, id) < (:cursor_fecha, :cursor_id) AND +estado = :estado
+        ORDER BY fecha DESC, id DESC
+        LIMIT :limit
+    ''', {'email': 'a@b.c', 'cursor_fecha': '2030-01-01', 'cursor_id': 1, 'estado': 'procesado', 'limit': 21}),
+    HotQuery('sesiones (leer sesión)', '''
+        SELECT datos, expira FROM sesiones WHERE id = :id AND expira > :ahora
+    ''', {'id': 'x', 'ahora': 0}),
+    HotQuery('retencion (sesiones vencidas)', '''
+        SELECT rowid FROM sesiones WHERE expira < :ahora LIMIT :lote
+    ''', {'ahora': 0, 'lote': 200}),
+    HotQuery('create_orden (idempotency key)', '''
+        SELECT orden_id FROM idempotencia
+        WHERE usuario_email = :email AND clave = :clave AND creado >= datetime('now', :ttl)
+    ''', {'email': 'a@b.c', 'clave': 'k', 'ttl': '-24 hours'}),
+    HotQuery('create_orden (conflicto de referencia de pago)', '''
+        SELECT id, usuario_email FROM ordenes
+        WHERE metodo_pago = :metodo_pago AND referencia_pago = :referencia_pago
+          AND juego_id = :juego_id AND paquete = :paquete AND usuario_id = :usuario_id
+          AND referencia_pago IS NOT NULL AND referencia_pago <> ''
+          AND estado <> 'rechazado' AND pago_duplicado = 0
+    ''', {'metodo_pago': 'pm', 'referencia_pago': 'r', 'juego_id': 1, 'paquete': 'p', 'usuario_id': '1'}),
+    HotQuery('crear_valoracion / get_valoracion_usuario (compras)', '''
+        SELECT EXISTS (
+            SELECT 1 FROM ordenes
+            WHERE juego_id = :juego_id AND usuario_email = :usuario_email AND estado = 'procesado'
+        ) OR EXISTS (
+            SELECT 1 FROM ordenes_archivo
+            WHERE juego_id = :juego_id AND usuario_email = :usuario_email AND estado = 'procesado'
+        )
+    ''', {'juego_id': 1, 'usuario_email': 'a@b.c'}),
+    HotQuery('get_valoracion_usuario', '''
+        SELECT * FROM valoraciones
+        WHERE juego_id = :juego_id AND usuario_email = :usuario_email
+    ''', {'juego_id': 1, 'usuario_email': 'a@b.c'}),
+    HotQuery('get_valoraciones_producto (recientes, siguiente página)', '''
+        SELECT id, juego_id, calificacion, comentario, fecha, autor AS usuario_nombre
+        FROM valoraciones
+        WHERE juego_id = :juego_id AND (fecha, id) < (:cursor_fecha, :cursor_id)
+        ORDER BY fecha DESC, id DESC
+        LIMIT :limit
+    ''', {'juego_id': 1, 'cursor_fecha': '2030-01-01', 'cursor_id': 1, 'limit': 11}),
+    HotQuery('get_valoraciones_producto (mayor calificación, siguiente página)', '''
+        SELECT id, juego_id, calificacion, comentario, fecha, autor AS usuario_nombre
+        FROM valoraciones
+        WHERE juego_id = :juego_id
+          AND (calificacion, fecha, id) < (:cursor_calificacion, :cursor_fecha, :cursor_id)
+        ORDER BY calificacion DESC, fecha DESC, id DESC
+        LIMIT :limit
+    ''', {'juego_id': 1, 'cursor_calificacion': 3, 'cursor_fecha': '2030-01-01', 'cursor_id': 1, 'limit': 11}),
+    HotQuery('get_valoraciones_producto (menor calificación, siguiente página)', '''
+        SELECT id, juego_id, calificacion, comentario, fecha, autor AS usuario_nombre
+        FROM valoraciones
+        WHERE juego_id = :juego_id
+          AND (calificacion > :cursor_calificacion OR (calificacion = :cursor_calificacion
+               AND (fecha, id) < (:cursor_fecha, :cursor_id)))
+        ORDER BY calificacion ASC, fecha DESC, id DESC
+        LIMIT :limit
+    ''', {'juego_id': 1, 'cursor_calificacion': 3, 'cursor_fecha': '2030-01-01', 'cursor_id': 1, 'limit': 11}),
+    HotQuery('get_valoraciones_producto (estadisticas)', '''
+        SELECT total, suma, estrellas_1, estrellas_2, estrellas_3, estrellas_4, estrellas_5
+        FROM valoraciones_resumen
+        WHERE juego_id = :juego_id
+    ''', {'juego_id': 1}),
+    HotQuery('get_ordenes (siguiente página)', '''
+        SELECT o.*, j.nombre as juego_nombre, j.categoria
+        FROM ordenes o
+        LEFT JOIN juegos j ON o.juego_id = j.id
+        WHERE (o.fecha, o.id) < (:cursor_fecha, :cursor_id)
+        ORDER BY o.fecha DESC, o.id DESC
+        LIMIT :limit
+    ''', {'cursor_fecha': '2025-01-01 00:00:00', 'cursor_id': 10, 'limit': 51}),
+    HotQuery('get_ordenes (por estado)', '''
+        SELECT o.*, j.nombre as juego_nombre, j.categoria
+        FROM ordenes o
+        LEFT JOIN juegos j ON o.juego_id = j.id
+        WHERE o.estado = :estado
+        ORDER BY o.fecha DESC, o.id DESC
+        LIMIT :limit
+    ''', {'estado': 'procesando', 'limit': 51}),
+    HotQuery('get_ordenes (por producto)', '''
+        SELECT o.*, j.nombre as juego_nombre, j.categoria
+        FROM ordenes o
+        LEFT JOIN juegos j ON o.juego_id = j.id
+        WHERE o.juego_id = :juego_id
+        ORDER BY o.fecha DESC, o.id DESC
+        LIMIT :limit
+    ''', {'juego_id': 1, 'limit': 51}),
+    HotQuery('update_orden / rechazar_orden', '''
+        SELECT o.*, j.nombre as juego_nombre, j.categoria
+        FROM ordenes o
+        LEFT JOIN juegos j ON o.juego_id = j.id
+        WHERE o.id = :orden_id
+    ''', {'orden_id': 1}),
+    HotQuery('update_producto / delete_producto', '''
+        SELECT id FROM juegos WHERE id = :pid
+    ''', {'pid': 1}),
+    HotQuery('get_productos_publico', '''
+        SELECT
+            j.id, j.nombre, j.descripcion, j.imagen, j.categoria, j.orden, j.etiquetas,
+            p.id as paquete_id, p.nombre as paquete_nombre, p.precio, p.orden as paquete_orden, p.imagen as paquete_imagen,
+            ROUND(CAST(v.suma AS REAL) / NULLIF(v.total, 0), 1) as promedio_valoracion,
+            NULLIF(v.total, 0) as total_valoraciones
+        FROM juegos j
+        LEFT JOIN paquetes p ON p.juego_id = j.id
+        LEFT JOIN valoraciones_resumen v ON v.juego_id = j.id
+        ORDER BY j.orden ASC, j.id ASC, p.orden ASC, p.precio ASC
+    ''', {}, allow_scan=('j',)),
+    HotQuery('get_productos (admin)', '''
+        SELECT
+            j.id, j.nombre, j.descripcion, j.imagen, j.categoria, j.orden, j.etiquetas,
+            p.id as paquete_id, p.nombre as paquete_nombre, p.precio, p.orden as paquete_orden, p.imagen as paquete_imagen
+        FROM juegos j
+        LEFT JOIN paquetes p ON p.juego_id = j.id
+        WHERE j.categoria = :categoria
+        ORDER BY j.orden ASC, j.id ASC, p.orden ASC, p.id ASC
+    ''', {'categoria': 'juegos'}, allow_scan=('j',)),
+    HotQuery('outbox (reclamar lote)', '''
+        SELECT id FROM outbox
+        WHERE (estado = 'pendiente' AND proximo_intento <= datetime('now'))
+           OR (estado = 'enviando' AND bloqueado_hasta <= datetime('now'))
+        ORDER BY id
+        LIMIT :lote
+    ''', {'lote': 20}),
+]
+
+INDEXED_MARKERS = ('USING INDEX', 'USING COVERING INDEX', 'USING INTEGER PRIMARY KEY', 'USING PRIMARY KEY')
+
+
+def full_scans(plan_rows: List[Tuple]) -> List[str]:
+    """Plan lines that scan a whole table without an index."""
+    scans = []
+    for row in plan_rows:
+        detail = row[-1]
+        if detail.startswith('SCAN ') and not any(m in detail for m in INDEXED_MARKERS):
+            if detail.startswith('SCAN CONSTANT ROW'):
+                continue
+            scans.append(detail)
+    return scans
+
+
+def scanned_table(detail: str) -> str:
+    # 'SCAN o' / 'SCAN ordenes' -> 'o' / 'ordenes'
+    return detail.split()[1]
+
+
+def check(conn: sqlite3.Connection) -> int:
+    failures = 0
+    for q in HOT_QUERIES:
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {q.sql}", q.params).fetchall()
+        bad = [d for d in full_scans(plan) if scanned_table(d) not in q.allow_scan]
+        status = 'FAIL' if bad else 'OK'
+        print(f"[{status:4}] {q.name}")
+        for row in plan:
+            print(f"         {row[-1]}")
+        if bad:
+            failures += 1
+    return failures
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Fail if a hot query falls back to a full table scan")
+    parser.add_argument("--db", dest="db_path", default=None, help="Existing SQLite database to check. Defaults to a fresh temporary database with all migrations applied")
+    args = parser.parse_args()
+
+    tmpdir = None
+    db_path = args.db_path
+    if not db_path:
+        tmpdir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(tmpdir.name, 'plans.db')
+        migrations.migrate(db_path, sync_admin=False)
+
+    print("=== Query plan check ===")
+    print(f"Database: {db_path}\n")
+    conn = sqlite3.connect(db_path)
+    try:
+        failures = check(conn)
+    finally:
+        conn.close()
+        if tmpdir is not None:
+            tmpdir.cleanup()
+
+    print(f"\n{len(HOT_QUERIES) - failures}/{len(HOT_QUERIES)} hot queries use indexes")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
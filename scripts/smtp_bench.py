@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Benchmark the SMTP pool against a local sink server.
+
+Starts an in-process SMTP sink on 127.0.0.1 (aiosmtpd if installed and
+requested, otherwise a small built-in threaded sink; the stdlib smtpd module
+is deprecated and gone in Python 3.12), then sends the same number of messages:
+
+  - per-message: a new connection + AUTH for every message (the old behavior)
+  - pool: smtp_pool.SmtpPool.send_batch, one batch per thread
+
+and reports messages per second for each mode. --handshake-ms adds a delay to
+the greeting and to AUTH in the built-in sink to emulate TLS/network setup.
+
+Usage examples:
+  python scripts/smtp_bench.py
+  python scripts/smtp_bench.py --messages 500 --threads 4 --handshake-ms 50
+  python scripts/smtp_bench.py --sink aiosmtpd
+"""
+import os
+import sys
+import time
+import base64
+import smtplib
+import argparse
+import threading
+import socketserver
+from email.message import EmailMessage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+import app_logging  # noqa: E402
+import smtp_pool  # noqa: E402
+
+USER = 'bench@example.com'
+PASSWORD = 'bench'
+
+
+class SinkStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+
+    def add(self, connections=0, messages=0):
+        with self.lock:
+            self.connections += connections
+            self.messages += messages
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP server: accepts everything and discards the message data"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        server.stats.add(connections=1)
+        time.sleep(server.handshake)
+        self.reply('220 localhost smtp-bench sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self.wfile.write(b'250-localhost\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n')
+                self.wfile.flush()
+            elif verb == 'HELO':
+                self.reply('250 localhost')
+            elif verb == 'AUTH':
+                parts = command.split()
+                if len(parts) == 2 and parts[1].upper() == 'PLAIN':
+                    self.reply('334 ')
+                    self.rfile.readline()
+                elif len(parts) >= 2 and parts[1].upper() == 'LOGIN':
+                    if len(parts) == 2:
+                        self.reply('334 ' + base64.b64encode(b'Username:').decode())
+                        self.rfile.readline()
+                    self.reply('334 ' + base64.b64encode(b'Password:').decode())
+                    self.rfile.readline()
+                time.sleep(server.handshake)
+                self.reply('235 2.7.0 Authentication successful')
+            elif verb in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data in (b'.\r\n', b'.\n'):
+                        break
+                server.stats.add(messages=1)
+                self.reply('250 OK queued')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SinkServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handshake):
+        super().__init__(('127.0.0.1', 0), SinkHandler)
+        self.handshake = handshake
+        self.stats = SinkStats()
+
+
+def start_builtin_sink(handshake):
+    server = SinkServer(handshake)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1], server.stats, server.shutdown
+
+
+def start_aiosmtpd_sink():
+    from aiosmtpd.controller import Controller
+
+    stats = SinkStats()
+
+    class Handler:
+        async def handle_DATA(self, server, session, envelope):
+            stats.add(messages=1)
+            return '250 OK queued'
+
+    controller = Controller(Handler(), hostname='127.0.0.1', port=0)
+    controller.start()
+    return controller.port, stats, controller.stop
+
+
+def build_messages(n):
+    messages = []
+    for i in range(n):
+        msg = EmailMessage()
+        msg['Subject'] = f'Bench #{i}'
+        msg['From'] = USER
+        msg['To'] = f'cliente{i}@example.com'
+        msg.set_content('Tu recarga esta lista.\n' * 20)
+        messages.append(msg)
+    return messages
+
+
+def send_per_message(port, messages, with_auth):
+    for msg in messages:
+        with smtplib.SMTP('127.0.0.1', port, timeout=30) as server:
+            if with_auth:
+                server.login(USER, PASSWORD)
+            server.send_message(msg)
+
+
+def send_pooled(port, messages, threads, with_auth):
+    def config():
+        user, password = (USER, PASSWORD) if with_auth else (None, None)
+        return '127.0.0.1', port, user, password, USER, False, False
+
+    pool = smtp_pool.SmtpPool(config, size=threads, rate_per_minute=0)
+    chunks = [messages[i::threads] for i in range(threads)]
+    errors = []
+    workers = [threading.Thread(target=lambda c: errors.extend(e for e in pool.send_batch(c) if e), args=(chunk,))
+               for chunk in chunks if chunk]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    pool.close()
+    if errors:
+        raise RuntimeError(f'{len(errors)} messages failed, first: {errors[0]!r}')
+    return pool.stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure SMTP throughput: per-message connections vs the pool')
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=2, help='pool size / sender threads (OUTBOX_CONCURRENCIA)')
+    parser.add_argument('--handshake-ms', type=float, default=20.0,
+                        help='delay added to the greeting and AUTH by the built-in sink')
+    parser.add_argument('--sink', choices=('auto', 'builtin', 'aiosmtpd'), default='builtin')
+    args = parser.parse_args()
+
+    app_logging.configure_logging()
+    sink = args.sink
+    if sink == 'auto':
+        try:
+            import aiosmtpd  # noqa: F401
+            sink = 'aiosmtpd'
+        except ImportError:
+            sink = 'builtin'
+    if sink == 'aiosmtpd':
+        # aiosmtpd refuses AUTH without TLS by default, so this sink runs without login
+        port, stats, stop = start_aiosmtpd_sink()
+        with_auth = False
+    else:
+        port, stats, stop = start_builtin_sink(args.handshake_ms / 1000)
+        with_auth = True
+
+    print(f'Sink: {sink} on 127.0.0.1:{port}, {args.messages} messages, '
+          f'{args.threads} threads, handshake {args.handshake_ms:.0f} ms')
+    try:
+        results = []
+        for name, run in (
+            ('per-message', lambda msgs: send_per_message(port, msgs, with_auth)),
+            ('pool', lambda msgs: send_pooled(port, msgs, args.threads, with_auth)),
+        ):
+            messages = build_messages(args.messages)
+            before_conn, before_msgs = stats.connections, stats.messages
+            start = time.perf_counter()
+            run(messages)
+            elapsed = time.perf_counter() - start
+            received = stats.messages - before_msgs
+            if received != args.messages:
+                print(f'{name}: sink received {received}/{args.messages} messages')
+                return 1
+            results.append((name, elapsed, stats.connections - before_conn))
+        for name, elapsed, connections in results:
+            print(f'{name:>12}: {args.messages / elapsed:8.1f} msgs/s  '
+                  f'({elapsed:.2f}s, {connections} connections)')
+        if results[0][1] > 0:
+            print(f'Speedup: {results[0][1] / results[1][1]:.1f}x')
+    finally:
+        stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Regression checks for orders, reviews and migrations, run against a throwaway database.
+
+Unlike test_admin_api.py this does not need a running server: it applies all
+migrations to a temporary SQLite file and drives the app through the Flask
+test client. Each check prints ok/FAIL; the exit code is the number of
+failures.
+
+Usage:
+  python scripts/test_ordenes_api.py
+"""
+import os
+import sys
+import tempfile
+import traceback
+
+ADMIN_EMAIL = 'admin@example.com'
+ADMIN_PASSWORD = 'admin123'
+
+
+def setup():
+    os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='test-ordenes-'), 'test.db')
+    os.environ['ADMIN_EMAIL'] = ADMIN_EMAIL
+    os.environ['ADMIN_PASSWORD'] = ADMIN_PASSWORD
+    os.environ.setdefault('LOG_LEVEL', 'ERROR')
+    os.environ['OUTBOX_WORKER'] = '0'
+    os.environ['RETENCION_WORKER'] = '0'
+    os.environ['LOGIN_INTENTOS_POR_IP'] = '0'
+    # Cheap hashes: the checks are about orders, not password cost
+    os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+    os.environ['PASSWORD_POOL_WORKERS'] = '0'
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    sys.path.insert(0, root)
+    os.chdir(root)
+    import main as app_main  # noqa: E402
+    return app_main
+
+
+def login(app, email, password, registrar=True):
+    client = app.test_client()
+    if registrar:
+        client.post('/registro', json={'nombre': email.split('@')[0], 'email': email,
+                                       'telefono': '555', 'password': password})
+    r = client.post('/login', json={'email': email, 'password': password})
+    assert r.status_code == 200, (r.status_code, r.get_data(as_text=True)[:200])
+    return client
+
+
+def orden(juego_id, referencia, usuario_id='1'):
+    return {'juego_id': juego_id, 'paquete': 'Test', 'monto': 1.0, 'usuario_id': usuario_id,
+            'metodo_pago': 'binance', 'referencia_pago': referencia}
+
+
+def check_orden_producto_inexistente(ctx):
+    """POST /orden with an unknown juego_id is a 404, never the duplicate-payment 409"""
+    cliente = ctx['cliente']
+    for referencia in ('', 'REF-INEXISTENTE'):
+        r = cliente.post('/orden', json=orden(999999, referencia))
+        assert r.status_code == 404, (referencia, r.status_code, r.get_data(as_text=True)[:200])
+    r = cliente.post('/orden', json=orden('abc', 'REF-ABC'))
+    assert r.status_code == 404, (r.status_code, r.get_data(as_text=True)[:200])
+
+
+def check_orden_referencia_repetida(ctx):
+    """Same payment reference: replay for the same user, 409 for another user"""
+    juego_id = ctx['juego_id']
+    r = ctx['cliente'].post('/orden', json=orden(juego_id, 'REF-DUP'))
+    assert r.status_code == 200, (r.status_code, r.get_data(as_text=True)[:200])
+    orden_id = r.get_json()['id']
+
+    r = ctx['cliente'].post('/orden', json=orden(juego_id, 'REF-DUP'))
+    assert r.status_code == 200 and r.get_json()['id'] == orden_id, r.get_data(as_text=True)[:200]
+    assert r.headers.get('Idempotent-Replayed') == 'true'
+
+    r = ctx['otro'].post('/orden', json=orden(juego_id, 'REF-DUP'))
+    assert r.status_code == 409, (r.status_code, r.get_data(as_text=True)[:200])
+
+
+def check_paginacion_fecha_null(ctx):
+    """Orders with a NULL fecha (legacy rows) are backfilled and still reachable page by page"""
+    import migrations
+    conn = migrations.connect(os.environ['DATABASE_PATH'])
+    try:
+        # Recreate pre-migration data: the triggers of migration 013 reject a NULL fecha
+        for tabla in ('ordenes', 'ordenes_archivo', 'valoraciones'):
+            for evento in ('insert', 'update'):
+                conn.execute(f'DROP TRIGGER IF EXISTS trg_{tabla}_fecha_{evento}')
+        for n in range(3):
+            conn.execute('''
+                INSERT INTO ordenes (juego_id, paquete, monto, usuario_email, usuario_id, metodo_pago,
+                                     referencia_pago, estado, fecha)
+                VALUES (?, 'Legacy', 1.0, 'legacy@example.com', ?, 'binance', ?, 'procesado', NULL)
+            ''', (ctx['juego_id'], str(n), f'LEGACY-{n}'))
+        conn.commit()
+        migrations._m013_fecha_obligatoria(conn)
+        conn.commit()
+        assert conn.execute('SELECT COUNT(*) FROM ordenes WHERE fecha IS NULL').fetchone()[0] == 0
+        esperadas = {row[0] for row in conn.execute('SELECT id FROM ordenes')}
+        try:
+            conn.execute("UPDATE ordenes SET fecha = NULL WHERE usuario_email = 'legacy@example.com'")
+            raise AssertionError('NULL fecha accepted after migration 013')
+        except migrations.sqlite3.IntegrityError:
+            conn.rollback()
+    finally:
+        conn.close()
+
+    vistas = []
+    cursor = None
+    while True:
+        r = ctx['admin'].get('/admin/ordenes', query_string={'limit': 2, **({'cursor': cursor} if cursor else {})})
+        assert r.status_code == 200, (r.status_code, r.get_data(as_text=True)[:200])
+        vistas.extend(o['id'] for o in r.get_json())
+        cursor = r.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+    assert len(vistas) == len(set(vistas)) and set(vistas) == esperadas, (sorted(vistas), sorted(esperadas))
+
+
+def producto_comprado(ctx, nombre, clientes=('cliente',)):
+    """Creates a product and a processed order of it for each client, so they can review it"""
+    r = ctx['admin'].post('/admin/producto', json={'nombre': nombre, 'descripcion': 'test', 'categoria': 'juegos',
+                                                    'paquetes': [{'nombre': 'Test', 'precio': 1.0}]})
+    assert r.status_code == 200, (r.status_code, r.get_data(as_text=True)[:200])
+    juego_id = r.get_json()['id']
+    for cliente in clientes:
+        r = ctx[cliente].post('/orden', json=orden(juego_id, f'REF-{nombre}-{cliente}'))
+        assert r.status_code == 200, (r.status_code, r.get_data(as_text=True)[:200])
+        r = ctx['admin'].patch(f"/admin/orden/{r.get_json()['id']}", json={'estado': 'procesado'})
+        assert r.status_code == 200, (r.status_code, r.get_data(as_text=True)[:200])
+    return juego_id
+
+
+def valorar(ctx, cliente, juego_id, calificacion):
+    r = ctx[cliente].post('/valoracion', json={'juego_id': juego_id, 'calificacion': calificacion, 'comentario': 'test'})
+    assert r.status_code == 200, (r.status_code, r.get_data(as_text=True)[:200])
+
+
+def resumen_coincide(juego_id, paso):
+    """valoraciones_resumen of juego_id matches an aggregate over valoraciones"""
+    import migrations
+    conn = migrations.connect(os.environ['DATABASE_PATH'])
+    try:
+        esperado = conn.execute('''
+            SELECT COUNT(*), COALESCE(SUM(calificacion), 0), AVG(calificacion),
+                   COUNT(CASE WHEN calificacion = 1 THEN 1 END), COUNT(CASE WHEN calificacion = 2 THEN 1 END),
+                   COUNT(CASE WHEN calificacion = 3 THEN 1 END), COUNT(CASE WHEN calificacion = 4 THEN 1 END),
+                   COUNT(CASE WHEN calificacion = 5 THEN 1 END)
+            FROM valoraciones WHERE juego_id = ?
+        ''', (juego_id,)).fetchone()
+        fila = conn.execute('''
+            SELECT total, suma, CAST(suma AS REAL) / NULLIF(total, 0),
+                   estrellas_1, estrellas_2, estrellas_3, estrellas_4, estrellas_5
+            FROM valoraciones_resumen WHERE juego_id = ?
+        ''', (juego_id,)).fetchone()
+    finally:
+        conn.close()
+    # With no reviews the resumen row may be missing or all zeros
+    resumen = tuple(fila) if fila is not None else (0, 0, None, 0, 0, 0, 0, 0)
+    assert resumen == tuple(esperado), (paso, resumen, tuple(esperado))
+
+
+def check_borrar_producto_valorado(ctx):
+    """DELETE /admin/producto works for a product that has reviews"""
+    juego_id = producto_comprado(ctx, 'Valorado')
+    r = ctx['cliente'].post('/valoracion', json={'juego_id': juego_id, 'calificacion': 4, 'comentario': 'ok'})
+    assert r.status_code == 200, (r.status_code, r.get_data(as_text=True)[:200])
+    r = ctx['admin'].delete(f'/admin/producto/{juego_id}')
+    assert r.status_code == 200, (r.status_code, r.get_data(as_text=True)[:200])
+    assert ctx['admin'].delete(f'/admin/producto/{juego_id}').status_code == 404
+
+
+def check_resumen_valoraciones(ctx):
+    """valoraciones_resumen follows valoraciones on create, edit, delete and product delete"""
+    import migrations
+    juego_id = producto_comprado(ctx, 'Resumen', clientes=('cliente', 'otro'))
+    resumen_coincide(juego_id, 'sin valoraciones')
+    valorar(ctx, 'cliente', juego_id, 5)
+    resumen_coincide(juego_id, 'crear')
+    valorar(ctx, 'otro', juego_id, 2)
+    resumen_coincide(juego_id, 'crear segunda')
+    valorar(ctx, 'cliente', juego_id, 3)
+    resumen_coincide(juego_id, 'editar')
+
+    # There is no endpoint to delete a review: delete it directly to exercise the trigger
+    conn = migrations.connect(os.environ['DATABASE_PATH'])
+    try:
+        conn.execute("DELETE FROM valoraciones WHERE juego_id = ? AND usuario_email = 'otro@example.com'", (juego_id,))
+        conn.commit()
+    finally:
+        conn.close()
+    resumen_coincide(juego_id, 'borrar')
+
+    r = ctx['admin'].delete(f'/admin/producto/{juego_id}')
+    assert r.status_code == 200, (r.status_code, r.get_data(as_text=True)[:200])
+    resumen_coincide(juego_id, 'borrar producto')
+
+
+def check_reparar_ids_juegos(ctx):
+    """Migration 003 keeps each NULL-id product on its rowid and refuses ambiguous collisions"""
+    import sqlite3
+    import migrations
+
+    def base_heredada(juego_id_orden):
+        # Legacy PostgreSQL-style table: 'SERIAL' is not a rowid alias and accepts NULL
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE juegos (id SERIAL PRIMARY KEY, nombre TEXT, descripcion TEXT, imagen TEXT, '
+                     "categoria TEXT DEFAULT 'juegos', orden INTEGER DEFAULT 0, etiquetas TEXT)")
+        conn.execute('CREATE TABLE paquetes (id INTEGER PRIMARY KEY, juego_id INTEGER, nombre TEXT)')
+        conn.execute('CREATE TABLE ordenes (id INTEGER PRIMARY KEY, juego_id INTEGER)')
+        conn.executemany('INSERT INTO juegos (rowid, id, nombre) VALUES (?, ?, ?)',
+                         [(1, None, 'a'), (2, None, 'b'), (3, 1, 'c')])
+        conn.execute('INSERT INTO ordenes (juego_id) VALUES (?)', (juego_id_orden,))
+        return conn
+
+    conn = base_heredada(2)
+    migrations._m003_reparar_ids_juegos(conn)
+    ids = dict(conn.execute('SELECT nombre, id FROM juegos'))
+    assert ids['b'] == 2 and ids['c'] == 1 and ids['a'] not in (1, 2), ids
+    nombre = conn.execute('SELECT j.nombre FROM ordenes o JOIN juegos j ON j.id = o.juego_id').fetchone()[0]
+    assert nombre == 'b', nombre
+
+    # An order with juego_id=1 could belong to 'a' (rowid 1) or 'c' (id 1): the migration must stop
+    conn = base_heredada(1)
+    try:
+        migrations._m003_reparar_ids_juegos(conn)
+        raise AssertionError('ambiguous juego_id accepted')
+    except RuntimeError:
+        pass
+
+
+def check_usuario_admin_revocado(ctx):
+    """/usuario stops reporting es_admin once the admin flag is revoked in the database"""
+    import time
+    import migrations
+    admin = login(ctx['app'], ADMIN_EMAIL, ADMIN_PASSWORD, registrar=False)
+    assert admin.get('/usuario').get_json()['usuario']['es_admin'] is True
+
+    conn = migrations.connect(os.environ['DATABASE_PATH'])
+    try:
+        conn.execute('UPDATE usuarios SET es_admin = 0 WHERE email = ?', (ADMIN_EMAIL,))
+        conn.commit()
+        # The shared roles version is re-read at most every CACHE_VERSION_CHECK_SECONDS
+        time.sleep(ctx['main'].CACHE_VERSION_CHECK_SECONDS + 0.1)
+        assert admin.get('/usuario').get_json()['usuario']['es_admin'] is False
+        assert admin.get('/admin/ping').status_code == 403
+    finally:
+        conn.execute('UPDATE usuarios SET es_admin = 1 WHERE email = ?', (ADMIN_EMAIL,))
+        conn.commit()
+        conn.close()
+
+
+CHECKS = [
+    check_orden_producto_inexistente,
+    check_orden_referencia_repetida,
+    check_paginacion_fecha_null,
+    check_borrar_producto_valorado,
+    check_resumen_valoraciones,
+    check_reparar_ids_juegos,
+    check_usuario_admin_revocado,
+]
+
+
+def main():
+    app_main = setup()
+    app = app_main.app
+    productos = app.test_client().get('/productos').get_json() or []
+    if not productos:
+        print('no products in the seeded catalog')
+        return 1
+    ctx = {
+        'main': app_main,
+        'app': app,
+        'juego_id': productos[0]['id'],
+        'cliente': login(app, 'cliente@example.com', 'cliente'),
+        'otro': login(app, 'otro@example.com', 'otro'),
+        'admin': login(app, ADMIN_EMAIL, ADMIN_PASSWORD, registrar=False),
+    }
+
+    fallos = 0
+    for check in CHECKS:
+        try:
+            check(ctx)
+            print(f'ok    {check.__name__}')
+        except Exception:
+            fallos += 1
+            print(f'FAIL  {check.__name__}')
+            traceback.print_exc()
+    print(f'{len(CHECKS) - fallos}/{len(CHECKS)} checks passed')
+    return fallos
+
+
+if __name__ == '__main__':
+    sys.exit(main())
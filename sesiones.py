@@ -0,0 +1,200 @@
+"""
+Sesiones del lado del servidor.
+
+La cookie de sesión solo lleva un identificador aleatorio; los datos (el perfil del usuario
+logueado: id, nombre, email, teléfono, es_admin, fecha de registro) viven en la tabla
+sesiones, guardada bajo el sha256 del identificador. Cada worker mantiene una cache LRU de
+las sesiones que leyó, así /usuario y POST /orden no consultan la base en el caso común:
+
+  - SESSION_CACHE_SECONDS  cuánto confía un worker en su copia antes de releer la fila (por
+                           defecto 30; un logout hecho en otro worker se nota a más tardar entonces)
+  - SESSION_CACHE_MAX      sesiones en cache por worker
+  - SESSION_REFRESH_SECONDS  la expiración deslizante (PERMANENT_SESSION_LIFETIME) se renueva en la
+                           base como mucho cada tantos segundos, no en cada petición
+
+Las sesiones vencidas se borran por lotes en el job de retención (retencion.py).
+"""
+import os
+import time
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from sqlalchemy import text
+from werkzeug.datastructures import CallbackDict
+
+import app_logging
+
+log = app_logging.get_logger('sesiones')
+
+CACHE_SECONDS = float(os.environ.get('SESSION_CACHE_SECONDS', '30'))
+CACHE_MAX = int(os.environ.get('SESSION_CACHE_MAX', '4096'))
+REFRESH_SECONDS = float(os.environ.get('SESSION_REFRESH_SECONDS', '300'))
+
+_serializer = TaggedJSONSerializer()
+
+SQL_LEER = text('SELECT datos, expira FROM sesiones WHERE id = :id AND expira > :ahora')
+SQL_GUARDAR = text('''
+    INSERT INTO sesiones (id, usuario_id, datos, expira) VALUES (:id, :usuario_id, :datos, :expira)
+    ON CONFLICT(id) DO UPDATE SET usuario_id = excluded.usuario_id, datos = excluded.datos, expira = excluded.expira
+''')
+SQL_RENOVAR = text('UPDATE sesiones SET expira = :expira WHERE id = :id')
+SQL_BORRAR = text('DELETE FROM sesiones WHERE id = :id')
+
+
+def _clave(sid):
+    return hashlib.sha256(sid.encode('utf-8')).hexdigest()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Diccionario de sesión que recuerda si cambió (igual que la sesión por cookie de Flask)"""
+
+    def __init__(self, initial=None, sid=None, expira=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expira = expira
+        self.modified = False
+        self.sid_anterior = None
+
+    def rotar(self):
+        """Nuevo identificador al iniciar sesión (el anterior se borra al guardar)"""
+        if self.sid and self.sid_anterior is None:
+            self.sid_anterior = self.sid
+        self.sid = None
+        self.modified = True
+
+
+class SQLiteSessionInterface(SessionInterface):
+    """Guarda las sesiones en la tabla sesiones con una cache de lectura por worker"""
+
+    def __init__(self, get_connection, cache_seconds=None, cache_max=None):
+        self._get_connection = get_connection
+        self.cache_seconds = CACHE_SECONDS if cache_seconds is None else cache_seconds
+        self.cache_max = CACHE_MAX if cache_max is None else cache_max
+        self._cache = OrderedDict()  # clave -> (datos, expira, leido_en)
+        self._lock = threading.Lock()
+
+    # --- cache ---
+
+    def _cache_get(self, clave):
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._cache.get(clave)
+            if entrada is None:
+                return None
+            datos, expira, leido_en = entrada
+            if ahora - leido_en >= self.cache_seconds or expira <= time.time():
+                del self._cache[clave]
+                return None
+            self._cache.move_to_end(clave)
+            return datos, expira
+
+    def _cache_put(self, clave, datos, expira):
+        with self._lock:
+            self._cache[clave] = (datos, expira, time.monotonic())
+            self._cache.move_to_end(clave)
+            while len(self._cache) > self.cache_max:
+                self._cache.popitem(last=False)
+
+    def invalidate(self, clave=None):
+        with self._lock:
+            if clave is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(clave, None)
+
+    # --- SessionInterface ---
+
+    def _leer(self, clave):
+        cacheada = self._cache_get(clave)
+        if cacheada is not None:
+            return cacheada
+        conn = self._get_connection()
+        try:
+            row = conn.execute(SQL_LEER, {'id': clave, 'ahora': time.time()}).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        datos = _serializer.loads(row[0])
+        self._cache_put(clave, datos, row[1])
+        return datos, row[1]
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            leida = self._leer(_clave(sid))
+            if leida is not None:
+                datos, expira = leida
+                # Copia: la sesión de la petición no debe modificar la entrada de la cache
+                return ServerSession(dict(datos), sid=sid, expira=expira)
+        return ServerSession()
+
+    def _escribir(self, sql, params):
+        conn = self._get_connection()
+        try:
+            conn.execute(sql, params)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def save_session(self, app, session, response):
+        nombre = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.sid_anterior:
+            clave_anterior = _clave(session.sid_anterior)
+            self._escribir(SQL_BORRAR, {'id': clave_anterior})
+            self.invalidate(clave_anterior)
+
+        if not session:
+            # Sesión vacía: si existía (logout), borrarla junto con la cookie
+            if session.sid and session.modified:
+                clave = _clave(session.sid)
+                self._escribir(SQL_BORRAR, {'id': clave})
+                self.invalidate(clave)
+                response.delete_cookie(nombre, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app),
+                                       httponly=self.get_cookie_httponly(app),
+                                       samesite=self.get_cookie_samesite(app))
+            elif session.sid_anterior:
+                response.delete_cookie(nombre, domain=domain, path=path)
+            return
+
+        ahora = time.time()
+        expira = ahora + app.permanent_session_lifetime.total_seconds()
+        if session.modified or not session.sid:
+            if not session.sid:
+                session.sid = secrets.token_urlsafe(32)
+            clave = _clave(session.sid)
+            datos = dict(session)
+            self._escribir(SQL_GUARDAR, {'id': clave, 'usuario_id': datos.get('user_id'),
+                                         'datos': _serializer.dumps(datos), 'expira': expira})
+            self._cache_put(clave, datos, expira)
+        elif session.permanent and expira - (session.expira or 0) >= REFRESH_SECONDS:
+            # Expiración deslizante, pero sin escribir en cada petición
+            clave = _clave(session.sid)
+            self._escribir(SQL_RENOVAR, {'id': clave, 'expira': expira})
+            self._cache_put(clave, dict(session), expira)
+        else:
+            return
+
+        response.set_cookie(
+            nombre, session.sid,
+            expires=expira if session.permanent else None,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+        response.vary.add('Cookie')
@@ -0,0 +1,204 @@
+"""
+Pool de conexiones SMTP autenticadas.
+
+Abrir una conexión por correo cuesta TCP + STARTTLS + AUTH en cada mensaje. El pool mantiene
+hasta SMTP_POOL_SIZE conexiones ya autenticadas y las reutiliza:
+
+  - antes de reutilizar una conexión inactiva más de SMTP_KEEPALIVE_SECONDS le envía NOOP;
+    si no responde (o lleva más de SMTP_IDLE_SECONDS inactiva) se cierra y se abre otra
+  - si el servidor corta la conexión a mitad de un envío se reconecta y se reintenta una vez
+  - tras SMTP_MAX_MESSAGES_PER_CONNECTION mensajes la conexión se renueva (límite de Gmail)
+  - SMTP_RATE_PER_MINUTE (0 = sin límite) acota los envíos por minuto de este proceso
+
+send_batch() envía varios mensajes por la misma conexión; lo usa el worker de la outbox.
+"""
+import os
+import time
+import smtplib
+import threading
+from collections import deque
+
+import app_logging
+
+log = app_logging.get_logger('smtp')
+
+POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', '2'))
+KEEPALIVE_SECONDS = float(os.environ.get('SMTP_KEEPALIVE_SECONDS', '30'))
+IDLE_SECONDS = float(os.environ.get('SMTP_IDLE_SECONDS', '240'))
+MAX_MESSAGES_PER_CONNECTION = int(os.environ.get('SMTP_MAX_MESSAGES_PER_CONNECTION', '100'))
+RATE_PER_MINUTE = int(os.environ.get('SMTP_RATE_PER_MINUTE', '0'))
+TIMEOUT_SECONDS = float(os.environ.get('SMTP_TIMEOUT_SECONDS', '30'))
+
+
+def es_error_de_conexion(error):
+    """True si tras el error la conexión ya no sirve (SMTPException hereda de OSError, hay que distinguir)"""
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+class _Conexion:
+    __slots__ = ('smtp', 'usada_en', 'enviados')
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.usada_en = time.monotonic()
+        self.enviados = 0
+
+
+class RateLimiter:
+    """Ventana deslizante de 60 s: bloquea hasta que haya cupo"""
+
+    def __init__(self, por_minuto):
+        self.por_minuto = por_minuto
+        self._envios = deque()
+        self._lock = threading.Lock()
+
+    def esperar(self):
+        if self.por_minuto <= 0:
+            return
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                while self._envios and ahora - self._envios[0] >= 60:
+                    self._envios.popleft()
+                if len(self._envios) < self.por_minuto:
+                    self._envios.append(ahora)
+                    return
+                espera = 60 - (ahora - self._envios[0])
+            time.sleep(espera)
+
+
+class SmtpPool:
+    """config() devuelve (host, port, user, password, sender, use_tls, use_ssl), como _smtp_config()"""
+
+    def __init__(self, config, size=None, rate_per_minute=None):
+        self._config = config
+        self._pid = os.getpid()
+        self._libres = []  # LIFO: la conexión más reciente es la que menos riesgo tiene de estar cortada
+        self._lock = threading.Lock()
+        self._cupos = threading.BoundedSemaphore(size or POOL_SIZE)
+        self._rate = RateLimiter(RATE_PER_MINUTE if rate_per_minute is None else rate_per_minute)
+        self.stats = {'conexiones': 0, 'reconexiones': 0, 'noops': 0, 'enviados': 0}
+
+    def _conectar(self):
+        host, port, user, password, sender, use_tls, use_ssl = self._config()
+        if use_ssl or port == 465:
+            smtp = smtplib.SMTP_SSL(host, port, timeout=TIMEOUT_SECONDS)
+        else:
+            smtp = smtplib.SMTP(host, port, timeout=TIMEOUT_SECONDS)
+            if use_tls:
+                smtp.starttls()
+        if user and password:
+            smtp.login(user, password)
+        with self._lock:
+            self.stats['conexiones'] += 1
+        return _Conexion(smtp)
+
+    @staticmethod
+    def _cerrar(conexion):
+        try:
+            conexion.smtp.quit()
+        except Exception:
+            try:
+                conexion.smtp.close()
+            except Exception:
+                pass
+
+    def _viva(self, conexion):
+        inactiva = time.monotonic() - conexion.usada_en
+        if inactiva > IDLE_SECONDS or conexion.enviados >= MAX_MESSAGES_PER_CONNECTION:
+            return False
+        if inactiva < KEEPALIVE_SECONDS:
+            return True
+        try:
+            with self._lock:
+                self.stats['noops'] += 1
+            return conexion.smtp.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _tomar(self):
+        while True:
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Tras un fork los sockets heredados son del padre: no compartirlos
+                    self._pid = os.getpid()
+                    self._libres = []
+                conexion = self._libres.pop() if self._libres else None
+            if conexion is None:
+                return self._conectar()
+            if self._viva(conexion):
+                return conexion
+            self._cerrar(conexion)
+
+    def _devolver(self, conexion):
+        conexion.usada_en = time.monotonic()
+        with self._lock:
+            self._libres.append(conexion)
+
+    def _enviar_uno(self, conexion, msg):
+        """Envía por conexion; si se cortó, reconecta y reintenta una vez. Devuelve la conexión vigente."""
+        self._rate.esperar()
+        try:
+            conexion.smtp.send_message(msg)
+        except Exception as e:
+            if not es_error_de_conexion(e):
+                raise
+            log.info("Conexión SMTP perdida (%s), reconectando", e)
+            self._cerrar(conexion)
+            conexion = self._conectar()
+            with self._lock:
+                self.stats['reconexiones'] += 1
+            conexion.smtp.send_message(msg)
+        conexion.enviados += 1
+        with self._lock:
+            self.stats['enviados'] += 1
+        return conexion
+
+    def send(self, msg):
+        """Envía un EmailMessage; lanza la excepción si falla"""
+        error = self.send_batch([msg])[0]
+        if error is not None:
+            raise error
+
+    def send_batch(self, mensajes):
+        """Envía varios EmailMessage por una misma conexión.
+
+        Devuelve una lista alineada con mensajes: None si se envió o la excepción si falló.
+        """
+        resultados = []
+        with self._cupos:
+            conexion = None
+            try:
+                for msg in mensajes:
+                    try:
+                        if conexion is None:
+                            conexion = self._tomar()
+                        conexion = self._enviar_uno(conexion, msg)
+                        resultados.append(None)
+                    except Exception as e:
+                        resultados.append(e)
+                        if conexion is None:
+                            continue
+                        if es_error_de_conexion(e) or not isinstance(e, smtplib.SMTPException):
+                            # La reconexión también falló: descartar la conexión y seguir con el resto
+                            self._cerrar(conexion)
+                            conexion = None
+                            continue
+                        # Rechazo de un destinatario/mensaje: la conexión sigue sirviendo
+                        try:
+                            conexion.smtp.rset()
+                        except Exception:
+                            self._cerrar(conexion)
+                            conexion = None
+            finally:
+                if conexion is not None:
+                    self._devolver(conexion)
+        return resultados
+
+    def close(self):
+        with self._lock:
+            libres, self._libres = self._libres, []
+        for conexion in libres:
+            self._cerrar(conexion)
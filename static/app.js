@@ -2561,6 +2561,29 @@ function inicializarEventos() {
     });
 }
 
+// Clave de idempotencia del pago en curso: se conserva entre reintentos del mismo carrito
+// para que un doble clic o un reintento no cree órdenes duplicadas
+let pagoIdempotencyKey = null;
+
+function generarIdempotencyKey() {
+    if (window.crypto && typeof window.crypto.randomUUID === 'function') {
+        return window.crypto.randomUUID();
+    }
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}-${Math.random().toString(36).slice(2)}`;
+}
+
+// Huella corta (FNV-1a) de la orden: si el carrito o los datos de pago cambian entre
+// reintentos la clave también cambia
+function huellaOrden(orden) {
+    const texto = JSON.stringify(orden);
+    let hash = 0x811c9dc5;
+    for (let i = 0; i < texto.length; i++) {
+        hash ^= texto.charCodeAt(i);
+        hash = Math.imul(hash, 0x01000193) >>> 0;
+    }
+    return hash.toString(16);
+}
+
 // Procesar pago
 async function procesarPago() {
     const email = document.getElementById('pago-email').value;
@@ -2603,8 +2626,12 @@ async function procesarPago() {
             return;
         }
 
+        if (!pagoIdempotencyKey) {
+            pagoIdempotencyKey = generarIdempotencyKey();
+        }
+
         // Crear una orden por cada item del carrito
-        for (const item of carrito) {
+        for (const [indice, item] of carrito.entries()) {
             const orden = {
                 juego_id: item.productoId,
                 paquete: item.paqueteNombre,
@@ -2619,6 +2646,7 @@ async function procesarPago() {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'Idempotency-Key': `${pagoIdempotencyKey}:${indice}:${huellaOrden(orden)}`,
                 },
                 body: JSON.stringify(orden)
             });
@@ -2641,6 +2669,7 @@ async function procesarPago() {
         detenerTemporizador();
 
         // Limpiar carrito y mostrar Ã©xito
+        pagoIdempotencyKey = null;
         carrito = [];
         limpiarCarritoStorage();
         actualizarContadorCarrito();
@@ -2883,6 +2912,22 @@ let historialCurrentPage = 1;
 let historialItemsPerPage = 5;
 let historialTotalItems = 0;
 let historialData = [];
+// El servidor pagina por cursor: se piden más compras solo al llegar al final de las cargadas
+let historialCursor = null;
+const HISTORIAL_LOTE = 20;
+
+async function cargarMasHistorial() {
+    const params = new URLSearchParams({ limit: HISTORIAL_LOTE });
+    if (historialCursor) params.set('cursor', historialCursor);
+    const response = await fetch(`/usuario/historial?${params}`);
+    if (!response.ok) {
+        throw new Error('Error al cargar historial');
+    }
+    const pagina = await response.json();
+    historialData = historialData.concat(pagina);
+    historialTotalItems = historialData.length;
+    historialCursor = response.headers.get('X-Next-Cursor');
+}
 
 // Mostrar historial de compras con paginaciÃ³n
 async function mostrarHistorialCompras() {
@@ -2896,14 +2941,10 @@ async function mostrarHistorialCompras() {
     listaCompras.innerHTML = '<div class="loading">Cargando historial...</div>';
 
     try {
-        const response = await fetch('/usuario/historial');
-
-        if (!response.ok) {
-            throw new Error('Error al cargar historial');
-        }
-
-        historialData = await response.json();
-        historialTotalItems = historialData.length;
+        historialData = [];
+        historialCursor = null;
+        historialCurrentPage = 1;
+        await cargarMasHistorial();
 
         if (historialData.length === 0) {
             listaCompras.innerHTML = `
@@ -2951,12 +2992,19 @@ async function mostrarHistorialCompras() {
 }
 
 // Cargar pÃ¡gina especÃ­fica del historial
-function loadHistorialPage() {
+async function loadHistorialPage() {
     const container = document.getElementById('historial-items-container');
     if (!container) return;
 
     const startIndex = (historialCurrentPage - 1) * historialItemsPerPage;
     const endIndex = startIndex + historialItemsPerPage;
+    try {
+        while (historialCursor && historialData.length < endIndex) {
+            await cargarMasHistorial();
+        }
+    } catch (error) {
+        console.error('Error al cargar historial:', error);
+    }
     const pageItems = historialData.slice(startIndex, endIndex);
 
     let html = '';
@@ -3026,11 +3074,13 @@ function loadHistorialPage() {
 // Actualizar controles de paginaciÃ³n del historial
 function updateHistorialPaginationControls() {
     const totalPages = Math.ceil(historialTotalItems / historialItemsPerPage);
+    // Con cursor pendiente hay más compras en el servidor que aún no se cargaron
+    const hayMas = Boolean(historialCursor);
     
     // Actualizar informaciÃ³n de pÃ¡gina
     const pageInfo = document.getElementById('historial-page-info');
     if (pageInfo) {
-        pageInfo.textContent = `Página ${historialCurrentPage} de ${totalPages}`;
+        pageInfo.textContent = `Página ${historialCurrentPage} de ${totalPages}${hayMas ? '+' : ''}`;
     }
 
     // Actualizar botones
@@ -3043,8 +3093,9 @@ function updateHistorialPaginationControls() {
     }
     
     if (nextBtn) {
-        nextBtn.disabled = historialCurrentPage >= totalPages;
-        nextBtn.style.opacity = historialCurrentPage >= totalPages ? '0.5' : '1';
+        const ultima = historialCurrentPage >= totalPages && !hayMas;
+        nextBtn.disabled = ultima;
+        nextBtn.style.opacity = ultima ? '0.5' : '1';
     }
 
     // Actualizar selector de items por pÃ¡gina
@@ -3075,7 +3126,7 @@ function previousHistorialPage() {
 // Ir a la siguiente pÃ¡gina del historial
 function nextHistorialPage() {
     const totalPages = Math.ceil(historialTotalItems / historialItemsPerPage);
-    if (historialCurrentPage < totalPages) {
+    if (historialCurrentPage < totalPages || historialCursor) {
         historialCurrentPage++;
         loadHistorialPage();
     }
@@ -4605,13 +4656,31 @@ async function ordenarProductosAdmin() {
 
 // Variables globales para valoraciones
 let valoracionSeleccionada = 0;
+// Por producto: orden elegido, valoraciones ya cargadas y cursor de la página siguiente
+const valoracionesPaginadas = {};
+
+async function pedirValoraciones(juego_id, cursor) {
+    const estado = valoracionesPaginadas[juego_id];
+    const params = new URLSearchParams({ orden: estado.orden });
+    if (cursor) params.set('cursor', cursor);
+    const response = await fetch(`/valoraciones/${juego_id}?${params}`);
+    if (!response.ok) {
+        throw new Error('Error al cargar valoraciones');
+    }
+    const data = await response.json();
+    estado.cursor = response.headers.get('X-Next-Cursor');
+    estado.lista = cursor ? estado.lista.concat(data.valoraciones) : data.valoraciones;
+    return data;
+}
 
 // FunciÃ³n para cargar valoraciones de un producto
 async function cargarValoracionesProducto(juego_id) {
     try {
-        // Cargar valoraciones del producto
-        const response = await fetch(`/valoraciones/${juego_id}`);
-        const data = await response.json();
+        const orden = valoracionesPaginadas[juego_id]?.orden || 'recientes';
+        valoracionesPaginadas[juego_id] = { orden, cursor: null, lista: [] };
+
+        // Cargar la primera página de valoraciones del producto
+        const data = await pedirValoraciones(juego_id, null);
 
         // Actualizar estadÃ­sticas
         actualizarEstadisticasValoraciones(juego_id, data.estadisticas);
@@ -4620,7 +4689,7 @@ async function cargarValoracionesProducto(juego_id) {
         await cargarFormularioValoracion(juego_id);
 
         // Mostrar lista de valoraciones
-        mostrarListaValoraciones(juego_id, data.valoraciones);
+        mostrarListaValoraciones(juego_id, valoracionesPaginadas[juego_id].lista);
 
     } catch (error) {
         console.error('Error al cargar valoraciones:', error);
@@ -4869,10 +4938,35 @@ async function enviarValoracion(juego_id) {
     }
 }
 
+// Siguiente página de valoraciones (botón "Ver más")
+async function cargarMasValoraciones(juego_id) {
+    const estado = valoracionesPaginadas[juego_id];
+    if (!estado || !estado.cursor) return;
+    try {
+        await pedirValoraciones(juego_id, estado.cursor);
+        mostrarListaValoraciones(juego_id, estado.lista);
+    } catch (error) {
+        console.error('Error al cargar valoraciones:', error);
+        mostrarAlerta('Error al cargar más valoraciones', 'error');
+    }
+}
+
+// Cambiar el orden de la lista (recientes | mayor | menor calificación)
+async function cambiarOrdenValoraciones(juego_id, orden) {
+    valoracionesPaginadas[juego_id] = { orden, cursor: null, lista: [] };
+    try {
+        await pedirValoraciones(juego_id, null);
+        mostrarListaValoraciones(juego_id, valoracionesPaginadas[juego_id].lista);
+    } catch (error) {
+        console.error('Error al cargar valoraciones:', error);
+    }
+}
+
 // FunciÃ³n para mostrar lista de valoraciones
 function mostrarListaValoraciones(juego_id, valoraciones) {
     const reviewsList = document.getElementById(`reviews-list-${juego_id}`);
     if (!reviewsList) return;
+    const estado = valoracionesPaginadas[juego_id] || { orden: 'recientes', cursor: null };
 
     if (!valoraciones || valoraciones.length === 0) {
         reviewsList.innerHTML = `
@@ -4885,7 +4979,15 @@ function mostrarListaValoraciones(juego_id, valoraciones) {
         return;
     }
 
-    let html = '';
+    let html = `
+        <div class="reviews-sort" style="display: flex; justify-content: flex-end; margin-bottom: 10px;">
+            <select onchange="cambiarOrdenValoraciones(${juego_id}, this.value)" style="padding: 6px 10px; border: 1px solid rgba(255,255,255,0.2); border-radius: 6px; background: rgba(255,255,255,0.1); color: #ffffff; font-size: 13px;">
+                <option value="recientes" ${estado.orden === 'recientes' ? 'selected' : ''}>Más recientes</option>
+                <option value="mayor" ${estado.orden === 'mayor' ? 'selected' : ''}>Mayor calificación</option>
+                <option value="menor" ${estado.orden === 'menor' ? 'selected' : ''}>Menor calificación</option>
+            </select>
+        </div>
+    `;
     valoraciones.forEach(valoracion => {
         // Formatear fecha
         const fecha = new Date(valoracion.fecha).toLocaleDateString('es-ES', {
@@ -4894,8 +4996,8 @@ function mostrarListaValoraciones(juego_id, valoraciones) {
             day: 'numeric'
         });
 
-        // Nombre del usuario (usar nombre completo si estÃ¡ disponible, sino email oculto)
-        const nombreUsuario = valoracion.usuario_nombre || valoracion.usuario_email_oculto || 'Usuario';
+        // Nombre del usuario (nombre o email oculto, guardado al escribir la valoración)
+        const nombreUsuario = valoracion.usuario_nombre || 'Usuario';
 
         html += `
             <div class="review-item">
@@ -4911,6 +5013,14 @@ function mostrarListaValoraciones(juego_id, valoraciones) {
         `;
     });
 
+    if (estado.cursor) {
+        html += `
+            <div style="text-align: center; margin-top: 15px;">
+                <button class="btn btn-sm" onclick="cargarMasValoraciones(${juego_id})" style="padding: 8px 15px; font-size: 13px; background: rgba(255,255,255,0.1); color: #ffffff; border: 1px solid rgba(255,255,255,0.2); border-radius: 6px;">Ver más valoraciones</button>
+            </div>
+        `;
+    }
+
     reviewsList.innerHTML = html;
 }
 